@@ -0,0 +1,87 @@
+import threading
+
+from MSApi import Bundle, Filter, Product
+
+from CatalogRecords import MsAssortmentRecord
+from settings import IMPORT_FLAG_ATTR_NAME
+
+
+def gen_import_products(import_flag_href, filters: Filter = None, **kwargs):
+    """возвращает товары МС с флагом импорта"""
+    import_filter = Filter.eq(import_flag_href, True)
+    if filters is not None:
+        import_filter += filters
+    return Product.gen_list(filters=import_filter, **kwargs)
+
+
+def gen_import_bundles(**kwargs):
+    """возвращает комплекты МС с флагом импорта"""
+    for ms_bundle in Bundle.gen_list(**kwargs):
+        # FIXME исправить на фильтр когда зафиксят баг
+        import_flag = ms_bundle.get_attribute_by_name(IMPORT_FLAG_ATTR_NAME)
+        if import_flag is None:
+            continue
+        if not import_flag.get_value():
+            continue
+        yield ms_bundle
+
+
+class AssortmentIndex:
+    """индекс wc_id -> [MsAssortmentRecord] импортируемого ассортимента МС.
+    Загружается целиком один раз, промахи дозапрашиваются по одному и запоминаются, только если найдены.
+    Может использоваться из параллельных потоков синхронизации заказов"""
+
+    def __init__(self, wc_id_href, import_flag_href, mirror=None, ms_objects=None):
+        """mirror - локальное зеркало каталогов (CatalogMirror), из которого строится индекс;
+        ms_objects - функция, возвращающая уже загруженные записи товаров и комплектов МС"""
+        self.__wc_id_href = wc_id_href
+        self.__import_flag_href = import_flag_href
+        self.__mirror = mirror
+        self.__ms_objects = ms_objects
+        self.__index = None  # {str: [MsAssortmentRecord]}
+        self.__lock = threading.Lock()
+
+    def get(self, wc_id):
+        """возвращает объекты МС, связанные с товаром WC"""
+        index = self.__get_index()
+        wc_id = str(wc_id)
+        ms_object_list = index.get(wc_id)
+        if ms_object_list is None:
+            ms_object_list = [MsAssortmentRecord.from_ms_object(ms_object) for ms_object in gen_import_products(
+                self.__import_flag_href, filters=Filter.eq(self.__wc_id_href, wc_id))]
+            if ms_object_list:
+                # пустой результат не запоминается: товар может быть связан позже
+                index[wc_id] = ms_object_list
+        return ms_object_list
+
+    def add(self, wc_id, ms_object: MsAssortmentRecord):
+        """добавляет в индекс новую связь"""
+        ms_object_list = self.__get_index().setdefault(str(wc_id), [])
+        if ms_object not in ms_object_list:
+            ms_object_list.append(ms_object)
+
+    def __get_index(self):
+        with self.__lock:
+            if self.__index is None:
+                self.__load()
+        return self.__index
+
+    def __load(self):
+        self.__index = {}
+        if self.__mirror is not None:
+            for ms_object in self.__mirror.gen_ms_by_wc_id():
+                if type(ms_object) in [Product, Bundle]:
+                    self.__append(MsAssortmentRecord.from_ms_object(ms_object))
+        elif self.__ms_objects is not None:
+            for ms_object in self.__ms_objects():
+                self.__append(ms_object)
+        else:
+            for ms_object in gen_import_products(self.__import_flag_href):
+                self.__append(MsAssortmentRecord.from_ms_object(ms_object))
+            for ms_object in gen_import_bundles():
+                self.__append(MsAssortmentRecord.from_ms_object(ms_object))
+
+    def __append(self, ms_record: MsAssortmentRecord):
+        if ms_record.wc_id is None:
+            return
+        self.__index.setdefault(str(ms_record.wc_id), []).append(ms_record)
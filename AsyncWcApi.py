@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from time import time
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from woocommerce.oauth import OAuth
+
+from WcApi import WcApi, check_wc_response
+
+
+class AsyncWcApi:
+    """асинхронный клиент WooCommerce для чтения каталогов, методы чтения - как у WcApi.
+    Запросы идут через общий пул соединений, число одновременных запросов ограничено.
+    Повторы и подстройка числа запросов - общие с WcApi (WcApi.retry_policy, WcApi.get_limiter)"""
+
+    session = None
+    concurrency = 8
+    timeout = 30
+
+    MAX_PER_PAGE = WcApi.MAX_PER_PAGE
+    VERSION = 'wc/v3'
+
+    __url = None
+    __consumer_key = None
+    __consumer_secret = None
+    __semaphores = {}  # {loop: asyncio.Semaphore}
+
+    @classmethod
+    def login(cls, url, consumer_key, consumer_secret, concurrency: int = None):
+        if concurrency is not None:
+            cls.concurrency = max(concurrency, 1)
+        if not url.endswith('/'):
+            url += '/'
+        cls.__url = f"{url}wp-json/{cls.VERSION}/"
+        cls.__consumer_key = consumer_key
+        cls.__consumer_secret = consumer_secret
+
+        cls.session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls.concurrency)
+        cls.session.mount('https://', adapter)
+        cls.session.mount('http://', adapter)
+        cls.session.headers.update({"accept": "application/json"})
+        if cls.__url.startswith('https'):
+            cls.session.auth = HTTPBasicAuth(consumer_key, consumer_secret)
+
+    @classmethod
+    async def get(cls, endpoint, **kwargs):
+        response = await cls.__request('GET', endpoint, **kwargs)
+        return response.json()
+
+    @classmethod
+    async def gen_all_wc(cls, entity, filters: {str: str} = None, per_page: int = MAX_PER_PAGE, fields=None,
+                         **kwargs):
+        """асинхронный генератор всех объектов WC. Страницы после первой
+        запрашиваются параллельно и отдаются по порядку. fields - см. WcApi.gen_all_wc"""
+        per_page = min(per_page, cls.MAX_PER_PAGE)
+        filters_str = ""
+        if filters is not None:
+            for filter_parameter, filter_value in filters.items():
+                filters_str += f"&{filter_parameter}={filter_value}"
+        if fields is not None:
+            filters_str += "&_fields={}".format(','.join(sorted(set(fields))))
+
+        def get_page_endpoint(page):
+            return f'{entity}?per_page={per_page}&page={page}{filters_str}'
+
+        response = await cls.__request('GET', get_page_endpoint(1), **kwargs)
+        wc_object_list = response.json()
+        for wc_object in wc_object_list:
+            yield wc_object
+
+        total_pages = response.headers.get('X-WP-TotalPages')
+        if total_pages is None:
+            page_iterator = 2
+            while len(wc_object_list) != 0:
+                wc_object_list = await cls.get(get_page_endpoint(page_iterator), **kwargs)
+                for wc_object in wc_object_list:
+                    yield wc_object
+                page_iterator += 1
+            return
+
+        page_tasks = [asyncio.ensure_future(cls.get(get_page_endpoint(page), **kwargs))
+                      for page in range(2, int(total_pages) + 1)]
+        try:
+            for page_task in page_tasks:
+                for wc_object in await page_task:
+                    yield wc_object
+        finally:
+            for page_task in page_tasks:
+                page_task.cancel()
+
+    @classmethod
+    def gen_all_wc_products(cls, **kwargs):
+        return cls.gen_all_wc(entity="products", **kwargs)
+
+    @classmethod
+    async def get_all_wc(cls, entity, **kwargs):
+        """возвращает все объекты WC списком"""
+        return [wc_object async for wc_object in cls.gen_all_wc(entity, **kwargs)]
+
+    @classmethod
+    async def __request(cls, method, endpoint, **kwargs):
+        if cls.session is None:
+            raise RuntimeError("AsyncWcApi: login first")
+        attempt = 0
+        while True:
+            async with cls.__get_semaphore():
+                logging.debug(f"AsyncWcApi {method}: {endpoint}")
+                # ограничитель WcApi блокирующий, поэтому попытка целиком выполняется в потоке
+                response, delay = await asyncio.to_thread(WcApi.try_request, method, endpoint,
+                                                          lambda: cls.__send(method, endpoint, **kwargs),
+                                                          True, attempt)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+        check_wc_response(response)
+        return response
+
+    @classmethod
+    def __send(cls, method, endpoint, **kwargs):
+        url = f"{cls.__url}{endpoint}"
+        headers = {}
+        if cls.session.auth is None:
+            url = OAuth(url=url,
+                        consumer_key=cls.__consumer_key,
+                        consumer_secret=cls.__consumer_secret,
+                        version=cls.VERSION,
+                        method=method,
+                        oauth_timestamp=int(time())).get_oauth_url()
+        kwargs.setdefault('timeout', cls.timeout)
+        return cls.session.request(method, url, headers=headers, **kwargs)
+
+    @classmethod
+    def __get_semaphore(cls):
+        loop = asyncio.get_running_loop()
+        semaphore = cls.__semaphores.get(loop)
+        if semaphore is None:
+            semaphore = cls.__semaphores[loop] = asyncio.Semaphore(cls.concurrency)
+        return semaphore
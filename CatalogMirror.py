@@ -0,0 +1,349 @@
+import json
+import logging
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from MSApi import Bundle, DateTimeFilter, Filter, Product, Service
+
+from CatalogRecords import MsAssortmentRecord, WcProductRecord
+from FileLock import FileLock
+from WcApi import WcApi, get_wooms_href
+from settings import IMPORT_FLAG_ATTR_NAME, MS_TIMEZONE, WC_ID_ATTR_NAME
+
+MS_TYPES = {
+    Product.get_typename(): Product,
+    Bundle.get_typename(): Bundle,
+    Service.get_typename(): Service,
+}
+
+# поля товаров WC, которые хранит зеркало (описания, изображения и т.п. не нужны синхронизации)
+WC_PRODUCT_FIELDS = ('id', 'name', 'type', 'status', 'regular_price', 'sale_price', 'meta_data', 'date_modified_gmt')
+
+# типы МС, которые связываются с товарами WC через wc_id
+LINKED_TYPES_SQL = "('{}', '{}')".format(Product.get_typename(), Bundle.get_typename())
+
+# условия отбора объектов, участвующих в синхронизации: архивные объекты МС и товары WC в корзине не участвуют
+MS_ACTIVE_SQL = "archived = 0"
+WC_ACTIVE_SQL = "status IS NOT 'trash'"
+
+# версия схемы, при её изменении зеркало создаётся заново
+SCHEMA_VERSION = '2'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS wc_products (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    status TEXT,
+    regular_price TEXT,
+    sale_price TEXT,
+    wooms_href TEXT,
+    modified TEXT,
+    json TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ms_assortment (
+    href TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    name TEXT,
+    wc_id_raw TEXT,
+    wc_id INTEGER,
+    import_flag INTEGER NOT NULL DEFAULT 0,
+    archived INTEGER NOT NULL DEFAULT 0,
+    sale_prices TEXT,
+    updated TEXT,
+    json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ms_assortment_wc_id ON ms_assortment (wc_id);
+CREATE TABLE IF NOT EXISTS mirror_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class CatalogMirror:
+    """локальное зеркало каталогов WC и МС в SQLite.
+    Обновляется инкрементально по времени изменения объектов: товары WC, перемещённые в корзину,
+    и архивные объекты МС отмечаются при обновлении, удалённые окончательно - убираются полной перезагрузкой.
+    Зеркало может быть общим для нескольких процессов (частей синхронизации): схему и обновление
+    выполняет один процесс под файловой блокировкой рядом с базой, остальные ждут"""
+
+    # сколько ждать, пока другой процесс держит блокировку базы, секунды
+    BUSY_TIMEOUT = 60
+
+    def __init__(self, path):
+        # обновление другим процессом, завершённое позже этого момента, не повторяется
+        self.__refreshed_after = datetime.now(timezone.utc)
+        self.__lock_path = None if path == ':memory:' else path + '.lock'
+        self.__connection = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        # в режиме WAL другие процессы читают зеркало, пока оно обновляется
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        with FileLock(self.__lock_path):
+            self.__create_schema()
+
+    def __create_schema(self):
+        self.__connection.executescript(SCHEMA)
+        if self.__get_state('schema_version') == SCHEMA_VERSION:
+            return
+        with self.__connection:
+            self.__connection.execute("DROP TABLE wc_products")
+            self.__connection.execute("DROP TABLE ms_assortment")
+            self.__connection.execute("DELETE FROM mirror_state")
+        self.__connection.executescript(SCHEMA)
+        with self.__connection:
+            self.__set_state('schema_version', SCHEMA_VERSION)
+
+    def close(self):
+        self.__connection.close()
+
+    def refresh(self, full_refresh_interval: timedelta = None):
+        """дозагружает изменения с момента прошлого обновления.
+        Полная перезагрузка - при первом запуске или по истечении full_refresh_interval.
+        Если зеркало обновил другой процесс, пока этот открывал его или ждал блокировки, повторно оно не обновляется"""
+        with FileLock(self.__lock_path):
+            refresh_finished = self.__get_state_datetime('refresh_finished')
+            if refresh_finished is not None and refresh_finished >= self.__refreshed_after:
+                logging.info("Catalog mirror: refreshed by another process")
+            else:
+                self.__refresh(full_refresh_interval)
+            self.__refreshed_after = datetime.now(timezone.utc)
+
+    def __refresh(self, full_refresh_interval: timedelta = None):
+        started_at = datetime.now(timezone.utc)
+        last_refresh = self.__get_state_datetime('last_refresh')
+        last_full_refresh = self.__get_state_datetime('last_full_refresh')
+        is_full = last_refresh is None or last_full_refresh is None \
+            or (full_refresh_interval is not None and started_at - last_full_refresh >= full_refresh_interval)
+
+        with self.__connection:
+            if is_full:
+                logging.info("Catalog mirror: full refresh")
+                self.__connection.execute("DELETE FROM wc_products")
+                self.__connection.execute("DELETE FROM ms_assortment")
+                self.__refresh_wc(None)
+                self.__refresh_ms(None)
+                self.__set_state('last_full_refresh', started_at.isoformat())
+            else:
+                logging.info("Catalog mirror: changes since {}".format(last_refresh.isoformat()))
+                self.__refresh_wc(last_refresh)
+                self.__refresh_ms(last_refresh)
+            self.__set_state('last_refresh', started_at.isoformat())
+            self.__set_state('refresh_finished', datetime.now(timezone.utc).isoformat())
+
+    def __refresh_wc(self, since):
+        filters = {'status': 'any'}
+        if since is not None:
+            filters.update({
+                'modified_after': since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S'),
+                'dates_are_gmt': 'true'
+            })
+        counter = 0
+        for wc_product in WcApi.gen_all_wc('products', filters=filters, fields=WC_PRODUCT_FIELDS):
+            self.put_wc_product(wc_product)
+            counter += 1
+        logging.info("Catalog mirror: {} WC products stored".format(counter))
+        if since is None:
+            return
+        # status=any не включает корзину, перемещённые в неё товары запрашиваются отдельно
+        trashed = [(int(wc_product['id']),) for wc_product in WcApi.gen_all_wc(
+            'products', filters=dict(filters, status='trash'), fields=('id',))]
+        self.__connection.executemany("DELETE FROM wc_products WHERE id = ?", trashed)
+        logging.info("Catalog mirror: {} trashed WC products removed".format(len(trashed)))
+
+    def __refresh_ms(self, since):
+        """при обновлении загружаются и объекты, перемещённые в архив, они отмечаются в зеркале"""
+        counter = 0
+        for ms_type in MS_TYPES.values():
+            filters = None
+            if since is not None:
+                filters = DateTimeFilter.gte('updated', since.astimezone(MS_TIMEZONE).replace(tzinfo=None)) \
+                    + Filter.eq('archived', True) + Filter.eq('archived', False)
+            for ms_object in ms_type.gen_list(filters=filters):
+                self.put_ms_object(ms_object)
+                counter += 1
+        logging.info("Catalog mirror: {} MS objects stored".format(counter))
+
+    def put_wc_product(self, wc_product):
+        """сохраняет товар WC"""
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO wc_products "
+            "(id, name, type, status, regular_price, sale_price, wooms_href, modified, json) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (int(wc_product['id']), wc_product.get('name'), wc_product.get('type'), wc_product.get('status'),
+             wc_product.get('regular_price'), wc_product.get('sale_price'),
+             get_wooms_href(wc_product) if wc_product.get('meta_data') is not None else None,
+             wc_product.get('date_modified_gmt'), json.dumps(wc_product, ensure_ascii=False)))
+
+    def put_ms_object(self, ms_object):
+        """сохраняет объект ассортимента МС"""
+        ms_json = ms_object.get_json()
+        wc_id_raw = None
+        wc_id = None
+        wc_id_attr = ms_object.get_attribute_by_name(WC_ID_ATTR_NAME)
+        if wc_id_attr is not None:
+            wc_id_raw = str(wc_id_attr.get_value())
+            try:
+                wc_id = int(wc_id_raw)
+            except ValueError:
+                pass
+        import_flag = ms_object.get_attribute_by_name(IMPORT_FLAG_ATTR_NAME)
+        sale_prices = {sale_price.get('priceType', {}).get('id'): sale_price.get('value')
+                       for sale_price in ms_json.get('salePrices', [])}
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO ms_assortment "
+            "(href, id, type, name, wc_id_raw, wc_id, import_flag, archived, sale_prices, updated, json) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (ms_object.get_meta().get_href(), ms_json.get('id'), ms_object.get_typename(), ms_json.get('name'),
+             wc_id_raw, wc_id, int(bool(import_flag is not None and import_flag.get_value())),
+             int(bool(ms_json.get('archived'))), json.dumps(sale_prices), ms_json.get('updated'),
+             json.dumps(ms_json, ensure_ascii=False)))
+
+    @property
+    def wc_products(self):
+        """все товары WC (итерируемое представление без загрузки в память)"""
+        return MirrorView(self.__connection, f"SELECT json FROM wc_products WHERE {WC_ACTIVE_SQL} ORDER BY id", (),
+                          json.loads)
+
+    @property
+    def wc_product_records(self):
+        """товары WC в виде компактных записей"""
+        return MirrorView(self.__connection, f"SELECT json FROM wc_products WHERE {WC_ACTIVE_SQL} ORDER BY id", (),
+                          lambda row: WcProductRecord.from_json(json.loads(row)))
+
+    def get_ms_records(self, ms_type: type, price_engine=None, import_only: bool = True):
+        """объекты МС заданного типа в виде компактных записей с ценами, рассчитанными price_engine"""
+        query = f"SELECT json FROM ms_assortment WHERE type = ? AND {MS_ACTIVE_SQL}"
+        if import_only:
+            query += " AND import_flag = 1"
+        return MirrorView(self.__connection, query + " ORDER BY name, href", (ms_type.get_typename(),),
+                          lambda row: MsAssortmentRecord.from_ms_object(ms_type(json.loads(row)), price_engine))
+
+    def get_ms_objects(self, ms_type: type, import_only: bool = True):
+        """объекты МС заданного типа (итерируемое представление без загрузки в память)"""
+        query = f"SELECT json FROM ms_assortment WHERE type = ? AND {MS_ACTIVE_SQL}"
+        if import_only:
+            query += " AND import_flag = 1"
+        return MirrorView(self.__connection, query + " ORDER BY name, href", (ms_type.get_typename(),),
+                          lambda row: ms_type(json.loads(row)))
+
+    def get_wc_product(self, wc_id):
+        row = self.__connection.execute(f"SELECT json FROM wc_products WHERE id = ? AND {WC_ACTIVE_SQL}",
+                                        (int(wc_id),)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_ms_link(self, ms_href):
+        """возвращает (wc_id_raw, wc_id) объекта МС или None"""
+        return self.__connection.execute(
+            "SELECT wc_id_raw, wc_id FROM ms_assortment WHERE href = ?", (ms_href,)).fetchone()
+
+    def gen_ms_by_wc_id(self, wc_id=None, import_only: bool = True):
+        """объекты МС, связанные с товаром WC (или все связанные, если wc_id не задан)"""
+        query = f"SELECT type, json FROM ms_assortment WHERE wc_id IS NOT NULL AND {MS_ACTIVE_SQL}"
+        params = ()
+        if wc_id is not None:
+            query += " AND wc_id = ?"
+            params = (int(wc_id),)
+        if import_only:
+            query += " AND import_flag = 1"
+        for ms_type_name, ms_json in self.__connection.execute(query, params):
+            yield MS_TYPES[ms_type_name](json.loads(ms_json))
+
+    def find_duplicates(self):
+        """wc_id, на которые ссылается больше одного импортируемого объекта МС"""
+        rows = self.__connection.execute(
+            f"SELECT wc_id, type, json FROM ms_assortment WHERE import_flag = 1 AND type IN {LINKED_TYPES_SQL} "
+            f"AND {MS_ACTIVE_SQL} AND wc_id IN ("
+            f"   SELECT wc_id FROM ms_assortment WHERE import_flag = 1 AND type IN {LINKED_TYPES_SQL} "
+            f"   AND {MS_ACTIVE_SQL} AND wc_id IS NOT NULL GROUP BY wc_id HAVING COUNT(*) > 1"
+            f") ORDER BY wc_id")
+        duplicates = {}
+        for wc_id, ms_type_name, ms_json in rows:
+            duplicates.setdefault(wc_id, []).append(MS_TYPES[ms_type_name](json.loads(ms_json)))
+        return duplicates
+
+    def find_unsynced(self):
+        """товары WC, на которые не ссылается ни один импортируемый объект МС"""
+        return [json.loads(row[0]) for row in self.__connection.execute(
+            f"SELECT json FROM wc_products WHERE {WC_ACTIVE_SQL} AND id NOT IN ("
+            f"   SELECT wc_id FROM ms_assortment WHERE import_flag = 1 AND type IN {LINKED_TYPES_SQL} "
+            f"   AND {MS_ACTIVE_SQL} AND wc_id IS NOT NULL"
+            f") ORDER BY id")]
+
+    def find_orphaned(self):
+        """wc_id импортируемых объектов МС, для которых нет товара WC"""
+        return [row[0] for row in self.__connection.execute(
+            f"SELECT DISTINCT wc_id FROM ms_assortment WHERE import_flag = 1 AND type IN {LINKED_TYPES_SQL} "
+            f"AND {MS_ACTIVE_SQL} AND wc_id IS NOT NULL "
+            f"AND wc_id NOT IN (SELECT id FROM wc_products WHERE {WC_ACTIVE_SQL}) "
+            f"ORDER BY wc_id")]
+
+    def find_unlinked(self):
+        """импортируемые объекты МС без wc_id"""
+        return [MS_TYPES[ms_type_name](json.loads(ms_json)) for ms_type_name, ms_json in self.__connection.execute(
+            f"SELECT type, json FROM ms_assortment WHERE import_flag = 1 AND {MS_ACTIVE_SQL} AND wc_id_raw IS NULL "
+            f"AND type IN {LINKED_TYPES_SQL} ORDER BY name, href")]
+
+    def __get_state_datetime(self, key):
+        value = self.__get_state(key)
+        return None if value is None else datetime.fromisoformat(value)
+
+    def __get_state(self, key):
+        row = self.__connection.execute("SELECT value FROM mirror_state WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def __set_state(self, key, value):
+        self.__connection.execute("INSERT OR REPLACE INTO mirror_state (key, value) VALUES (?, ?)", (key, value))
+
+
+class MirrorView:
+    """итерируемый результат запроса к зеркалу"""
+
+    def __init__(self, connection, query, params, converter):
+        self.__connection = connection
+        self.__query = query
+        self.__params = params
+        self.__converter = converter
+
+    def __iter__(self):
+        for row in self.__connection.execute(self.__query, self.__params):
+            yield self.__converter(row[0])
+
+    def __len__(self):
+        return self.__connection.execute(f"SELECT COUNT(*) FROM ({self.__query})", self.__params).fetchone()[0]
+
+
+class MirrorIndex:
+    """индекс сопоставления поверх зеркала каталогов, повторяет интерфейс ReconciliationIndex"""
+
+    def __init__(self, mirror: CatalogMirror):
+        self.__mirror = mirror
+
+    @property
+    def duplicates(self):
+        return {wc_id: [MsAssortmentRecord.from_ms_object(ms_object) for ms_object in ms_object_list]
+                for wc_id, ms_object_list in self.__mirror.find_duplicates().items()}
+
+    @property
+    def unsynced(self):
+        return [WcProductRecord.from_json(wc_product) for wc_product in self.__mirror.find_unsynced()]
+
+    @property
+    def orphaned(self):
+        return self.__mirror.find_orphaned()
+
+    @property
+    def unlinked(self):
+        return [MsAssortmentRecord.from_ms_object(ms_object) for ms_object in self.__mirror.find_unlinked()]
+
+    def is_linked(self, ms_record: MsAssortmentRecord) -> bool:
+        link = self.__mirror.get_ms_link(ms_record.href)
+        return link is not None and link[0] is not None
+
+    def get_wc_id(self, ms_record: MsAssortmentRecord):
+        link = self.__mirror.get_ms_link(ms_record.href)
+        return None if link is None else link[1]
+
+    def get_wc_product(self, wc_id):
+        wc_product = self.__mirror.get_wc_product(wc_id)
+        return None if wc_product is None else WcProductRecord.from_json(wc_product)
@@ -0,0 +1,79 @@
+from MSApi import MSApiException, Product
+
+from exceptions import SyncroException
+from settings import WC_ID_ATTR_NAME
+
+
+def parse_wc_price(price):
+    """цена WC из строки, пустая строка - цены нет"""
+    if price is None or price == '':
+        return None
+    return float(price)
+
+
+class WcProductRecord:
+    """товар WC: только поля, по которым сопоставляются каталоги"""
+
+    __slots__ = ('id', 'name', 'type', 'regular_price', 'sale_price')
+
+    # поля, запрашиваемые у WC для построения записи
+    FIELDS = ('id', 'name', 'type', 'regular_price', 'sale_price')
+
+    def __init__(self, wc_id: int, name, wc_type, regular_price, sale_price):
+        self.id = wc_id
+        self.name = name
+        self.type = wc_type
+        self.regular_price = regular_price
+        self.sale_price = sale_price
+
+    @classmethod
+    def from_json(cls, wc_json):
+        return cls(int(wc_json['id']), wc_json.get('name'), wc_json.get('type'),
+                   parse_wc_price(wc_json.get('regular_price')), parse_wc_price(wc_json.get('sale_price')))
+
+
+class MsAssortmentRecord:
+    """товар или комплект МС: ссылка, имя, значение wc_id и цены для сайта.
+    Цены рассчитываются при создании записи, сам объект МС не хранится"""
+
+    __slots__ = ('href', 'id', 'type', 'name', 'wc_id', 'has_variants', 'regular_price', 'sale_price', 'price_error')
+
+    def __init__(self, href, ms_id, ms_type, name, wc_id=None, has_variants=False):
+        self.href = href
+        self.id = ms_id
+        self.type = ms_type
+        self.name = name
+        self.wc_id = wc_id  # значение атрибута как есть, None - атрибут не заполнен
+        self.has_variants = has_variants
+        self.regular_price = None
+        self.sale_price = None
+        self.price_error = None
+
+    @classmethod
+    def from_ms_object(cls, ms_object, price_engine=None):
+        """price_engine - расчёт цен для группы покупателей (PriceEngine), если None - цены не рассчитываются"""
+        wc_id_attr = ms_object.get_attribute_by_name(WC_ID_ATTR_NAME)
+        record = cls(ms_object.get_meta().get_href(), ms_object.get_id(), ms_object.get_typename(),
+                     ms_object.get_name(), None if wc_id_attr is None else wc_id_attr.get_value(),
+                     isinstance(ms_object, Product) and ms_object.has_variants())
+        if price_engine is not None:
+            try:
+                record.regular_price, record.sale_price = price_engine.get_prices(ms_object)
+            except MSApiException as e:
+                record.price_error = str(e)
+        return record
+
+    def get_meta_json(self):
+        return {
+            'href': self.href,
+            'type': self.type,
+            'mediaType': 'application/json'
+        }
+
+    def get_prices(self):
+        """обычная цена и цена со скидкой"""
+        if self.price_error is not None:
+            raise SyncroException("\'{}\' prices: {}".format(self.name, self.price_error))
+        if self.regular_price is None:
+            raise SyncroException("\'{}\' prices are not loaded".format(self.name))
+        return self.regular_price, self.sale_price
@@ -0,0 +1,72 @@
+import phonenumbers
+
+from MSApi import Counterparty
+
+
+def format_phone(phone_str):
+    """приводит номер телефона к формату E.164, бросает NumberParseException"""
+    number = phonenumbers.parse(phone_str, "RU")
+    return phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164)
+
+
+class CounterpartyIndex:
+    """индекс контрагентов МС по номеру телефона (E.164) и электронному адресу (в нижнем регистре)"""
+
+    def __init__(self):
+        self.__by_phone = {}  # {str: [Counterparty]}
+        self.__by_email = {}  # {str: [Counterparty]}
+        self.__is_loaded = False
+
+    def is_loaded(self) -> bool:
+        return self.__is_loaded
+
+    def clear(self):
+        self.__by_phone.clear()
+        self.__by_email.clear()
+        self.__is_loaded = False
+
+    def set_loaded(self):
+        """отмечает индекс как полный"""
+        self.__is_loaded = True
+
+    def load(self):
+        """загружает всех контрагентов МС"""
+        self.clear()
+        for ms_cp in Counterparty.gen_list():
+            self.add(ms_cp)
+        self.set_loaded()
+
+    def add(self, ms_cp: Counterparty, phone: str = None):
+        """добавляет контрагента в индекс. phone - уже отформатированный номер"""
+        if phone is None:
+            phone = ms_cp.get_phone()
+            if phone:
+                try:
+                    phone = format_phone(phone)
+                except phonenumbers.phonenumberutil.NumberParseException:
+                    pass
+        if phone:
+            self.__append(self.__by_phone, phone, ms_cp)
+        email = ms_cp.get_email()
+        if email:
+            self.__append(self.__by_email, email.lower(), ms_cp)
+
+    def find_by_phone(self, phone: str) -> [Counterparty]:
+        """ищет контрагентов по номеру телефона в формате E.164"""
+        self.__check_loaded()
+        return list(self.__by_phone.get(phone, []))
+
+    def find_by_email(self, email: str) -> [Counterparty]:
+        """ищет контрагентов по электронному адресу"""
+        self.__check_loaded()
+        return list(self.__by_email.get(email.lower(), []))
+
+    def __check_loaded(self):
+        if not self.__is_loaded:
+            self.load()
+
+    @staticmethod
+    def __append(index, key, ms_cp):
+        ms_cp_list = index.setdefault(key, [])
+        if ms_cp not in ms_cp_list:
+            ms_cp_list.append(ms_cp)
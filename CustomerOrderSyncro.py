@@ -1,23 +1,59 @@
-from WcApi import WcApi
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from WcApi import WcApi, WcBatchWriter
 
 import phonenumbers
 import logging
 
-from MSApi import Counterparty, MSApi, error_handler, MSApiException, MSApiHttpException, Filter, Organization, Service
-from MSApi import Bundle, AttributeMixin, Employee, Task
-from MSApi import State, Project, Product, Order, Store
+from MSApi import Counterparty, MSApi, error_handler, MSApiException, MSApiHttpException, Organization, Service
+from MSApi import AttributeMixin
+from MSApi import State, Project, Product, Store
 from MSApi.documents.CustomerOrder import CustomerOrder
 
+from CatalogMirror import CatalogMirror
+from CounterpartyIndex import format_phone
+from OrderNumberAllocator import format_order_name
+from RunContext import RunContext
+from StageScheduler import submit_in_context
+from TaskRegistry import TaskRegistry
 from exceptions import WcApiException
 from settings import *
 
 
 class CustomerOrderSyncro:
 
-    def __init__(self, customer_tag):
+    REFERENCE_LOAD_WORKERS = 4
+    # заказы WC, синхронизируемые одновременно
+    ORDER_WORKERS = 4
+    # поля заказов WC, которые читает синхронизация
+    WC_ORDER_FIELDS = ('id', 'status', 'payment_method', 'customer_note', 'billing', 'meta_data', 'line_items',
+                       'shipping_lines')
+
+    def __init__(self, customer_tag, task_registry: TaskRegistry = None, mirror: CatalogMirror = None,
+                 run_context: RunContext = None):
+        """run_context - общие данные запуска (атрибуты, ассортимент, контрагенты, реестр задач)"""
         self.customer_tag = customer_tag
-        self.organization: Organization = list(Organization.gen_list())[0]  # TODO choose organization
-        for store in Store.gen_list():
+        if run_context is None:
+            run_context = RunContext(mirror, customer_tag)
+
+        # справочники не зависят друг от друга и загружаются параллельно
+        with ThreadPoolExecutor(max_workers=self.REFERENCE_LOAD_WORKERS) as executor:
+            organizations_future = submit_in_context(executor, lambda: list(Organization.gen_list()))
+            stores_future = submit_in_context(executor, lambda: list(Store.gen_list()))
+            states_future = submit_in_context(executor, lambda: list(CustomerOrder.gen_states_list()))
+            projects_future = submit_in_context(executor, lambda: list(Project.gen_list()))
+            service_futures = {service_id: submit_in_context(executor, Service.request_by_id, service_id)
+                               for service_id in set(DELIVERY_DICT.values())}
+            product_attributes_future = submit_in_context(executor, run_context.get_product_attributes)
+            order_attributes_future = submit_in_context(executor,
+                                                        lambda: list(CustomerOrder.gen_attributes_list()))
+            task_registry_future = None
+            if task_registry is None:
+                task_registry_future = submit_in_context(executor, run_context.get_task_registry)
+
+        self.organization: Organization = organizations_future.result()[0]  # TODO choose organization
+        for store in stores_future.result():
             if store.get_name() == STORE_NAME:
                 self.store: Store = store
                 break
@@ -25,7 +61,7 @@ class CustomerOrderSyncro:
             raise RuntimeError("Store \'{}\' not found".format(STORE_NAME))
 
         self.states_dict = {}
-        for state in CustomerOrder.gen_states_list():
+        for state in states_future.result():
             state: State
             payment_method = STATES_DICT.get(state.get_name())
             if payment_method is None:
@@ -36,7 +72,7 @@ class CustomerOrderSyncro:
             raise RuntimeError("States \'{}\' not found".format(STATES_DICT.keys()))
 
         self.projects_dict = {}
-        for project in Project.gen_list():
+        for project in projects_future.result():
             project: Project
             pickup_store_name = PROJECTS_DICT.get(project.get_name())
             if pickup_store_name is None:
@@ -48,150 +84,224 @@ class CustomerOrderSyncro:
 
         self.delivery_dict = {}
         for zone_name, service_id in DELIVERY_DICT.items():
-            service = Service.request_by_id(service_id)
-            self.delivery_dict[zone_name] = service
-
-        self.product_wc_id_href = self.__get_attribute_by_name(Product, WC_ID_ATTR_NAME).get_meta().get_href()
-        self.product_import_flag_href = self.__get_attribute_by_name(Product,
-                                                                     IMPORT_FLAG_ATTR_NAME).get_meta().get_href()
-        self.wc_id_attribute = self.__get_attribute_by_name(CustomerOrder, WC_ID_ATTR_NAME)
-
-        self.employee_for_tasks = Employee.request_by_id(EMPLOYEE_ID)
-
-        for order in CustomerOrder.gen_list(limit=1, orders=Order.desc('created')):
-            self.last_order_num = order.get_name()
-        self.last_order_num = int(self.last_order_num)
+            self.delivery_dict[zone_name] = service_futures[service_id].result()
+
+        product_attributes = product_attributes_future.result()
+        self.product_wc_id_href = self.__get_attribute_by_name(
+            product_attributes, Product, WC_ID_ATTR_NAME).get_meta().get_href()
+        self.product_import_flag_href = self.__get_attribute_by_name(
+            product_attributes, Product, IMPORT_FLAG_ATTR_NAME).get_meta().get_href()
+        self.wc_id_attribute = self.__get_attribute_by_name(order_attributes_future.result(), CustomerOrder,
+                                                            WC_ID_ATTR_NAME)
+        # индекс ассортимента берётся из run_context при каждом обращении, он может быть сброшен между проходами
+        self.__run_context = run_context
+        self.__counterparty_index = run_context.get_counterparty_index()
+        self.__order_numbers = run_context.get_order_number_allocator()
+        # поиск и создание контрагента по заказу выполняются по одному, чтобы не создавать дубликаты
+        self.__counterparty_lock = threading.Lock()
+        self.__product_syncro_required = False
+
+        if task_registry is None:
+            task_registry = task_registry_future.result()
+        self.__task_registry = task_registry
 
     @staticmethod
-    def __get_attribute_by_name(obj: type(AttributeMixin), name: str):
-        for attr in obj.gen_attributes_list():
+    def __get_attribute_by_name(attributes, obj: type(AttributeMixin), name: str):
+        for attr in attributes:
             if attr.get_name() == name:
                 return attr
         raise RuntimeError("{} attribute \'{}\' not found".format(obj.__name__, name))
 
-    @staticmethod
-    def __get_bundle_by_wc_id(wc_product_id):
-        bundles = []
-        for ms_bundle in Bundle.gen_list(cached=True):
-            import_flag = ms_bundle.get_attribute_by_name(IMPORT_FLAG_ATTR_NAME)
-            if import_flag is None:
-                continue
-            if not import_flag.get_value():
-                continue
-            wc_id = ms_bundle.get_attribute_by_name(WC_ID_ATTR_NAME)
-            if wc_id is None:
-                continue
-            if str(wc_product_id) == wc_id.get_value():
-                bundles.append(ms_bundle)
-        return bundles
-
-    def sync_orders(self):
-        start_product_syncro = False
-        for wc_order in WcApi.gen_all_wc(entity='orders', filters={'status': 'processing'}, cached=True):
-            wc_order_id = wc_order['id']
+    ORDER_BATCH_LIMIT = 100
+
+    def sync_orders(self, batch: bool = False):
+        """синхронизирует все заказы WC в статусе 'processing'"""
+        return self.sync_order_list(WcApi.gen_all_wc(entity='orders', filters={'status': 'processing'},
+                                                     fields=self.WC_ORDER_FIELDS), batch)
+
+    def sync_order_list(self, wc_orders, batch: bool = False):
+        """синхронизирует заказы WC, возвращает необходимость синхронизации ассортимента.
+        Заказы обрабатываются параллельно пулом из ORDER_WORKERS потоков. В пакетном режиме
+        заказы сначала разбираются, затем создаются в МС и закрываются в WC пакетами"""
+        self.__product_syncro_required = False
+        try:
+            if batch:
+                self.__sync_order_batch(list(wc_orders))
+            else:
+                with ThreadPoolExecutor(max_workers=self.ORDER_WORKERS) as executor:
+                    futures = [submit_in_context(executor, self.__sync_order, wc_order) for wc_order in wc_orders]
+                    for future in futures:
+                        future.result()
+        finally:
+            self.__order_numbers.release_unused()
+        self.__task_registry.flush()
+        return self.__product_syncro_required
+
+    def sync_order(self, wc_order):
+        """создаёт заказ МС по заказу WC, возвращает необходимость синхронизации ассортимента"""
+        self.__product_syncro_required = False
+        self.__sync_order(wc_order)
+        return self.__product_syncro_required
+
+    def __sync_order(self, wc_order):
+        """создаёт заказ МС по заказу WC. Может выполняться одновременно для разных заказов"""
+        wc_order_id = wc_order['id']
+        try:
+            logging.info("WC Order [{}]:\tStarting syncro...".format(wc_order_id))
+            ms_post_order_data = self.__get_order_post_data(wc_order)
+            order_num, = self.__order_numbers.allocate()
+            ms_post_order_data['name'] = format_order_name(order_num)
+
             try:
-                logging.info("WC Order [{}]:\tStarting syncro...".format(wc_order_id))
-                ms_cp = self.__find_customer_order_by_phone(wc_order)
-                if ms_cp is None:
-                    self.__find_customer_order_by_email(wc_order)
-                if ms_cp is None:
-                    logging.debug("WC Order [{}]:\tCounterparty not found".format(wc_order_id))
-                    ms_cp = self.__create_new_counterparty(wc_order)
-                if ms_cp is None:
-                    raise RuntimeError("Counterparty not found")
-                wc_payment_method = wc_order['payment_method']
-                state = self.states_dict.get(wc_payment_method)
-                if state is None:
-                    raise RuntimeError("State for \'{}\' payment method not found".format(wc_payment_method))
-
-                ms_post_order_data = {
-                    'description': wc_order.get('customer_note'),
-                    'externalCode': str(wc_order.get('id')),
-                    'name': str(self.last_order_num + 1).zfill(5),
-                    'organization': {'meta': self.organization.get_meta().get_json()},
-                    'store': {'meta': self.store.get_meta().get_json()},
-                    'state': {'meta': state.get_meta().get_json()},
-                    'agent': {'meta': ms_cp.get_meta().get_json()},
-                    'attributes': [
-                        {
-                            'meta': self.wc_id_attribute.get_meta().get_json(),
-                            'value': str(wc_order_id)
-                        }
-                    ]
-                }
+                response = MSApi.auch_post("entity/customerorder", json=ms_post_order_data)
+                error_handler(response)
+            except MSApiException:
+                # заказ не создан, номер будет выдан другому заказу
+                self.__order_numbers.release([order_num])
+                raise
+            ms_order = CustomerOrder(response.json())
+            logging.info('WC Order [{}]: CustomerOrder {} created'.format(wc_order_id, ms_order.get_name()))
 
-                project = None
-                for meta_data in wc_order['meta_data']:
-                    if meta_data['key'] == '_shipping_pickup_stores':
-                        project = self.projects_dict.get(meta_data['value'])
-                if project is not None:
-                    ms_post_order_data['project'] = {'meta': project.get_meta().get_json()}
-
-                positions_post_data_list = []
-                for wc_product in wc_order['line_items']:
-                    wc_product_id = wc_product['product_id']
-
-                    filters = Filter.eq(self.product_wc_id_href, wc_product_id)
-                    filters += Filter.eq(self.product_import_flag_href, True)
-                    ms_product_list = list(Product.gen_list(filters=filters))
-                    ms_product_list += self.__get_bundle_by_wc_id(wc_product_id)
-                    if len(ms_product_list) == 0:
-                        start_product_syncro = True
-                        raise RuntimeError("Product [{}] not found in MoySklad."
-                                           .format(wc_product_id))
-                    elif len(ms_product_list) != 1:
-                        warn_str = "Product [{}] multiply definition in MoySklad".format(wc_product_id)
-                        self.__create_uniq_task(warn_str)
-                        raise RuntimeError(warn_str)
-                    ms_product = ms_product_list[0]
-                    ms_post_position = {
-                        'assortment': {'meta': ms_product.get_meta().get_json()},
-                        'quantity': wc_product['quantity'],
-                        'price': wc_product['price'] * 100
-                    }
-                    positions_post_data_list.append(ms_post_position)
-
-                for wc_shipping_line in wc_order['shipping_lines']:
-                    service = self.delivery_dict.get(wc_shipping_line['method_title'])
-                    if service is None:
-                        continue
-                    positions_post_data_list.append({
-                        'assortment': {'meta': service.get_meta().get_json()},
-                        'quantity': 1,
-                        'price': int(wc_shipping_line['total']) * 100
-                    })
-                ms_post_order_data['positions'] = positions_post_data_list
+            try:
+                wc_put_data = {
+                    'status': 'completed'
+                }
+                WcApi.put('orders/{}'.format(wc_order['id']), data=wc_put_data)
+            except WcApiException as e:
+                logging.error('WC Order status change failed: {}'.format(str(e)))
+        except RuntimeError as e:
+            logging.error("WC Order [{}]: Synchronize failed: {}".format(wc_order_id, str(e)))
+        except MSApiException as e:
+            logging.error("WC Order [{}]: MoySklad error: {}".format(wc_order_id, str(e)))
 
-                try:
-                    response = MSApi.auch_post("entity/customerorder", json=ms_post_order_data)
-                    error_handler(response)
-                    ms_order = CustomerOrder(response.json())
-                    logging.info('WC Order [{}]: CustomerOrder {} created'.format(wc_order_id, ms_order.get_name()))
-                    self.last_order_num += 1
-                    wc_put_data = {
-                        'status': 'completed'
-                    }
-                    WcApi.put('orders/{}'.format(wc_order['id']), data=wc_put_data)
-                except WcApiException as e:
-                    logging.error('WC Order status change failed: {}'.format(str(e)))
+    def __sync_order_batch(self, wc_orders):
+        """пакетная синхронизация: разбор всех заказов, создание в МС массивами,
+        смена статуса в WC через orders/batch. Ошибка одного заказа не останавливает пакет"""
+        resolved = []  # [(wc_order, ms_post_order_data)]
+        for wc_order in wc_orders:
+            try:
+                logging.info("WC Order [{}]:\tStarting syncro...".format(wc_order['id']))
+                resolved.append((wc_order, self.__get_order_post_data(wc_order)))
             except RuntimeError as e:
-                logging.error("WC Order [{}]: Synchronize failed: {}".format(wc_order_id, str(e)))
+                logging.error("WC Order [{}]: Synchronize failed: {}".format(wc_order['id'], str(e)))
+            except MSApiException as e:
+                logging.error("WC Order [{}]: MoySklad error: {}".format(wc_order['id'], str(e)))
+
+        wc_writer = WcBatchWriter('orders')
+        for i in range(0, len(resolved), self.ORDER_BATCH_LIMIT):
+            chunk = resolved[i:i + self.ORDER_BATCH_LIMIT]
+            order_nums = self.__order_numbers.allocate(len(chunk))
+            for order_num, (wc_order, ms_post_order_data) in zip(order_nums, chunk):
+                ms_post_order_data['name'] = format_order_name(order_num)
+            try:
+                response = MSApi.auch_post("entity/customerorder", json=[data for _, data in chunk])
+                error_handler(response)
             except MSApiException as e:
-                logging.error("WC Order [{}]: MoySklad error: {}".format(wc_order_id, str(e)))
-        return start_product_syncro
+                self.__order_numbers.release(order_nums)
+                for wc_order, _ in chunk:
+                    logging.error("WC Order [{}]: MoySklad error: {}".format(wc_order['id'], str(e)))
+                continue
+
+            for order_num, (wc_order, ms_post_order_data), ms_order_json in zip(order_nums, chunk, response.json()):
+                if 'errors' in ms_order_json:
+                    logging.error("WC Order [{}]: MoySklad error: {}".format(wc_order['id'], ms_order_json['errors']))
+                    self.__order_numbers.release([order_num])
+                    continue
+                ms_order = CustomerOrder(ms_order_json)
+                logging.info('WC Order [{}]: CustomerOrder {} created'.format(wc_order['id'], ms_order.get_name()))
+                wc_writer.update(wc_order['id'], {'status': 'completed'}, source=wc_order)
+
+        for wc_order, wc_json, error in wc_writer.flush():
+            if error is not None:
+                logging.error('WC Order [{}]: status change failed: {}'.format(wc_order['id'], error))
+
+    def __get_order_post_data(self, wc_order):
+        """собирает данные нового заказа МС (без номера) по заказу WC"""
+        wc_order_id = wc_order['id']
+        with self.__counterparty_lock:
+            ms_cp = self.__find_customer_order_by_phone(wc_order)
+            if ms_cp is None:
+                ms_cp = self.__find_customer_order_by_email(wc_order)
+            if ms_cp is None:
+                logging.debug("WC Order [{}]:\tCounterparty not found".format(wc_order_id))
+                ms_cp = self.__create_new_counterparty(wc_order)
+        if ms_cp is None:
+            raise RuntimeError("Counterparty not found")
+        wc_payment_method = wc_order['payment_method']
+        state = self.states_dict.get(wc_payment_method)
+        if state is None:
+            raise RuntimeError("State for \'{}\' payment method not found".format(wc_payment_method))
+
+        ms_post_order_data = {
+            'description': wc_order.get('customer_note'),
+            'externalCode': str(wc_order.get('id')),
+            'organization': {'meta': self.organization.get_meta().get_json()},
+            'store': {'meta': self.store.get_meta().get_json()},
+            'state': {'meta': state.get_meta().get_json()},
+            'agent': {'meta': ms_cp.get_meta().get_json()},
+            'attributes': [
+                {
+                    'meta': self.wc_id_attribute.get_meta().get_json(),
+                    'value': str(wc_order_id)
+                }
+            ]
+        }
+
+        project = None
+        for meta_data in wc_order['meta_data']:
+            if meta_data['key'] == '_shipping_pickup_stores':
+                project = self.projects_dict.get(meta_data['value'])
+        if project is not None:
+            ms_post_order_data['project'] = {'meta': project.get_meta().get_json()}
+
+        positions_post_data_list = []
+        for wc_product in wc_order['line_items']:
+            wc_product_id = wc_product['product_id']
+
+            ms_product_list = self.__run_context.get_assortment_index().get(wc_product_id)
+            if len(ms_product_list) == 0:
+                self.__product_syncro_required = True
+                raise RuntimeError("Product [{}] not found in MoySklad."
+                                   .format(wc_product_id))
+            elif len(ms_product_list) != 1:
+                warn_str = "Product [{}] multiply definition in MoySklad".format(wc_product_id)
+                self.__task_registry.add_task(warn_str)
+                raise RuntimeError(warn_str)
+            ms_product = ms_product_list[0]
+            ms_post_position = {
+                'assortment': {'meta': ms_product.get_meta_json()},
+                'quantity': wc_product['quantity'],
+                'price': wc_product['price'] * 100
+            }
+            positions_post_data_list.append(ms_post_position)
+
+        for wc_shipping_line in wc_order['shipping_lines']:
+            service = self.delivery_dict.get(wc_shipping_line['method_title'])
+            if service is None:
+                continue
+            positions_post_data_list.append({
+                'assortment': {'meta': service.get_meta().get_json()},
+                'quantity': 1,
+                'price': int(wc_shipping_line['total']) * 100
+            })
+        ms_post_order_data['positions'] = positions_post_data_list
+        return ms_post_order_data
 
     def check_and_correct_ms_phone_numbers(self):
-        """проверяет формат телефонных номеров контрагентов и исправляет при необходимости"""
+        """проверяет формат телефонных номеров контрагентов и исправляет при необходимости.
+        Заодно заполняет индекс контрагентов"""
+        self.__counterparty_index.clear()
         try:
             for ms_cp in Counterparty.gen_list():
                 ms_cp: Counterparty
                 ms_cp_phone = ms_cp.get_phone()
                 if ms_cp_phone is None:
+                    self.__counterparty_index.add(ms_cp)
                     continue
 
                 try:
-                    ms_number = phonenumbers.parse(ms_cp_phone, "RU")
-                    ms_formatted_number = phonenumbers.format_number(ms_number, phonenumbers.PhoneNumberFormat.E164)
+                    ms_formatted_number = format_phone(ms_cp_phone)
+                    self.__counterparty_index.add(ms_cp, ms_formatted_number)
                     if ms_formatted_number == ms_cp_phone:
                         continue
 
@@ -205,38 +315,28 @@ class CustomerOrderSyncro:
                         ms_formatted_number
                     ))
                 except phonenumbers.phonenumberutil.NumberParseException:
+                    self.__counterparty_index.add(ms_cp, ms_cp_phone)
                     warn_str = f"Counterparty \"{ms_cp.get_name()}\": Invalid phone: {ms_cp_phone}"
                     logging.warning(f"Counterparty \"{ms_cp.get_name()}\": Invalid phone: {ms_cp_phone}")
-                    self.__create_uniq_task(warn_str)
+                    self.__task_registry.add_task(warn_str)
 
                 except MSApiHttpException as e:
                     logging.error(str(e))
+            self.__counterparty_index.set_loaded()
         except MSApiException as e:
             logging.error(str(e))
+        self.__task_registry.flush()
 
-    def __create_uniq_task(self, desc):
-        for task in Task.gen_list():
-            if task.get_description() == desc:
-                break
-        else:
-            task = Task({
-                'description': str(desc),
-                'assignee': {'meta': self.employee_for_tasks.get_meta().get_json()}
-            })
-            task.create_new()
-
-    @staticmethod
-    def __find_customer_order_by_phone(wc_order):
+    def __find_customer_order_by_phone(self, wc_order):
         """ищет контрагента по номеру телефона"""
         wc_phone_str = wc_order.get('billing').get('phone')
         if wc_phone_str == '':
             logging.debug("WC Order [{}]:\tPhone is empty".format(wc_order.get('id')))
             return None
         try:
-            wc_number = phonenumbers.parse(wc_phone_str, "RU")
-            formatted_number = phonenumbers.format_number(wc_number, phonenumbers.PhoneNumberFormat.E164)
+            formatted_number = format_phone(wc_phone_str)
 
-            ms_cp_list = list(Counterparty.gen_list(filters=Filter.eq('phone', formatted_number)))
+            ms_cp_list = self.__counterparty_index.find_by_phone(formatted_number)
             if not ms_cp_list:
                 logging.debug("WC Order [{}]:\tCounterparty not found by phone".format(wc_order.get('id')))
                 return None
@@ -251,15 +351,14 @@ class CustomerOrderSyncro:
             logging.warning("WC Order [{}]:\tInvalid phone \'{}\'".format(wc_order.get('id'), wc_phone_str))
             return None
 
-    @staticmethod
-    def __find_customer_order_by_email(wc_order):
+    def __find_customer_order_by_email(self, wc_order):
         """ищет контрагента по эллектронному адресу"""
         wc_email_str = wc_order.get('billing').get('email')
         if wc_email_str == '':
             logging.debug("WC Order [{}]:\tEmail is empty".format(wc_order.get('id')))
             return None
 
-        ms_cp_list = list(Counterparty.gen_list(filters=Filter.eq('email', wc_email_str)))
+        ms_cp_list = self.__counterparty_index.find_by_email(wc_email_str)
         if not ms_cp_list:
             logging.debug("WC Order [{}]:\tCounterparty not found by email".format(wc_order.get('id')))
             return None
@@ -291,7 +390,9 @@ class CustomerOrderSyncro:
         response = MSApi.auch_post('entity/counterparty', json=ms_post_data)
         error_handler(response)
         logging.info("New counterparty \'{}\' created".format(cp_name))
-        return Counterparty(response.json())
+        ms_cp = Counterparty(response.json())
+        self.__counterparty_index.add(ms_cp)
+        return ms_cp
 
     @staticmethod
     def __get_name_by_order(wc_order, phone):
@@ -307,8 +408,7 @@ class CustomerOrderSyncro:
             logging.warning("WC Order [{}]:\tPhone is empty".format(wc_order.get('id')))
             return None
         try:
-            wc_number = phonenumbers.parse(wc_phone_str, "RU")
-            return phonenumbers.format_number(wc_number, phonenumbers.PhoneNumberFormat.E164)
+            return format_phone(wc_phone_str)
         except phonenumbers.phonenumberutil.NumberParseException:
             logging.warning("WC Order [{}]:\tInvalid phone \'{}\'".format(wc_order.get('id'), wc_phone_str))
         return None
@@ -0,0 +1,53 @@
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """исключительная блокировка файла между процессами, None - без блокировки.
+    Если blocking=False и файл уже заблокирован, бросает BlockingIOError"""
+
+    def __init__(self, path, blocking=True):
+        self.__path = path
+        self.__blocking = blocking
+        self.__file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def acquire(self):
+        if self.__path is None:
+            return
+        self.__file = open(self.__path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.__file, fcntl.LOCK_EX if self.__blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.__file.seek(0)
+                try:
+                    msvcrt.locking(self.__file.fileno(), msvcrt.LK_LOCK if self.__blocking else msvcrt.LK_NBLCK, 1)
+                except OSError as e:
+                    raise BlockingIOError(str(e))
+        except OSError:
+            self.__file.close()
+            self.__file = None
+            raise
+
+    def release(self):
+        if self.__file is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.__file, fcntl.LOCK_UN)
+            else:
+                self.__file.seek(0)
+                msvcrt.locking(self.__file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.__file.close()
+            self.__file = None
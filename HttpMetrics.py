@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from urllib.parse import urlsplit
+
+from MSApi.MSLowApi import MSLowApi
+
+from RetryPolicy import RetryPolicy
+
+# границы корзин гистограммы задержек, секунды
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+ID_PATTERN = re.compile(r'^(\d+|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$', re.IGNORECASE)
+
+
+def normalize_endpoint(url: str) -> str:
+    """приводит адрес запроса к виду шаблона: без хоста, версии API и параметров,
+    идентификаторы заменены на {id}. Например 'products/{id}/variations'"""
+    path = urlsplit(url).path if '://' in url else url.split('?', 1)[0]
+    for prefix in ('/api/remap/1.2/', '/wp-json/wc/v3/'):
+        if prefix in path:
+            path = path.split(prefix, 1)[1]
+    segments = [segment for segment in path.split('/') if segment]
+    return '/'.join('{id}' if ID_PATTERN.match(segment) else segment for segment in segments)
+
+
+class EndpointStats:
+    """накопленная статистика запросов одной группы (сервис, стадия, метод, эндпоинт)"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.bytes = 0
+        self.statuses = {}  # {str: int}
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, status, elapsed, size):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.bytes += size
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+
+    def get_errors(self):
+        return sum(count for status, count in self.statuses.items() if not status.startswith('2'))
+
+    def get_quantile(self, q):
+        """оценка квантиля задержки по гистограмме (верхняя граница корзины)"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        accumulated = 0
+        for bound, bucket in zip(LATENCY_BUCKETS, self.buckets):
+            accumulated += bucket
+            if accumulated >= rank:
+                return min(bound, self.max_time)
+        return self.max_time
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'errors': self.get_errors(),
+            'total_seconds': round(self.total_time, 6),
+            'max_seconds': round(self.max_time, 6),
+            'bytes': self.bytes,
+            'statuses': dict(self.statuses),
+            'buckets': {str(bound): bucket for bound, bucket in zip(LATENCY_BUCKETS, self.buckets)},
+        }
+
+
+class HttpMetrics:
+    """сбор статистики HTTP запросов к WC и МС по эндпоинтам и стадиям синхронизации"""
+
+    # МойСклад допускает не больше 5 параллельных запросов с одного токена
+    MS_MAX_PARALLEL = 5
+    ms_retry_policy = RetryPolicy()
+
+    __stats = {}  # {(service, stage, method, endpoint): EndpointStats}
+    __lock = threading.Lock()
+    __stage = ContextVar('http_metrics_stage', default='main')
+    __msapi_instrumented = False
+    __ms_semaphore = threading.BoundedSemaphore(MS_MAX_PARALLEL)
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name):
+        """задаёт стадию для запросов внутри блока (наследуется потоками asyncio.to_thread)"""
+        token = cls.__stage.set(name)
+        try:
+            yield
+        finally:
+            cls.__stage.reset(token)
+
+    @classmethod
+    def get_stage(cls):
+        return cls.__stage.get()
+
+    @classmethod
+    def record(cls, service, method, url, response, elapsed):
+        """учитывает запрос. response равен None, если запрос не выполнен"""
+        if response is None:
+            status, size = 'exception', 0
+        else:
+            status, size = str(response.status_code), len(response.content or b'')
+        key = (service, cls.__stage.get(), method, normalize_endpoint(url))
+        with cls.__lock:
+            stats = cls.__stats.get(key)
+            if stats is None:
+                stats = cls.__stats[key] = EndpointStats()
+            stats.add(status, elapsed, size)
+
+    @classmethod
+    def measure(cls, service, method, url, send):
+        """выполняет send() и учитывает запрос"""
+        started = time.perf_counter()
+        response = None
+        try:
+            response = send()
+            return response
+        finally:
+            cls.record(service, method, url, response, time.perf_counter() - started)
+
+    @classmethod
+    def instrument_msapi(cls, max_parallel: int = MS_MAX_PARALLEL):
+        """оборачивает низкоуровневые запросы MSApi (auch_post, auch_put, _auch_get_by_href).
+        auch_get проходит через _auch_get_by_href и учитывается один раз.
+        Все потоки процесса вместе выполняют не больше max_parallel (не больше MS_MAX_PARALLEL)
+        запросов к МС одновременно, ответ 429 повторяется по ms_retry_policy"""
+        cls.__ms_semaphore = threading.BoundedSemaphore(max(min(max_parallel, cls.MS_MAX_PARALLEL), 1))
+        if cls.__msapi_instrumented:
+            return
+        cls.__msapi_instrumented = True
+        for method, name in (('POST', 'auch_post'), ('PUT', 'auch_put'), ('GET', '_auch_get_by_href')):
+            setattr(MSLowApi, name, classmethod(cls.__wrap_ms_request(method, MSLowApi.__dict__[name].__func__)))
+
+    @classmethod
+    def __wrap_ms_request(cls, method, func):
+        @wraps(func)
+        def wrapper(api_cls, request, *args, **kwargs):
+            policy = cls.ms_retry_policy
+            attempt = 0
+            while True:
+                with cls.__ms_semaphore:
+                    response = cls.measure('ms', method, request, lambda: func(api_cls, request, *args, **kwargs))
+                policy.stats.add(requests=1)
+                if response.status_code != 429:
+                    return response
+                policy.stats.add(throttled=1)
+                if attempt >= policy.max_retries:
+                    policy.stats.add(gave_up=1)
+                    return response
+                # 429 МС отклоняет до обработки запроса, поэтому повторяются и POST
+                delay = cls.__get_ms_retry_delay(policy, attempt, response)
+                logging.warning("MS {} {}: 429, retry {}/{} in {:.1f}s".format(
+                    method, normalize_endpoint(request), attempt + 1, policy.max_retries, delay))
+                policy.stats.add(retries=1, backoff_seconds=delay)
+                time.sleep(delay)
+                attempt += 1
+        return wrapper
+
+    @staticmethod
+    def __get_ms_retry_delay(policy: RetryPolicy, attempt, response):
+        """МС сообщает время до снятия ограничения в заголовке X-Lognex-Retry-After (миллисекунды)"""
+        try:
+            retry_after = float(response.headers.get('X-Lognex-Retry-After')) / 1000
+        except (TypeError, ValueError):
+            return policy.get_delay(attempt, response)
+        return min(max(retry_after, 0.0), policy.retry_after_max) + random.uniform(0, policy.backoff_base)
+
+    @classmethod
+    def reset(cls):
+        with cls.__lock:
+            cls.__stats = {}
+
+    @classmethod
+    def get_stats(cls):
+        """копия статистики {(service, stage, method, endpoint): EndpointStats}"""
+        with cls.__lock:
+            return dict(cls.__stats)
+
+    @classmethod
+    def to_str(cls):
+        """сводная таблица по эндпоинтам, самые долгие группы сверху"""
+        stats = sorted(cls.get_stats().items(), key=lambda item: item[1].total_time, reverse=True)
+        if not stats:
+            return "HTTP: no requests"
+        header = ('service', 'stage', 'method', 'endpoint', 'count', 'errors', 'total s', 'avg ms', 'p95 ms', 'KiB')
+        rows = [header]
+        totals = EndpointStats()
+        for (service, stage, method, endpoint), endpoint_stats in stats:
+            rows.append((service, stage, method, endpoint, str(endpoint_stats.count),
+                         str(endpoint_stats.get_errors()),
+                         "{:.2f}".format(endpoint_stats.total_time),
+                         "{:.0f}".format(1000 * endpoint_stats.total_time / endpoint_stats.count),
+                         "{:.0f}".format(1000 * endpoint_stats.get_quantile(0.95)),
+                         "{:.0f}".format(endpoint_stats.bytes / 1024)))
+            totals.count += endpoint_stats.count
+            totals.total_time += endpoint_stats.total_time
+            totals.bytes += endpoint_stats.bytes
+            for status, count in endpoint_stats.statuses.items():
+                totals.statuses[status] = totals.statuses.get(status, 0) + count
+        rows.append(('total', '', '', '', str(totals.count), str(totals.get_errors()),
+                     "{:.2f}".format(totals.total_time), '', '', "{:.0f}".format(totals.bytes / 1024)))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return '\n'.join('  '.join(cell.ljust(width) if i < 4 else cell.rjust(width)
+                                   for i, (cell, width) in enumerate(zip(row, widths)))
+                         for row in rows)
+
+    @classmethod
+    def write_json(cls, path):
+        data = [dict(service=service, stage=stage, method=method, endpoint=endpoint, **endpoint_stats.to_json())
+                for (service, stage, method, endpoint), endpoint_stats in cls.get_stats().items()]
+        cls.__write_file(path, json.dumps(data, indent=4, ensure_ascii=False))
+
+    @classmethod
+    def write_prometheus(cls, path):
+        """пишет метрики в формате textfile collector node_exporter"""
+        lines = [
+            "# HELP woosync_http_requests_total HTTP requests by status.",
+            "# TYPE woosync_http_requests_total counter",
+        ]
+        stats = cls.get_stats()
+        for key, endpoint_stats in stats.items():
+            for status, count in sorted(endpoint_stats.statuses.items()):
+                lines.append("woosync_http_requests_total{{{},status=\"{}\"}} {}".format(
+                    cls.__get_labels(key), status, count))
+        lines += [
+            "# HELP woosync_http_response_bytes_total HTTP response body size.",
+            "# TYPE woosync_http_response_bytes_total counter",
+        ]
+        for key, endpoint_stats in stats.items():
+            lines.append("woosync_http_response_bytes_total{{{}}} {}".format(cls.__get_labels(key),
+                                                                           endpoint_stats.bytes))
+        lines += [
+            "# HELP woosync_http_request_duration_seconds HTTP request latency.",
+            "# TYPE woosync_http_request_duration_seconds histogram",
+        ]
+        for key, endpoint_stats in stats.items():
+            labels = cls.__get_labels(key)
+            accumulated = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, endpoint_stats.buckets):
+                accumulated += bucket
+                le = '+Inf' if bound == float('inf') else str(bound)
+                lines.append("woosync_http_request_duration_seconds_bucket{{{},le=\"{}\"}} {}".format(
+                    labels, le, accumulated))
+            lines.append("woosync_http_request_duration_seconds_sum{{{}}} {:.6f}".format(
+                labels, endpoint_stats.total_time))
+            lines.append("woosync_http_request_duration_seconds_count{{{}}} {}".format(
+                labels, endpoint_stats.count))
+        cls.__write_file(path, '\n'.join(lines) + '\n')
+
+    @staticmethod
+    def __get_labels(key):
+        service, stage, method, endpoint = key
+        return 'service="{}",stage="{}",method="{}",endpoint="{}"'.format(
+            service, stage, method, endpoint.replace('\\', '\\\\').replace('"', '\\"'))
+
+    @staticmethod
+    def __write_file(path, text):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        logging.debug("HTTP metrics written to \'{}\'".format(path))
@@ -6,9 +6,14 @@ from MSApi.Variant import *
 from MSApi.Product import Product
 from MSApi.Service import Service
 from MSApi.Bundle import Bundle
-from MSApi.DiscountHandler import DiscountHandler
+from MSApi.ProductFolder import ProductFolder
+from PriceEngine import PriceEngine, get_price_put_data
+from StageScheduler import submit_in_context
 from exceptions import *
 from typing import Union
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import threading
 
 reporter = Reporter()
 
@@ -19,24 +24,45 @@ def get_product_by_id(product_id, **kwargs):
     return Product(response.json())
 
 
+def get_id_by_href(href: str) -> str:
+    return href.rsplit('/', 1)[-1]
+
+
 class NewAssortmentCreator:
 
-    def __init__(self, wc_products: {}, sale_group_tag):
-        self.__productfolder_ids_blacklist = []
-        self.__assortment_ids_blacklist = []
+    # поля товаров и вариаций WC, по которым ищутся уже созданные товары
+    WC_PRODUCT_FIELDS = ('id', 'type', 'meta_data')
+    WC_VARIATION_FIELDS = ('id', 'meta_data')
+    # типы объектов entity/assortment, которые создаются на сайте
+    ASSORTMENT_TYPES = {'product': Product, 'service': Service, 'bundle': Bundle, 'variant': Variant}
+
+    def __init__(self, wc_products: {}, sale_group_tag, run_context=None):
+        """wc_products - каталог WC, если None, берётся из общих данных запуска run_context (RunContext)"""
+        self.__productfolder_ids_blacklist = set()
+        self.__expanded_productfolder_ids_blacklist = None  # вместе с вложенными группами
+        self.__assortment_ids_blacklist = set()
         self.__sale_group_tag = sale_group_tag
+        self.__context = run_context
+        self.__price_engine = None
+        self.__wc_parents = {}  # {WC_id: Future} товары WC, запрошенные за запуск
+        self.__lock = threading.Lock()
 
+        if wc_products is None and run_context is not None:
+            wc_products = run_context.get_wc_products(self.WC_PRODUCT_FIELDS)
         self.__wc_products = wc_products
         self.__sync_wc_products = {}  # MS_href, WC_id
+        variable_ids = []
         for wc_product in self.__wc_products:
             product_wooms_href = get_wooms_href(wc_product)
             if product_wooms_href is not None:
                 self.__sync_wc_products[product_wooms_href] = wc_product.get('id')
             if wc_product.get('type') == 'variable':
-                for wc_variation in gen_all_wc_variations(wc_product.get('id')):
-                    variation_wooms_href = get_wooms_href(wc_variation)
-                    if variation_wooms_href is not None:
-                        self.__sync_wc_products[variation_wooms_href] = wc_variation.get('id')
+                variable_ids.append(wc_product.get('id'))
+        for wc_variations in self.__map_concurrently(self.__get_wc_variations, variable_ids):
+            for wc_variation in wc_variations:
+                variation_wooms_href = get_wooms_href(wc_variation)
+                if variation_wooms_href is not None:
+                    self.__sync_wc_products[variation_wooms_href] = wc_variation.get('id')
 
         Reporter.add_report_group('new_variants', "New variants created")
         Reporter.add_report_group('new_products', "New products created")
@@ -46,14 +72,22 @@ class NewAssortmentCreator:
         return self.__sync_wc_products
 
     def set_productfolder_ids_blacklist(self, blacklist: []):
-        self.__productfolder_ids_blacklist = blacklist.copy()
+        """id групп товаров, которые не создаются на сайте, вместе с вложенными в них группами"""
+        self.__productfolder_ids_blacklist = set(blacklist)
+        self.__expanded_productfolder_ids_blacklist = None
 
     def set_assortment_ids_blacklist(self, blacklist: []):
-        self.__assortment_ids_blacklist = blacklist.copy()
+        """id или ссылки объектов МС, которые не создаются на сайте"""
+        self.__assortment_ids_blacklist = set(blacklist)
 
-    def create_new_wc_products(self):
+    def create_new_wc_products(self, stream_assortment: bool = False):
+        """stream_assortment - читать ассортимент одним проходом по entity/assortment
+        и создавать товары пакетами по мере чтения, иначе - по спискам каждого типа"""
+        if stream_assortment:
+            self.__create_from_assortment_stream()
+            return
 
-        self.__create_new_wc_variants()
+        self.create_new_wc_variants()
         self.__create_new_wc_products()
         self.__create_new_wc_services()
         self.__create_new_wc_bundles()
@@ -62,14 +96,26 @@ class NewAssortmentCreator:
         ms_product = get_product_by_id(ms_id)
         return "Product added {}".format(self.__create_new_wc_product(ms_product))
 
-    def __create_new_wc_variants(self):
+    def create_new_wc_variants(self):
+        """создаёт на сайте модификации МС, родитель которых уже есть на сайте"""
+        # все модификации, которых нет на сайте, но чей родитель есть, сгруппированные по родителю
+        ms_variants_by_parent = {}  # {WC_id: [Variant]}
         for ms_variation in Variant.gen_list():
-            if not self.__check_assortment(ms_variation):
+            try:
+                self.__check_assortment(ms_variation)
+            except CheckAssortmentException:
                 continue
             wc_product_id = self.__sync_wc_products.get(ms_variation.get_product().get_meta().get_href())
-            # все модификации, которых нет на сайте, но чей родитель есть
-            wc_product = WcApi.get(f'products/{wc_product_id}')
-            self.__create_wc_variant(ms_variation, wc_product)
+            ms_variants_by_parent.setdefault(wc_product_id, []).append(ms_variation)
+        self.__create_wc_variants_by_parent(ms_variants_by_parent)
+
+    def __create_wc_variants_by_parent(self, ms_variants_by_parent):
+        """ms_variants_by_parent - {WC_id: [Variant]} новые модификации товаров, уже созданных на сайте"""
+        def create_variants(wc_product_id):
+            self.__create_wc_variants(self.__get_wc_product(wc_product_id), ms_variants_by_parent[wc_product_id])
+
+        # родители запрашиваются и модификации создаются параллельно для разных родителей
+        self.__map_concurrently(create_variants, list(ms_variants_by_parent.keys()))
 
     # @except_discount_exception
     def __create_new_wc_products(self):
@@ -78,31 +124,18 @@ class NewAssortmentCreator:
                 self.__create_new_wc_product(ms_product)
             except CheckAssortmentException:
                 continue
+            except MSApiException as e:
+                self.__report_creation_error(ms_product, str(e))
 
     def __create_new_wc_product(self, ms_product):
         self.__check_assortment(ms_product)
-        wc_put_data = {
-            'status': 'draft',
-            'meta_data': [
-                {
-                    'key': 'wooms_href',
-                    'value': ms_product.get_meta().get_href()
-                }
-            ]
-        }
-        wc_put_data |= self.__get_wc_put_data_prices(ms_product)
-        if ms_product.has_variants():
-            wc_put_data['type'] = 'variable'
-        article = ms_product.get_article()
-        if article is not None:
-            wc_put_data['sku'] = article
-
-        wc_put_data['name'] = ms_product.get_name()
+        wc_put_data = self.__get_wc_post_data(ms_product)
 
         response = WcApi.post('products', wc_put_data)
         Reporter.append_report('new_products', '"{}"'.format(ms_product.get_name()))
         if response is None:
             raise SyncroException("WcApi post method return None")
+        self.__add_created(ms_product, response)
 
         wc_product_id = response.get('id')
         if ms_product.has_variants():
@@ -114,57 +147,124 @@ class NewAssortmentCreator:
         for ms_service in Service.gen_list(expand=Expand('productFolder')):
             try:
                 self.__check_assortment(ms_service)
+                wc_put_data = self.__get_wc_post_data(ms_service)
 
-                wc_put_data = {
-                    'status': 'draft',
-                    'virtual': True,
-                    'meta_data': [
-                        {
-                            'key': 'wooms_href',
-                            'value': ms_service.get_meta().get_href()
-                        }
-                    ]
-                }
-                wc_put_data |= self.__get_wc_put_data_prices(ms_service)
-                wc_put_data['name'] = ms_service.get_name()
-
-                WcApi.post('products', wc_put_data)
+                self.__add_created(ms_service, WcApi.post('products', wc_put_data))
                 Reporter.append_report('new_products', '"{}"'.format(ms_service.get_name()))
             except CheckAssortmentException:
                 continue
+            except MSApiException as e:
+                self.__report_creation_error(ms_service, str(e))
 
     # @except_discount_exception
     def __create_new_wc_bundles(self):
         for ms_bundle in Bundle.gen_list(expand=Expand('productFolder')):
             try:
                 self.__check_assortment(ms_bundle)
+                wc_put_data = self.__get_wc_post_data(ms_bundle)
 
-                wc_put_data = {
-                    'status': 'draft',
-                    'meta_data': [
-                        {
-                            'key': 'wooms_href',
-                            'value': ms_bundle.get_meta().get_href()
-                        }
-                    ]
-                }
-                wc_put_data |= self.__get_wc_put_data_prices(ms_bundle)
-                wc_put_data['name'] = ms_bundle.get_name()
-
-                WcApi.post('products', wc_put_data)
+                self.__add_created(ms_bundle, WcApi.post('products', wc_put_data))
                 Reporter.append_report('new_products', '"{}"'.format(ms_bundle.get_name()))
             except CheckAssortmentException:
                 continue
+            except MSApiException as e:
+                self.__report_creation_error(ms_bundle, str(e))
+
+    def __create_from_assortment_stream(self):
+        """один проход по entity/assortment с отбором типов на стороне МС. Товары, услуги и комплекты
+        отправляются на создание пакетами по мере чтения страниц, в памяти остаются только новые модификации"""
+        # модификации товаров, созданных в этом проходе, создаются вместе с товаром
+        known_hrefs = set(self.__sync_wc_products.keys())
+        ms_variants_by_parent = {}  # {WC_id: [Variant]}
+        wc_writer = WcBatchWriter('products')
+        for ms_object in self.__gen_assortment():
+            try:
+                self.__check_assortment(ms_object)
+            except CheckAssortmentException:
+                continue
+            if isinstance(ms_object, Variant):
+                parent_href = ms_object.get_product().get_meta().get_href()
+                if parent_href in known_hrefs:
+                    ms_variants_by_parent.setdefault(self.__sync_wc_products[parent_href], []).append(ms_object)
+                continue
+            try:
+                wc_writer.create(self.__get_wc_post_data(ms_object), source=ms_object)
+            except MSApiException as e:
+                self.__report_creation_error(ms_object, str(e))
+            if len(wc_writer) == 0:
+                # пакет отправлен при заполнении буфера
+                self.__add_created_batch(wc_writer.flush())
+        self.__add_created_batch(wc_writer.flush())
+        self.__create_wc_variants_by_parent(ms_variants_by_parent)
+
+    def __gen_assortment(self):
+        """товары, услуги, комплекты и модификации МС одним списком entity/assortment"""
+        type_filter = Filter()
+        for type_name in self.ASSORTMENT_TYPES:
+            type_filter += Filter.eq('type', type_name)
+        return MSLowApi.gen_objects('entity/assortment',
+                                    lambda row: self.ASSORTMENT_TYPES[row['meta']['type']](row), filters=type_filter)
+
+    def __add_created_batch(self, batch_results):
+        """обрабатывает результаты пакетного создания товаров WC"""
+        for ms_object, wc_product, error in batch_results:
+            if error is not None:
+                self.__report_creation_error(ms_object, error)
+                continue
+            if wc_product is None:
+                continue
+            Reporter.append_report('new_products', '"{}"'.format(ms_object.get_name()))
+            self.__add_created(ms_object, wc_product)
+            if isinstance(ms_object, Product) and ms_object.has_variants():
+                self.__create_new_wc_variations(wc_product.get('id'), ms_object.get_id())
+
+    @staticmethod
+    def __report_creation_error(ms_object, error):
+        logging.error("WC Product '{}' creation failed: {}".format(ms_object.get_name(), error))
+        Reporter.append_report('errors', '"{}": {}'.format(ms_object.get_name(), error))
+
+    def __get_wc_post_data(self, ms_object: Union[Product, Service, Bundle]):
+        """данные для создания товара WC из товара, услуги или комплекта МС"""
+        wc_put_data = {
+            'status': 'draft',
+            'meta_data': [
+                {
+                    'key': 'wooms_href',
+                    'value': ms_object.get_meta().get_href()
+                }
+            ]
+        }
+        if isinstance(ms_object, Service):
+            wc_put_data['virtual'] = True
+        wc_put_data |= self.__get_wc_put_data_prices(ms_object)
+        if isinstance(ms_object, Product):
+            if ms_object.has_variants():
+                wc_put_data['type'] = 'variable'
+            article = ms_object.get_article()
+            if article is not None:
+                wc_put_data['sku'] = article
+
+        wc_put_data['name'] = ms_object.get_name()
+        return wc_put_data
+
+    def __add_created(self, ms_object, wc_product):
+        """запоминает созданный товар WC, чтобы он не создавался повторно и был виден другим стадиям"""
+        if wc_product is None:
+            return
+        self.__sync_wc_products[ms_object.get_meta().get_href()] = wc_product.get('id')
+        if self.__context is not None:
+            self.__context.add_wc_products([wc_product])
 
     def __create_new_wc_variations(self, wc_product_id, ms_product_id):
+        ms_variants = list(Variant.gen_list(filters=Filter.eq('productid', ms_product_id)))
         all_characteristics: {str: [Characteristic]} = {}
-        for ms_variant in Variant.gen_list(filters=Filter.eq('productid', ms_product_id)):
+        for ms_variant in ms_variants:
             for characteristic in ms_variant.gen_characteristics():
                 all_characteristics.setdefault(characteristic.get_name(), []).append(characteristic)
 
         list_wc_attributes = []
-        for name, ms_characteristic_list in all_characteristics:
-            characteristic_values = [str]
+        for name, ms_characteristic_list in all_characteristics.items():
+            characteristic_values = []
             for ms_characteristic in ms_characteristic_list:
                 characteristic_values.append(ms_characteristic.get_value())
             list_wc_attributes.append({
@@ -176,12 +276,38 @@ class NewAssortmentCreator:
 
         wc_put_data = {'attributes': list_wc_attributes}
         wc_product = WcApi.put(f'products/{wc_product_id}', wc_put_data)
-
-        for ms_variant in Variant.gen_list(filters=Filter.eq('productid', ms_product_id)):
-            self.__create_wc_variant(ms_variant, wc_product)
+        if wc_product is None:
+            return
+        self.__create_wc_variants(wc_product, ms_variants)
+
+    def __create_wc_variants(self, wc_product, ms_variants):
+        """создаёт модификации одного товара WC пакетами через 'products/{id}/variations/batch'"""
+        wc_writer = WcBatchWriter(f"products/{wc_product.get('id')}/variations")
+        for ms_variant in ms_variants:
+            try:
+                wc_writer.create(self.__get_wc_variant_data(ms_variant, wc_product), source=ms_variant)
+            except (SyncroException, MSApiException) as e:
+                logging.error("WC Variation '{}' creation failed: {}".format(ms_variant.get_name(), str(e)))
+                Reporter.append_report('errors', '"{}": {}'.format(ms_variant.get_name(), str(e)))
+
+        for ms_variant, wc_variation, error in wc_writer.flush():
+            if error is not None:
+                logging.error("WC Variation '{}' creation failed: {}".format(ms_variant.get_name(), error))
+                Reporter.append_report('errors', '"{}": {}'.format(ms_variant.get_name(), error))
+                continue
+            if wc_variation is None:
+                continue
+            self.__sync_wc_products[ms_variant.get_meta().get_href()] = wc_variation.get('id')
+            report_attributes_strings = [f'"{characteristic.get_name()}" : {characteristic.get_value()}'
+                                         for characteristic in ms_variant.gen_characteristics()]
+            Reporter.append_report('new_variants',
+                                   'In product "{}" with attributes:\n{}'.format(ms_variant.get_name(),
+                                                                                 "\n\t".join(
+                                                                                     report_attributes_strings)))
 
     # @except_discount_exception
-    def __create_wc_variant(self, ms_variant, wc_product):
+    def __get_wc_variant_data(self, ms_variant, wc_product):
+        """данные для создания модификации WC"""
         wc_variant_put_data = {
             'status': 'draft',
             'meta_data': [
@@ -193,10 +319,9 @@ class NewAssortmentCreator:
         }
         wc_variant_put_data |= self.__get_wc_put_data_prices(ms_variant)
 
-        report_attributes_strings = []
         attributes_list = []
         for characteristic in ms_variant.gen_characteristics():
-            for wc_attr in wc_product.get('attributes'):
+            for wc_attr in wc_product.get('attributes') or []:
                 if wc_attr.get('name') == characteristic.get_name():
                     break
             else:
@@ -205,50 +330,104 @@ class NewAssortmentCreator:
                 'id': wc_attr.get('id'),
                 'option': characteristic.get_value()
             })
-            report_attributes_strings.append(f'"{characteristic.get_name()}" : {characteristic.get_value()}')
         wc_variant_put_data['attributes'] = attributes_list
-        WcApi.put(f'products/{wc_product.get(id)}/variations', wc_variant_put_data)
-        Reporter.append_report('new_variants',
-                               'In product "{}" with attributes:\n{}'.format(ms_variant.get_name(),
-                                                                             "\n\t".join(
-                                                                                 report_attributes_strings)))
+        return wc_variant_put_data
+
+    def __get_wc_variations(self, wc_product_id):
+        return list(gen_all_wc_variations(wc_product_id, fields=self.WC_VARIATION_FIELDS))
+
+    def __get_wc_product(self, wc_product_id):
+        """товар WC запрашивается один раз за запуск, одновременные запросы одного товара объединяются"""
+        with self.__lock:
+            future = self.__wc_parents.get(wc_product_id)
+            is_owner = future is None
+            if is_owner:
+                future = self.__wc_parents[wc_product_id] = Future()
+        if is_owner:
+            try:
+                future.set_result(WcApi.get(f'products/{wc_product_id}'))
+            except BaseException as e:
+                # неудачный запрос не запоминается, следующее обращение запросит товар заново
+                with self.__lock:
+                    self.__wc_parents.pop(wc_product_id, None)
+                future.set_exception(e)
+        return future.result()
+
+    @staticmethod
+    def __map_concurrently(func, items):
+        """func для каждого элемента не более чем в WcApi.pool_size потоков, результаты в порядке items"""
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=max(WcApi.pool_size, 1)) as executor:
+            futures = [submit_in_context(executor, func, item) for item in items]
+            return [future.result() for future in futures]
 
     def __get_wc_put_data_prices(self, ms_object,
                                  wc_regular_price: int = None,
                                  wc_sale_price: int = None):
         """вытаскивает из объекта МС обычную и скидочную цену, сравнивает с ценами WC
         и возвращает цены для отправки на сайт"""
-        wc_put_data = {}
-        ms_regular_price = DiscountHandler.get_default_price_value(ms_object)
-        ms_sale_price = DiscountHandler.get_actual_price(ms_object, self.__sale_group_tag)
-        if ms_regular_price != wc_regular_price:
-            wc_put_data['regular_price'] = str(ms_regular_price)
-        if ms_sale_price == ms_regular_price:
-            ms_sale_price = None
-
-        if ms_sale_price != wc_sale_price:
-            if ms_sale_price is None:
-                wc_put_data['sale_price'] = ''
+        ms_prices = self.__get_price_engine().get_prices(ms_object)
+        return get_price_put_data(ms_prices, (wc_regular_price, wc_sale_price))
+
+    def __get_price_engine(self) -> PriceEngine:
+        """расчёт цен общий для запуска, без run_context загружается один раз на создателя"""
+        if self.__price_engine is None:
+            if self.__context is not None:
+                self.__price_engine = self.__context.get_price_engine()
             else:
-                wc_put_data['sale_price'] = str(ms_sale_price)
-        return wc_put_data
+                self.__price_engine = PriceEngine.load(self.__sale_group_tag)
+        return self.__price_engine
 
     def __check_assortment(self, ms_object: Union[Product, Service, Bundle, Variant]) -> None:
-        """проверяет пеобходимость сознаия нового товара"""
-        wc_product_id = self.__sync_wc_products.get(ms_object.get_meta().get_href())
+        """проверяет пеобходимость сознаия нового товара.
+        id берутся из ссылок, поэтому группы товаров не нужно раскрывать (expand)"""
+        href = ms_object.get_meta().get_href()
+        wc_product_id = self.__sync_wc_products.get(href)
         if wc_product_id is not None:
-            raise SyncroException(f"Assortment already append: \"{wc_product_id}\"")
-        if ms_object.get_meta().get_href() in self.__assortment_ids_blacklist:
-            raise SyncroException(f"Assortment in blacklist: \"{ms_object.get_id()}\"")
+            raise CheckAssortmentException(f"Assortment already append: \"{wc_product_id}\"")
+        if href in self.__assortment_ids_blacklist or get_id_by_href(href) in self.__assortment_ids_blacklist:
+            raise CheckAssortmentException(f"Assortment in blacklist: \"{get_id_by_href(href)}\"")
         if type(ms_object) in [Product, Service, Bundle]:
             productfolder = ms_object.get_productfolder()
             if productfolder is None:
                 return
-            if productfolder.get_id() in self.__productfolder_ids_blacklist:
-                raise SyncroException(f"Assortment`s productfolder in blacklist: \"{ms_object.get_id()}\"")
+            if get_id_by_href(productfolder.get_meta().get_href()) in self.__get_productfolder_ids_blacklist():
+                raise CheckAssortmentException(
+                    f"Assortment`s productfolder in blacklist: \"{get_id_by_href(href)}\"")
         else:
             # проверяем есть ли на сайте родитель
             wc_product_id = self.__sync_wc_products.get(ms_object.get_product().get_meta().get_href())
             if wc_product_id is None:
-                raise SyncroException(f"Parent of modification not found: \"{ms_object.get_id()}\"")
+                raise CheckAssortmentException(f"Parent of modification not found: \"{get_id_by_href(href)}\"")
         return
+
+    def __get_productfolder_ids_blacklist(self) -> set:
+        """id групп из черного списка вместе со всеми вложенными группами"""
+        if self.__expanded_productfolder_ids_blacklist is None:
+            self.__expanded_productfolder_ids_blacklist = self.__expand_productfolder_ids(
+                self.__productfolder_ids_blacklist)
+        return self.__expanded_productfolder_ids_blacklist
+
+    @staticmethod
+    def __expand_productfolder_ids(productfolder_ids) -> set:
+        """добавляет к группам вложенные группы любой глубины, список групп запрашивается один раз"""
+        if not productfolder_ids:
+            return set()
+        children = {}  # {id группы: [id вложенных групп]}
+        for productfolder in ProductFolder.gen_list():
+            parent = productfolder.get_json().get('productFolder')
+            if parent is None:
+                continue
+            children.setdefault(get_id_by_href(parent['meta']['href']), []).append(
+                get_id_by_href(productfolder.get_meta().get_href()))
+
+        expanded = set()
+        stack = list(productfolder_ids)
+        while stack:
+            productfolder_id = stack.pop()
+            if productfolder_id in expanded:
+                continue
+            expanded.add(productfolder_id)
+            stack.extend(children.get(productfolder_id, []))
+        return expanded
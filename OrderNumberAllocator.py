@@ -0,0 +1,114 @@
+import heapq
+import json
+import logging
+import os
+import threading
+
+from MSApi import Order
+from MSApi.documents.CustomerOrder import CustomerOrder
+
+from FileLock import FileLock
+
+
+def format_order_name(number: int) -> str:
+    return str(number).zfill(5)
+
+
+def get_last_ms_order_number() -> int:
+    """номер последнего созданного заказа МС, 0 - заказов нет"""
+    for order in CustomerOrder.gen_list(limit=1, orders=Order.desc('created')):
+        return int(order.get_name())
+    return 0
+
+
+class OrderNumberAllocator:
+    """выдаёт номера новых заказов МС, в том числе параллельным потокам.
+    Номера резервируются блоками: под файловой блокировкой последний зарезервированный номер
+    сверяется с последним заказом МС и сдвигается на блок, поэтому одновременные запуски
+    не получают одинаковых номеров. Без файла номера согласуются только внутри процесса.
+    Номера заказов, которые не удалось создать, возвращаются и выдаются повторно"""
+
+    BLOCK_SIZE = 20
+
+    def __init__(self, path=None, block_size=None, get_last_number=get_last_ms_order_number):
+        """path - json файл с последним зарезервированным номером (рядом создаётся файл блокировки),
+        get_last_number - номер последнего заказа МС"""
+        self.__path = path
+        self.__block_size = block_size or self.BLOCK_SIZE
+        self.__get_last_number = get_last_number
+        self.__next = 1
+        self.__end = 0  # текущий блок - номера [next, end]
+        self.__released = []  # heap возвращённых номеров
+        self.__last_reserved = 0  # последний зарезервированный номер, если файла нет
+        self.__lock = threading.Lock()
+
+    def allocate(self, count=1) -> [int]:
+        """выдаёт count номеров по возрастанию"""
+        with self.__lock:
+            numbers = []
+            while len(numbers) < count:
+                if self.__released:
+                    numbers.append(heapq.heappop(self.__released))
+                    continue
+                if self.__next > self.__end:
+                    self.__reserve(count - len(numbers))
+                numbers.append(self.__next)
+                self.__next += 1
+            return sorted(numbers)
+
+    def release(self, numbers: [int]):
+        """возвращает номера заказов, которые не были созданы"""
+        with self.__lock:
+            for number in numbers:
+                heapq.heappush(self.__released, number)
+
+    def release_unused(self):
+        """возвращает в файл неиспользованный остаток блока, если после него никто не резервировал номера"""
+        with self.__lock:
+            if self.__next > self.__end:
+                return
+            last_used = self.__next - 1
+            released = set(self.__released)
+            while last_used in released:
+                released.discard(last_used)
+                last_used -= 1
+            with self.__locked_file():
+                if self.__read_last_reserved() == self.__end:
+                    self.__write_last_reserved(last_used)
+            self.__released = list(released)
+            heapq.heapify(self.__released)
+            self.__next, self.__end = 1, 0
+
+    def __reserve(self, count):
+        """резервирует блок не меньше count номеров после последнего зарезервированного и последнего в МС"""
+        size = max(count, self.__block_size)
+        with self.__locked_file():
+            last_number = max(self.__read_last_reserved(), self.__get_last_number())
+            self.__write_last_reserved(last_number + size)
+        self.__next, self.__end = last_number + 1, last_number + size
+        logging.debug("Order numbers {}-{} reserved".format(self.__next, self.__end))
+
+    def __locked_file(self):
+        return FileLock(None if self.__path is None else self.__path + '.lock')
+
+    def __read_last_reserved(self):
+        if self.__path is None:
+            return self.__last_reserved
+        if not os.path.exists(self.__path):
+            return 0
+        try:
+            with open(self.__path, encoding='utf-8') as f:
+                return int(json.load(f)['last_reserved'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Order numbers \'{}\' ignored: {}".format(self.__path, str(e)))
+            return 0
+
+    def __write_last_reserved(self, number):
+        self.__last_reserved = number
+        if self.__path is None:
+            return
+        tmp_path = self.__path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'last_reserved': number}, f, indent=4)
+        os.replace(tmp_path, self.__path)
+
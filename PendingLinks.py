@@ -0,0 +1,50 @@
+import json
+import logging
+import os
+import threading
+
+
+class PendingLinks:
+    """созданные товары WC, чей wc_id ещё не записан в МС (ms_href -> wc_id).
+    Хранятся в json файле, чтобы повторный запуск не создавал дубликаты.
+    Стадии создания товаров и комплектов могут обновлять ссылки одновременно"""
+
+    def __init__(self, path=None):
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__links = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.__links = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error("Pending links \'{}\' ignored: {}".format(path, str(e)))
+
+    def __len__(self):
+        return len(self.__links)
+
+    def get(self, ms_href):
+        return self.__links.get(ms_href)
+
+    def add(self, links: {str: int}):
+        if not links:
+            return
+        with self.__lock:
+            self.__links.update(links)
+            self.__save()
+
+    def remove(self, ms_hrefs: [str]):
+        if not ms_hrefs:
+            return
+        with self.__lock:
+            for ms_href in ms_hrefs:
+                self.__links.pop(ms_href, None)
+            self.__save()
+
+    def __save(self):
+        if self.__path is None:
+            return
+        tmp_path = self.__path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.__links, f, indent=4)
+        os.replace(tmp_path, self.__path)
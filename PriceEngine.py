@@ -0,0 +1,131 @@
+import threading
+
+from MSApi import CompanySettings, MSApiException, SpecialPriceDiscount
+
+
+def get_price_put_data(ms_prices, wc_prices=(None, None)):
+    """данные для обновления цен WC: ms_prices - (обычная, со скидкой) МС,
+    wc_prices - (обычная, со скидкой) WC, None - цены нет"""
+    ms_regular_price, ms_sale_price = ms_prices
+    wc_regular_price, wc_sale_price = wc_prices
+    wc_put_data = {}
+    if ms_regular_price != wc_regular_price:
+        wc_put_data['regular_price'] = str(ms_regular_price)
+    if ms_sale_price == ms_regular_price:
+        ms_sale_price = None
+
+    if ms_sale_price != wc_sale_price:
+        if ms_sale_price is None:
+            wc_put_data['sale_price'] = ''
+        else:
+            wc_put_data['sale_price'] = str(ms_sale_price)
+    return wc_put_data
+
+
+def diff_prices(ms_prices, wc_prices):
+    """сравнивает столбцы цен МС и WC [(обычная, со скидкой)] целиком.
+    Возвращает {номер строки: данные для обновления цен WC} только для различающихся строк"""
+    # цена со скидкой, равная обычной, на сайте не указывается
+    ms_prices = [(regular_price, None if sale_price == regular_price else sale_price)
+                 for regular_price, sale_price in ms_prices]
+    return {i: get_price_put_data(ms_row, wc_row)
+            for i, (ms_row, wc_row) in enumerate(zip(ms_prices, wc_prices)) if ms_row != wc_row}
+
+
+class DiscountRule:
+    """скидка, применимая к группе покупателей: ассортимент и группы товаров в виде множеств ссылок"""
+
+    __slots__ = ('all_products', 'assortment_hrefs', 'folder_hrefs', 'price_type_href', 'percent')
+
+    def __init__(self, discount: SpecialPriceDiscount):
+        self.all_products = discount.is_all_products()
+        assortment = discount.get_json().get('assortment') or []
+        self.assortment_hrefs = frozenset(obj['meta']['href'] for obj in assortment)
+        self.folder_hrefs = frozenset(folder.get_meta().get_href() for folder in discount.gen_productfolders())
+        self.price_type_href = None
+        self.percent = 0
+        if discount.is_use_price_type():
+            # TODO обработка параметра value
+            self.price_type_href = discount.get_special_price().get_price_type().get_meta().get_href()
+        else:
+            self.percent = discount.get_discount_percent() or 0
+
+
+class PriceEngine:
+    """цены сайта для ассортимента МС, расчёт совпадает с DiscountHandler.
+    Тип цены по умолчанию и скидки загружаются один раз, скидки группы покупателей
+    отбираются заранее, поэтому цена объекта считается без обхода всех правил скидок"""
+
+    def __init__(self, default_price_type_href, discounts: [SpecialPriceDiscount], sale_group_tag):
+        """discounts - активные скидки, sale_group_tag - группа покупателей"""
+        self.__default_price_type_href = default_price_type_href
+        self.__rules = [DiscountRule(discount) for discount in discounts
+                        if discount.is_all_agents() or sale_group_tag in discount.gen_agent_tags()]
+        self.__product_folders = {}  # {ссылка на товар: ссылка на группу} для модификаций
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def load(cls, sale_group_tag):
+        """загружает тип цены по умолчанию и активные скидки"""
+        discounts = [discount for discount in SpecialPriceDiscount.gen_list() if discount.is_active()]
+        default_price_type = CompanySettings.get_default_price_type()
+        return cls(default_price_type.get_meta().get_href(), discounts, sale_group_tag)
+
+    def get_prices(self, ms_object):
+        """обычная цена и цена со скидкой объекта МС"""
+        prices = {}  # {ссылка на тип цены: значение}
+        for sale_price in ms_object.gen_sale_prices():
+            prices.setdefault(sale_price.get_json()['priceType']['meta']['href'], sale_price.get_value())
+        regular_price = prices.get(self.__default_price_type_href)
+        if regular_price is None:
+            raise MSApiException(f"Default price type in {str(ms_object)} not found")
+
+        max_discount_percent = 0
+        min_price = regular_price
+        href = ms_object.get_meta().get_href()
+        folder_href = None
+        for rule in self.__rules:
+            if not rule.all_products and href not in rule.assortment_hrefs:
+                if folder_href is None:
+                    folder_href = self.__get_folder_href(ms_object) or ''
+                if folder_href not in rule.folder_hrefs:
+                    continue
+            if rule.price_type_href is None:
+                max_discount_percent = max(max_discount_percent, rule.percent)
+            elif rule.price_type_href in prices:
+                min_price = min(min_price, prices[rule.price_type_href])
+
+        min_price = min(min_price, regular_price * (1 - max_discount_percent))
+        return regular_price, round(min_price * 100) / 100
+
+    def get_price_table(self, ms_objects):
+        """цены всего ассортимента за один проход: {ссылка МС: (обычная, со скидкой)}
+        и {ссылка МС: текст ошибки} для объектов, цены которых не рассчитать"""
+        table = {}
+        errors = {}
+        for ms_object in ms_objects:
+            href = ms_object.get_meta().get_href()
+            try:
+                table[href] = self.get_prices(ms_object)
+            except MSApiException as e:
+                errors[href] = str(e)
+        return table, errors
+
+    def __get_folder_href(self, ms_object):
+        """ссылка на группу товара, для модификации - группа её товара (запрашивается один раз на товар)"""
+        if hasattr(type(ms_object), 'get_productfolder'):
+            productfolder = ms_object.get_productfolder()
+        elif hasattr(type(ms_object), 'get_product'):
+            product = ms_object.get_product()
+            product_href = product.get_meta().get_href()
+            with self.__lock:
+                if product_href in self.__product_folders:
+                    return self.__product_folders[product_href]
+            productfolder = product.get_productfolder()
+            folder_href = None if productfolder is None else productfolder.get_meta().get_href()
+            with self.__lock:
+                self.__product_folders[product_href] = folder_href
+            return folder_href
+        else:
+            raise MSApiException(f"Unexpected type {type(ms_object)}")
+        return None if productfolder is None else productfolder.get_meta().get_href()
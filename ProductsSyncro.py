@@ -1,237 +1,387 @@
-from MSApi import Employee, Task
 from MSApi.MSApi import MSApi, MSApiHttpException, Product
 from MSApi import Bundle
 from MSApi import Variant
-from MSApi.DiscountHandler import DiscountHandler
 from MSApi.MSLowApi import error_handler
 from MSApi.properties import *
 
-from WcApi import WcApi
-from exceptions import SyncroException, WcApiException
+from WcApi import WcApi, WcBatchWriter
+from AssortmentIndex import gen_import_bundles, gen_import_products
+from CatalogMirror import CatalogMirror, MirrorIndex
+from CatalogRecords import MsAssortmentRecord, WcProductRecord
+from PendingLinks import PendingLinks
+from PriceEngine import diff_prices, get_price_put_data
+from ReconciliationIndex import ReconciliationIndex
+from RunContext import RunContext
+from ShardCoordinator import ShardCoordinator
+from StageScheduler import submit_in_context
+from TaskRegistry import TaskRegistry
+from exceptions import SyncroException
 import logging
+import threading
 
 from settings import *
-
-
-def get_wc_prices(wc_product):
-    """возвращает обычную цену и цену со скидкой из товара WooCommerce"""
-    regular_price = wc_product.get('regular_price')
-    if regular_price == '':
-        regular_price = None
-    else:
-        regular_price = float(regular_price)
-    sale_price = wc_product.get('sale_price')
-    if sale_price == '':
-        sale_price = None
-    else:
-        sale_price = float(sale_price)
-    return regular_price, sale_price
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 
 class ProductsSyncro:
-
-    def __init__(self, sale_group_tag):
+    """синхронизация ассортимента. Каталоги обеих сторон хранятся в виде компактных записей
+    (WcProductRecord, MsAssortmentRecord), цены МС рассчитываются при загрузке (PriceEngine)"""
+
+    WC_INCLUDE_LIMIT = 100
+    MS_FILTER_LIMIT = 50
+    MS_BATCH_LIMIT = 1000
+    LOAD_WORKERS = 3
+    # поля товаров WC, которые читают стадии синхронизации ассортимента
+    WC_PRODUCT_FIELDS = WcProductRecord.FIELDS
+
+    def __init__(self, sale_group_tag, task_registry: TaskRegistry = None, modified_since: datetime = None,
+                 wc_products=None, mirror: CatalogMirror = None, pending_links: PendingLinks = None,
+                 run_context: RunContext = None, coordinator: ShardCoordinator = None, retry_ms_hrefs: [str] = None):
+        """modified_since - если задано, синхронизируются только объекты, изменённые после этого момента;
+        wc_products - уже загружаемый каталог WC (итерируется после загрузки ассортимента МС);
+        mirror - локальное зеркало каталогов, если задано, данные читаются из него;
+        pending_links - созданные товары WC, ещё не связанные с МС;
+        run_context - общие данные запуска (атрибуты, каталоги, реестр задач);
+        coordinator - если задан, синхронизируется только часть каталога coordinator.shard;
+        retry_ms_hrefs - объекты МС, которые не удалось синхронизировать в прошлый раз, при modified_since
+        загружаются вместе с изменёнными"""
         self.__sale_group_tag = sale_group_tag
-
-        self.__import_flag_attribute = None
-        self.__wc_id_attribute = None
-        for attr in Product.gen_attributes_list():
-            if attr.get_name() == IMPORT_FLAG_ATTR_NAME:
-                self.__import_flag_attribute = attr
-            if attr.get_name() == WC_ID_ATTR_NAME:
-                self.__wc_id_attribute = attr
-
-        if self.__import_flag_attribute is None:
-            raise SyncroException("product attribute '{}' not found".format(IMPORT_FLAG_ATTR_NAME))
-        if self.__wc_id_attribute is None:
-            raise SyncroException("product attribute '{}' not found".format(WC_ID_ATTR_NAME))
-
-        self.wc_products = list(WcApi.gen_all_wc_products())
-
-        self.ms_products = list(Product.gen_list(
-            filters=Filter.eq(self.__import_flag_attribute.get_meta().get_href(), True)))
-
-        self.ms_bundles = []
-        for ms_bundle in Bundle.gen_list():
-            # FIXME исправить на фильтр когда зафиксят баг
-            import_flag = ms_bundle.get_attribute_by_name(IMPORT_FLAG_ATTR_NAME)
-            if import_flag is None:
-                continue
-            if not import_flag.get_value():
+        self.__coordinator = coordinator
+        self.__retry_ms_hrefs = set(retry_ms_hrefs or ())
+        self.__failed_ms_hrefs = set()
+        self.__failed_lock = threading.Lock()
+        self.__complete = True
+        if run_context is None:
+            run_context = RunContext(mirror, sale_group_tag)
+        self.__context = run_context
+
+        # каталог WC не зависит от данных МС и загружается параллельно с ними
+        executor = ThreadPoolExecutor(max_workers=self.LOAD_WORKERS)
+        try:
+            self.__load(executor, modified_since, wc_products, mirror)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if coordinator is not None:
+            # обе стороны делятся по одному ключу, поэтому пары и проверки не выходят за пределы части
+            shard = coordinator.shard
+            self.wc_products = shard.filter_wc_records(self.wc_products)
+            self.ms_products = shard.filter_ms_records(self.ms_products)
+            self.ms_bundles = shard.filter_ms_records(self.ms_bundles)
+            logging.info("Shard {}: {} WC products, {} MS products, {} MS bundles".format(
+                shard, len(self.wc_products), len(self.ms_products), len(self.ms_bundles)))
+
+        if mirror is None:
+            self.__index = ReconciliationIndex(self.wc_products, self.ms_products + self.ms_bundles)
+
+        if task_registry is None:
+            task_registry = self.__context.get_task_registry()
+        self.__task_registry = task_registry
+
+        if pending_links is None:
+            pending_links = PendingLinks()
+        self.__pending_links = pending_links
+
+    def __load(self, executor, modified_since, wc_products, mirror):
+        """загружает атрибуты и каталоги обеих сторон"""
+        wc_products_future = None
+        if mirror is None and modified_since is None and wc_products is None:
+            wc_products_future = submit_in_context(executor, self.__context.get_wc_records)
+        # скидки и типы цен нужны для расчёта цен записей МС
+        price_engine_future = submit_in_context(executor, self.__context.get_price_engine)
+
+        self.__import_flag_attribute = self.__context.get_product_attribute(IMPORT_FLAG_ATTR_NAME)
+        self.__wc_id_attribute = self.__context.get_product_attribute(WC_ID_ATTR_NAME)
+
+        if mirror is not None:
+            self.wc_products = mirror.wc_product_records
+            self.ms_products = mirror.get_ms_records(Product, price_engine_future.result())
+            self.ms_bundles = mirror.get_ms_records(Bundle, price_engine_future.result())
+            self.__index = MirrorIndex(mirror)
+        elif modified_since is None:
+            ms_bundles_future = submit_in_context(executor, self.__context.get_ms_bundles)
+            self.ms_products = self.__context.get_ms_products()
+            self.ms_bundles = ms_bundles_future.result()
+            if wc_products_future is not None:
+                self.wc_products = wc_products_future.result()
+            else:
+                self.wc_products = [WcProductRecord.from_json(wc_product) for wc_product in wc_products]
+        else:
+            self.__load_modified(executor, modified_since)
+        price_engine_future.result()
+
+    def __load_modified(self, executor, modified_since: datetime):
+        """загружает изменённые объекты с обеих сторон и их пары с другой стороны"""
+        logging.info("Incremental syncro: changes since {}".format(modified_since.isoformat()))
+        import_flag_href = self.__import_flag_attribute.get_meta().get_href()
+        wc_id_href = self.__wc_id_attribute.get_meta().get_href()
+
+        wc_products_future = submit_in_context(executor, lambda: self.__gen_wc_records(filters={
+            'modified_after': modified_since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S'),
+            'dates_are_gmt': 'true'
+        }))
+        ms_since = modified_since.astimezone(MS_TIMEZONE).replace(tzinfo=None)
+        ms_bundles_future = submit_in_context(executor, lambda: self.__context.to_records(
+            gen_import_bundles(filters=DateTimeFilter.gte('updated', ms_since))))
+        self.ms_products = self.__context.to_records(
+            gen_import_products(import_flag_href, filters=DateTimeFilter.gte('updated', ms_since)))
+        self.ms_bundles = ms_bundles_future.result()
+        self.wc_products = wc_products_future.result()
+        logging.info("Incremental syncro: {} WC products, {} MS products, {} MS bundles changed".format(
+            len(self.wc_products), len(self.ms_products), len(self.ms_bundles)))
+        self.__load_retried(import_flag_href)
+
+        wc_ids = set(wc_product.id for wc_product in self.wc_products)
+        ms_wc_ids = set()
+        ms_hrefs = set()
+        for ms_object in self.ms_products + self.ms_bundles:
+            ms_hrefs.add(ms_object.href)
+            wc_id = self.__get_wc_id_value(ms_object)
+            if wc_id is not None:
+                ms_wc_ids.add(wc_id)
+
+        # товары WC для изменённых объектов МС
+        missing_wc_ids = sorted(ms_wc_ids - wc_ids)
+        for i in range(0, len(missing_wc_ids), self.WC_INCLUDE_LIMIT):
+            include = ','.join(str(wc_id) for wc_id in missing_wc_ids[i:i + self.WC_INCLUDE_LIMIT])
+            self.wc_products += self.__gen_wc_records(filters={'include': include})
+
+        # объекты МС для изменённых товаров WC и все объекты МС с теми же wc_id, что и у изменённых:
+        # без них проверка дубликатов не видит неизменённый объект с тем же wc_id
+        linked_wc_ids = sorted(wc_ids | ms_wc_ids)
+        linked_wc_id_set = set(linked_wc_ids)
+        if not linked_wc_ids:
+            return
+        for i in range(0, len(linked_wc_ids), self.MS_FILTER_LIMIT):
+            wc_id_filter = Filter()
+            for wc_id in linked_wc_ids[i:i + self.MS_FILTER_LIMIT]:
+                wc_id_filter += Filter.eq(wc_id_href, wc_id)
+            for ms_product in self.__context.to_records(gen_import_products(import_flag_href, filters=wc_id_filter)):
+                if ms_product.href not in ms_hrefs:
+                    ms_hrefs.add(ms_product.href)
+                    self.ms_products.append(ms_product)
+        for ms_bundle in self.__context.get_ms_bundles():
+            if self.__get_wc_id_value(ms_bundle) not in linked_wc_id_set:
                 continue
-            self.ms_bundles.append(ms_bundle)
+            if ms_bundle.href not in ms_hrefs:
+                ms_hrefs.add(ms_bundle.href)
+                self.ms_bundles.append(ms_bundle)
+
+    def __load_retried(self, import_flag_href):
+        """добавляет объекты МС, которые не удалось синхронизировать в прошлый раз"""
+        loaded_hrefs = set(ms_object.href for ms_object in self.ms_products + self.ms_bundles)
+        ms_ids = {Product.get_typename(): [], Bundle.get_typename(): []}  # {тип: [id]}
+        for ms_href in sorted(self.__retry_ms_hrefs - loaded_hrefs):
+            ms_type, ms_id = ms_href.rsplit('/', 2)[1:]
+            if ms_type in ms_ids:
+                ms_ids[ms_type].append(ms_id)
+        counter = 0
+        for ms_type, ms_type_ids in ms_ids.items():
+            for i in range(0, len(ms_type_ids), self.MS_FILTER_LIMIT):
+                id_filter = Filter()
+                for ms_id in ms_type_ids[i:i + self.MS_FILTER_LIMIT]:
+                    id_filter += Filter.eq('id', ms_id)
+                if ms_type == Product.get_typename():
+                    ms_records = self.__context.to_records(gen_import_products(import_flag_href, filters=id_filter))
+                    self.ms_products += ms_records
+                else:
+                    ms_records = self.__context.to_records(gen_import_bundles(filters=id_filter))
+                    self.ms_bundles += ms_records
+                counter += len(ms_records)
+        if counter:
+            logging.info("Incremental syncro: {} MS objects failed last time retried".format(counter))
 
-        self.employee_for_tasks = Employee.request_by_id(EMPLOYEE_ID)
+    def get_failed_ms_hrefs(self):
+        """объекты МС, которые не удалось синхронизировать в этом запуске"""
+        with self.__failed_lock:
+            return sorted(self.__failed_ms_hrefs)
 
-    def __create_uniq_task(self, desc):
-        for task in Task.gen_list():
-            if task.get_description() == desc:
-                break
-        else:
-            task = Task({
-                'description': str(desc),
-                'assignee': {'meta': self.employee_for_tasks.get_meta().get_json()}
-            })
-            task.create_new()
-
-    def __get_wc_product_by_id(self, wc_id):
-        for wc_product in self.wc_products:
-            if wc_product['id'] == int(wc_id):
-                return wc_product
-        return None
+    def is_complete(self) -> bool:
+        """False, если стадия прервалась и неизвестно, какие объекты не синхронизированы"""
+        return self.__complete
+
+    def __add_failed(self, ms_objects):
+        with self.__failed_lock:
+            self.__failed_ms_hrefs.update(ms_object.href for ms_object in ms_objects)
+
+    @staticmethod
+    def __gen_wc_records(filters):
+        return [WcProductRecord.from_json(wc_product)
+                for wc_product in WcApi.gen_all_wc('products', filters=filters, fields=WcProductRecord.FIELDS)]
+
+    @staticmethod
+    def __get_wc_id_value(ms_record: MsAssortmentRecord):
+        try:
+            return int(ms_record.wc_id)
+        except (TypeError, ValueError):
+            return None
 
     def find_duplicate_wc_products(self):
         """
         ищет повторяющиеся продукты и пишет о них в лог
         """
-        dist_of_products = {}
-
-        for ms_product in self.ms_products:
-            wc_id = ms_product.get_attribute_by_name(WC_ID_ATTR_NAME)
-            if wc_id is None:
-                continue
-            wc_id = wc_id.get_value()
-
-            ms_id_list = dist_of_products.setdefault(wc_id, [])
-            if ms_product not in ms_id_list:
-                ms_id_list.append(ms_product)
-
-        for ms_bundle in self.ms_bundles:
-            wc_id = ms_bundle.get_attribute_by_name(WC_ID_ATTR_NAME)
-            if wc_id is None:
-                continue
-            wc_id = wc_id.get_value()
-
-            ms_id_list = dist_of_products.setdefault(wc_id, [])
-            if ms_bundle not in ms_id_list:
-                ms_id_list.append(ms_bundle)
-
-        for wc_id, ms_product_list in dist_of_products.items():
-            if len(ms_product_list) > 1:
-                warn_str = "Product duplicates [{}]:\n\t{}".format(
-                    wc_id,
-                    "\n\t".join("{} ({})".format(product.get_id(), product.get_name()) for product in ms_product_list))
-                self.__create_uniq_task(warn_str)
-                logging.warning(warn_str)
-
-        return
+        duplicates = self.__filter_wc_ids(self.__index.duplicates)
+        for wc_id in duplicates:
+            ms_product_list = self.__index.duplicates[wc_id]
+            warn_str = "Product duplicates [{}]:\n\t{}".format(
+                wc_id,
+                "\n\t".join("{} ({})".format(product.id, product.name) for product in ms_product_list))
+            self.__task_registry.add_task(warn_str)
+            logging.warning(warn_str)
+        self.__task_registry.flush()
+        if self.__coordinator is not None:
+            self.__coordinator.publish('duplicates', duplicates)
 
     def find_unsync_wc_products(self):
         """Ищет несинхронизированные продукты WC и пишет о них в лог"""
+        unsynced = {wc_product.id: wc_product for wc_product in self.__index.unsynced}
+        unsynced_ids = self.__filter_wc_ids(unsynced)
+        for wc_id in unsynced_ids:
+            warn_str = "WC Product unsyncronized: [{}] {}".format(wc_id, unsynced[wc_id].name)
+            self.__task_registry.add_task(warn_str)
+            logging.warning(warn_str)
 
-        assortment_wc_ids = set()
-        for ms_product in self.ms_products:
-            wc_id = ms_product.get_attribute_by_name(WC_ID_ATTR_NAME)
-            if wc_id is None:
-                continue
-            assortment_wc_ids.add(int(ms_product.get_attribute_by_name(WC_ID_ATTR_NAME).get_value()))
-
-        for ms_bundle in self.ms_bundles:
-            ms_bundle: Bundle
-            wc_id = ms_bundle.get_attribute_by_name(WC_ID_ATTR_NAME)
-            if wc_id is None:
-                continue
-            assortment_wc_ids.add(int(wc_id.get_value()))
-
-        for wc_product in self.wc_products:
-            wc_id = wc_product.get('id')
-            if wc_id not in assortment_wc_ids:
-                warn_str = "WC Product unsyncronized: [{}] {}".format(wc_id, wc_product.get('name'))
-                self.__create_uniq_task(warn_str)
-                logging.warning(warn_str)
-                continue
-            else:
-                assortment_wc_ids.remove(wc_id)
-
-        for wc_id in assortment_wc_ids:
+        orphaned = self.__filter_wc_ids(self.__index.orphaned)
+        for wc_id in orphaned:
             warn_str = "WC Product with \'{}\' id not found".format(wc_id)
-            self.__create_uniq_task(warn_str)
+            self.__task_registry.add_task(warn_str)
             logging.warning(warn_str)
+        self.__task_registry.flush()
+        if self.__coordinator is not None:
+            self.__coordinator.publish('unsynced', unsynced_ids)
+            self.__coordinator.publish('orphaned', orphaned)
+
+    def __filter_wc_ids(self, wc_ids):
+        """wc_id части каталога. Индекс зеркала строится по всему каталогу, индекс записей - уже по части"""
+        if self.__coordinator is None:
+            return list(wc_ids)
+        return [wc_id for wc_id in wc_ids if self.__coordinator.shard.contains_wc_id(wc_id)]
 
     def create_new_products(self):
         """Создаёт новые продукты"""
-
+        candidates = []
         for ms_product in self.ms_products:
-            ms_product: Product
+            ms_product: MsAssortmentRecord
             try:
-                if ms_product.get_attribute_by_name(WC_ID_ATTR_NAME) is not None:
+                if self.__index.is_linked(ms_product):
                     continue
 
-                wc_put_data = {
-                    'name': ms_product.get_name(),
+                wc_post_data = {
+                    'name': ms_product.name,
                     'status': 'draft'
                 }
 
-                if ms_product.has_variants():
-                    wc_put_data['type'] = "variable"
+                if ms_product.has_variants:
+                    wc_post_data['type'] = "variable"
                     continue
                 else:
-                    wc_put_data['type'] = "simple"
-
-                wc_put_data.update(self.__get_wc_put_data_prices(ms_product))
-
-                wc_json = WcApi.post('products', data=wc_put_data)
-                response = MSApi.auch_put(
-                    "entity/product/{}".format(ms_product.get_id()),
-                    json={
-                        "attributes": [
-                            {
-                                'meta': self.__wc_id_attribute.get_meta().get_json(),
-                                "value": str(wc_json.get('id'))
-                            }
-                        ]
-                    })
-                error_handler(response)
-                logging.info("WC Product '{}' created".format(ms_product.get_name()))
+                    wc_post_data['type'] = "simple"
+
+                wc_post_data.update(get_price_put_data(ms_product.get_prices()))
+                candidates.append((ms_product, wc_post_data))
 
                 # if ms_product.has_variants():
                 #     self.__create_new_wc_attributes(ms_product)
 
             except MSApiHttpException as e:
                 logging.error(str(e))
+                self.__add_failed([ms_product])
             except SyncroException as e:
                 logging.error(str(e))
-            except WcApiException as e:
-                logging.error(str(e))
+                self.__add_failed([ms_product])
+
+        self.__create_linked_wc_products(Product.get_typename(), candidates)
 
     def create_new_bundles(self):
         """Создаёт новые комплекты как обычные продукта WC"""
-
+        candidates = []
         # FIXME исправить на фильтр когда зафиксят баг
         for ms_bundle in self.ms_bundles:
             try:
-                ms_bundle: Bundle
-                if ms_bundle.get_attribute_by_name(WC_ID_ATTR_NAME) is not None:
+                ms_bundle: MsAssortmentRecord
+                if self.__index.is_linked(ms_bundle):
                     continue
 
-                wc_put_data = {
-                    'name': ms_bundle.get_name(),
+                wc_post_data = {
+                    'name': ms_bundle.name,
                     'status': 'draft',
                     'type': 'simple'
                 }
 
-                wc_put_data.update(self.__get_wc_put_data_prices(ms_bundle))
-
-                wc_json = WcApi.post('products', data=wc_put_data)
-                response = MSApi.auch_put(
-                    "entity/bundle/{}".format(ms_bundle.get_id()),
-                    json={
-                        "attributes": [
-                            {
-                                'meta': self.__wc_id_attribute.get_meta().get_json(),
-                                "value": str(wc_json.get('id'))
-                            }
-                        ]
-                    })
-                error_handler(response)
-                logging.info("WC Product '{}' created".format(ms_bundle.get_name()))
+                wc_post_data.update(get_price_put_data(ms_bundle.get_prices()))
+                candidates.append((ms_bundle, wc_post_data))
 
             except MSApiHttpException as e:
                 logging.error(str(e))
+                self.__add_failed([ms_bundle])
             except SyncroException as e:
                 logging.error(str(e))
-            except WcApiException as e:
-                logging.error(str(e))
+                self.__add_failed([ms_bundle])
+
+        self.__create_linked_wc_products(Bundle.get_typename(), candidates)
+
+    def __create_linked_wc_products(self, ms_entity, candidates):
+        """создаёт товары WC пакетами, затем записывает их id в объекты МС массовым запросом.
+        Созданные id сохраняются локально до успешной записи в МС"""
+        links = []  # [(ms_object, wc_id)]
+        for i in range(0, len(candidates), WcBatchWriter.BATCH_LIMIT):
+            wc_writer = WcBatchWriter('products')
+            for ms_object, wc_post_data in candidates[i:i + WcBatchWriter.BATCH_LIMIT]:
+                wc_id = self.__pending_links.get(ms_object.href)
+                if wc_id is not None:
+                    logging.info("WC Product '{}' already created [{}]".format(ms_object.name, wc_id))
+                    links.append((ms_object, wc_id))
+                    continue
+                wc_writer.create(wc_post_data, source=ms_object)
+
+            created = {}
+            created_wc_products = []
+            for ms_object, wc_json, error in wc_writer.flush():
+                if error is not None:
+                    logging.error("WC Product '{}' creation failed: {}".format(ms_object.name, error))
+                    self.__add_failed([ms_object])
+                    continue
+                if wc_json is None:
+                    continue
+                created[ms_object.href] = wc_json.get('id')
+                created_wc_products.append(wc_json)
+                links.append((ms_object, wc_json.get('id')))
+                logging.info("WC Product '{}' created".format(ms_object.name))
+            self.__pending_links.add(created)
+            self.__context.add_wc_products(created_wc_products)
+
+        for i in range(0, len(links), self.MS_BATCH_LIMIT):
+            self.__write_back_wc_ids(ms_entity, links[i:i + self.MS_BATCH_LIMIT])
+
+    def __write_back_wc_ids(self, ms_entity, links):
+        """записывает wc_id в объекты МС одним запросом"""
+        try:
+            response = MSApi.auch_post("entity/{}".format(ms_entity), json=[
+                {
+                    'meta': ms_object.get_meta_json(),
+                    'attributes': [
+                        {
+                            'meta': self.__wc_id_attribute.get_meta().get_json(),
+                            'value': str(wc_id)
+                        }
+                    ]
+                } for ms_object, wc_id in links])
+            error_handler(response)
+        except MSApiHttpException as e:
+            logging.error("{} {} wc_id write-back failed: {}".format(len(links), ms_entity, str(e)))
+            self.__add_failed(ms_object for ms_object, wc_id in links)
+            return
+
+        linked = []
+        for (ms_object, wc_id), ms_json in zip(links, response.json()):
+            if 'errors' in ms_json:
+                logging.error("'{}' wc_id write-back failed: {}".format(ms_object.name, ms_json['errors']))
+                self.__add_failed([ms_object])
+                continue
+            linked.append((ms_object, wc_id))
+        self.__pending_links.remove([ms_object.href for ms_object, wc_id in linked])
+        self.__context.add_wc_ids(linked)
 
     @staticmethod
     def create_new_characteristics():
@@ -252,21 +402,22 @@ class ProductsSyncro:
 
     def sync_products(self):
         """Синхронизирует товары"""
+        wc_writer = WcBatchWriter('products')
         try:
+            pairs = []  # [(MsAssortmentRecord, WcProductRecord)]
             for ms_product in self.ms_products:
-                ms_product: Product
+                ms_product: MsAssortmentRecord
                 try:
-                    wc_id = ms_product.get_attribute_by_name(WC_ID_ATTR_NAME)
+                    wc_id = self.__index.get_wc_id(ms_product)
                     if wc_id is None:
                         continue
-                    wc_id = wc_id.get_value()
 
-                    wc_product = self.__get_wc_product_by_id(wc_id)
+                    wc_product = self.__index.get_wc_product(wc_id)
                     if wc_product is None:
                         raise SyncroException("[{}] WC Product not found".format(wc_id))
-                    wc_type = wc_product.get('type')
-                    if wc_product.get('type') == 'variable':
-                        if not ms_product.has_variants():
+                    wc_type = wc_product.type
+                    if wc_type == 'variable':
+                        if not ms_product.has_variants:
                             # TODO change to simple
                             raise SyncroException(
                                 "[{}] Change variant product to simple is not implemented now".format(wc_id))
@@ -274,116 +425,113 @@ class ProductsSyncro:
                         raise SyncroException("[{}] Unsupported product type: {}".format(wc_id, wc_type))
                     elif wc_type != 'simple':
                         raise SyncroException("[{}] Unsupported product type: {}".format(wc_id, wc_type))
-                    elif ms_product.has_variants():
+                    elif ms_product.has_variants:
                         # TODO change to variant
                         raise SyncroException(
                             "[{}] Change simple product to variant is not implemented now".format(wc_id))
 
-                    wc_put_data = {}
-
-                    wc_put_data.update(self.__sync_name(ms_product, wc_product))
-                    wc_put_data.update(self.__sync_prices(ms_product, wc_product))
-
-                    if wc_put_data:
-                        WcApi.put(f'products/{wc_product.get("id")}', data=wc_put_data)
+                    pairs.append((ms_product, wc_product))
 
                 except SyncroException as e:
                     logging.error(str(e))
-                except WcApiException as e:
-                    logging.error(str(e))
+                    self.__add_failed([ms_product])
+
+            self.__update_wc_products(wc_writer, pairs)
 
         except MSApiHttpException as e:
             logging.error(str(e))
+            self.__complete = False
+        finally:
+            self.__log_batch_errors(wc_writer.flush())
 
     def sync_bundles(self):
         """Синхронизирует комплекты"""
+        wc_writer = WcBatchWriter('products')
         try:
+            pairs = []  # [(MsAssortmentRecord, WcProductRecord)]
             for ms_bundle in self.ms_bundles:
-                ms_bundle: Bundle
+                ms_bundle: MsAssortmentRecord
                 try:
-                    wc_id = ms_bundle.get_attribute_by_name(WC_ID_ATTR_NAME)
+                    wc_id = self.__index.get_wc_id(ms_bundle)
                     if wc_id is None:
                         continue
-                    wc_id = wc_id.get_value()
 
-                    wc_product = self.__get_wc_product_by_id(wc_id)
+                    wc_product = self.__index.get_wc_product(wc_id)
                     if wc_product is None:
                         raise SyncroException("[{}] WC Product not found".format(wc_id))
-                    wc_type = wc_product.get('type')
-                    if wc_product.get('type') == 'variable':
+                    wc_type = wc_product.type
+                    if wc_type == 'variable':
                         # TODO sync variant
                         raise SyncroException("[{}] Bundle cannot be variant".format(wc_id, wc_type))
                     elif wc_type != 'simple':
                         raise SyncroException("[{}] Unsupported product type: {}".format(wc_id, wc_type))
 
-                    wc_put_data = {}
-
-                    wc_put_data.update(self.__sync_name(ms_bundle, wc_product))
-                    wc_put_data.update(self.__sync_prices(ms_bundle, wc_product))
-
-                    if wc_put_data:
-                        WcApi.put(f'products/{wc_id}', data=wc_put_data)
+                    pairs.append((ms_bundle, wc_product))
 
                 except SyncroException as e:
                     logging.error(str(e))
-                except WcApiException as e:
-                    logging.error(str(e))
+                    self.__add_failed([ms_bundle])
+
+            self.__update_wc_products(wc_writer, pairs)
 
         except MSApiHttpException as e:
             logging.error(str(e))
+            self.__complete = False
+        finally:
+            self.__log_batch_errors(wc_writer.flush())
+
+    def __update_wc_products(self, wc_writer, pairs):
+        """обновляет имена и цены связанных товаров WC.
+        Цены всех пар сравниваются одним проходом по столбцам цен МС и WC"""
+        priced = []
+        ms_prices = []
+        for ms_object, wc_product in pairs:
+            try:
+                ms_prices.append(ms_object.get_prices())
+            except SyncroException as e:
+                logging.error(str(e))
+                self.__add_failed([ms_object])
+                continue
+            priced.append((ms_object, wc_product))
+
+        price_changes = diff_prices(ms_prices, [(wc_product.regular_price, wc_product.sale_price)
+                                                for ms_object, wc_product in priced])
+        for i, (ms_object, wc_product) in enumerate(priced):
+            wc_put_data = self.__sync_name(ms_object, wc_product)
+            if i in price_changes:
+                self.__log_price_changes(wc_product, price_changes[i])
+                wc_put_data.update(price_changes[i])
+            if wc_put_data:
+                wc_writer.update(wc_product.id, wc_put_data, source=ms_object)
+
+    def __log_batch_errors(self, batch_results):
+        """пишет в лог ошибки пакетной записи WC"""
+        for ms_object, wc_json, error in batch_results:
+            if error is None:
+                continue
+            logging.error("WC Product update failed for \'{}\' ({}): {}".format(ms_object.name, ms_object.id, error))
+            self.__add_failed([ms_object])
 
     @staticmethod
-    def __sync_name(ms_object, wc_object):
+    def __sync_name(ms_object: MsAssortmentRecord, wc_object: WcProductRecord):
         """Возвращает данные для обновления имени WC"""
-        ms_name = ms_object.get_name()
-        wc_name = wc_object.get('name')
+        ms_name = ms_object.name
+        wc_name = wc_object.name
         if ms_name != wc_name:
             logging.info("WC product [{}] name changed from \'{}\' to \'{}\'"
-                         .format(wc_object.get('id'), wc_name, ms_name))
+                         .format(wc_object.id, wc_name, ms_name))
             return {'name': ms_name}
         else:
             return {}
 
-    def __sync_prices(self, ms_object, wc_product):
-        """Возвращает данные для обновления цен WC"""
-        wc_regular_price, wc_sale_price = get_wc_prices(wc_product)
-        wc_put_data = {}
-        ms_regular_price = DiscountHandler.get_default_price_value(ms_object)
-        ms_sale_price = DiscountHandler.get_actual_price(ms_object, self.__sale_group_tag)
-        if ms_regular_price != wc_regular_price:
-            wc_put_data['regular_price'] = str(ms_regular_price)
+    @staticmethod
+    def __log_price_changes(wc_product: WcProductRecord, wc_put_data):
+        """пишет в лог изменения цен WC"""
+        if 'regular_price' in wc_put_data:
             logging.info("WC product [{}] regular price changed from {} to {}"
-                         .format(wc_product.get('id'), wc_regular_price, ms_regular_price))
-
-        if ms_sale_price == ms_regular_price:
-            ms_sale_price = None
-
-        if ms_sale_price != wc_sale_price:
-            if ms_sale_price is None:
-                wc_put_data['sale_price'] = ''
-                logging.info("WC product [{}] sale price removed".format(wc_product.get('id')))
-            else:
-                wc_put_data['sale_price'] = str(ms_sale_price)
-                logging.info("WC product [{}] sale price changed from {} to {}"
-                             .format(wc_product.get('id'), wc_sale_price, ms_sale_price))
-        return wc_put_data
-
-    def __get_wc_put_data_prices(self, ms_object,
-                                 wc_regular_price: int = None,
-                                 wc_sale_price: int = None):
-        """вытаскивает из объекта МС обычную и скидочную цену, сравнивает с ценами WC
-        и возвращает цены для отправки на сайт"""
-        wc_put_data = {}
-        ms_regular_price = DiscountHandler.get_default_price_value(ms_object)
-        ms_sale_price = DiscountHandler.get_actual_price(ms_object, self.__sale_group_tag)
-        if ms_regular_price != wc_regular_price:
-            wc_put_data['regular_price'] = str(ms_regular_price)
-        if ms_sale_price == ms_regular_price:
-            ms_sale_price = None
-
-        if ms_sale_price != wc_sale_price:
-            if ms_sale_price is None:
-                wc_put_data['sale_price'] = ''
-            else:
-                wc_put_data['sale_price'] = str(ms_sale_price)
-        return wc_put_data
+                         .format(wc_product.id, wc_product.regular_price, wc_put_data['regular_price']))
+        if wc_put_data.get('sale_price') == '':
+            logging.info("WC product [{}] sale price removed".format(wc_product.id))
+        elif 'sale_price' in wc_put_data:
+            logging.info("WC product [{}] sale price changed from {} to {}"
+                         .format(wc_product.id, wc_product.sale_price, wc_put_data['sale_price']))
@@ -0,0 +1,60 @@
+import logging
+
+from settings import WC_ID_ATTR_NAME
+
+
+class ReconciliationIndex:
+    """индекс сопоставления товаров WC и ассортимента МС.
+    Строится за один проход по каждой стороне, все этапы синхронизации читают из него.
+    Работает с компактными записями WcProductRecord и MsAssortmentRecord"""
+
+    def __init__(self, wc_products, ms_objects):
+        self.wc_products_by_id = {}  # wc_id: wc_product
+        self.ms_objects_by_wc_id = {}  # wc_id: [ms_object]
+        self.unlinked = []  # объекты МС без wc_id
+        self.__wc_ids_by_href = {}  # ms_href: wc_id (None если wc_id некорректный)
+
+        for wc_product in wc_products:
+            self.wc_products_by_id[wc_product.id] = wc_product
+
+        for ms_object in ms_objects:
+            ms_href = ms_object.href
+            if ms_href in self.__wc_ids_by_href:
+                continue
+            if ms_object.wc_id is None:
+                self.unlinked.append(ms_object)
+                continue
+            try:
+                wc_id = int(ms_object.wc_id)
+            except (TypeError, ValueError):
+                logging.error("Invalid {} \'{}\' in \'{}\' ({})".format(
+                    WC_ID_ATTR_NAME, ms_object.wc_id, ms_object.name, ms_object.id))
+                self.__wc_ids_by_href[ms_href] = None
+                continue
+            self.__wc_ids_by_href[ms_href] = wc_id
+            self.ms_objects_by_wc_id.setdefault(wc_id, []).append(ms_object)
+
+        # несколько объектов МС ссылаются на один товар WC
+        self.duplicates = {wc_id: ms_object_list
+                           for wc_id, ms_object_list in self.ms_objects_by_wc_id.items()
+                           if len(ms_object_list) > 1}
+        # товары WC, на которые не ссылается ни один объект МС
+        self.unsynced = [wc_product
+                         for wc_id, wc_product in self.wc_products_by_id.items()
+                         if wc_id not in self.ms_objects_by_wc_id]
+        # wc_id из МС, для которых нет товара WC
+        self.orphaned = [wc_id
+                         for wc_id in self.ms_objects_by_wc_id
+                         if wc_id not in self.wc_products_by_id]
+
+    def is_linked(self, ms_object) -> bool:
+        """проверяет, заполнен ли у объекта МС wc_id"""
+        return ms_object.href in self.__wc_ids_by_href
+
+    def get_wc_id(self, ms_object):
+        """возвращает wc_id объекта МС или None"""
+        return self.__wc_ids_by_href.get(ms_object.href)
+
+    def get_wc_product(self, wc_id):
+        """возвращает товар WC по id или None"""
+        return self.wc_products_by_id.get(int(wc_id))
@@ -0,0 +1,133 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+# ответы, после которых запрос можно повторить
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# ответы, означающие, что сервер просит снизить нагрузку
+THROTTLE_STATUSES = (429, 503)
+
+
+def get_retry_after(response):
+    """значение заголовка Retry-After в секундах или None"""
+    if response is None:
+        return None
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryStats:
+    """счётчики повторов запросов за время запуска"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+        self.gave_up = 0
+        self.backoff_seconds = 0.0
+
+    def add(self, **counters):
+        with self.__lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def to_json(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'failed': self.failed,
+            'gave_up': self.gave_up,
+            'backoff_seconds': round(self.backoff_seconds, 3),
+        }
+
+    def to_str(self):
+        return "{requests} requests, {retries} retries, {throttled} throttled, {failed} failed, " \
+               "{gave_up} gave up, {backoff_seconds}s in backoff".format(**self.to_json())
+
+
+class RetryPolicy:
+    """экспоненциальная задержка со случайным разбросом (full jitter).
+    Retry-After сервера имеет приоритет над расчётной задержкой"""
+
+    def __init__(self, max_retries=5, backoff_base=0.5, backoff_max=30.0, retry_after_max=120.0):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+        self.stats = RetryStats()
+
+    def is_retryable(self, response, idempotent: bool) -> bool:
+        """response равен None, если запрос не выполнен (ошибка соединения).
+        429 сервер отклоняет до обработки, поэтому он повторяется и для неидемпотентных запросов"""
+        if response is None:
+            return idempotent
+        if response.status_code == 429:
+            return True
+        return idempotent and response.status_code in RETRY_STATUSES
+
+    def get_delay(self, attempt, response=None):
+        """задержка перед повтором номер attempt (с нуля)"""
+        retry_after = get_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.retry_after_max) + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+class AimdLimiter:
+    """ограничение числа одновременных запросов: +1 за окно успешных ответов,
+    уменьшение вдвое при ответе сервера о перегрузке (не чаще раза в decrease_interval)"""
+
+    def __init__(self, max_limit, min_limit=1, decrease_factor=0.5, decrease_interval=1.0):
+        self.max_limit = max(int(max_limit), 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.limit = float(self.max_limit)
+        self.lowest_limit = self.limit
+        self.__in_flight = 0
+        self.__last_decrease = None
+        self.__condition = threading.Condition()
+
+    def __enter__(self):
+        with self.__condition:
+            while self.__in_flight >= int(self.limit):
+                self.__condition.wait()
+            self.__in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.__condition:
+            self.__in_flight -= 1
+            self.__condition.notify_all()
+
+    def on_success(self):
+        with self.__condition:
+            if self.limit < self.max_limit:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+                self.__condition.notify_all()
+
+    def on_throttle(self):
+        with self.__condition:
+            now = time.monotonic()
+            if self.__last_decrease is not None and now - self.__last_decrease < self.decrease_interval:
+                return
+            self.__last_decrease = now
+            self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+            self.lowest_limit = min(self.lowest_limit, self.limit)
@@ -0,0 +1,157 @@
+import threading
+
+from MSApi import Employee, Product
+
+from AssortmentIndex import AssortmentIndex, gen_import_bundles, gen_import_products
+from CatalogRecords import MsAssortmentRecord, WcProductRecord
+from CounterpartyIndex import CounterpartyIndex
+from OrderNumberAllocator import OrderNumberAllocator
+from PriceEngine import PriceEngine
+from TaskRegistry import TaskRegistry
+from WcApi import WcApi
+from exceptions import SyncroException
+from settings import EMPLOYEE_ID, IMPORT_FLAG_ATTR_NAME, WC_ID_ATTR_NAME
+
+
+class RunContext:
+    """данные, общие для синхронизаций одного запуска.
+    Каждый набор загружается при первом обращении и только один раз, в том числе
+    при одновременном обращении из параллельных стадий. Записи стадий (новые связи wc_id,
+    созданные товары WC, контрагенты, задачи) обновляют общую копию"""
+
+    def __init__(self, mirror=None, sale_group_tag=None):
+        """mirror - локальное зеркало каталогов (CatalogMirror), из которого строятся индексы;
+        sale_group_tag - группа покупателей, для которой рассчитываются цены записей ассортимента"""
+        self.__mirror = mirror
+        self.__sale_group_tag = sale_group_tag
+        self.__values = {}  # {str: object}
+        self.__wc_product_fields = set()  # поля загружаемого каталога WC, None - все
+        self.__locks = {}  # {str: threading.Lock}
+        self.__lock = threading.Lock()
+
+    def invalidate(self, *names):
+        """сбрасывает наборы данных, они будут загружены заново при следующем обращении"""
+        with self.__lock:
+            for name in names:
+                self.__values.pop(name, None)
+
+    def get_product_attributes(self):
+        return self.__get('product_attributes', lambda: list(Product.gen_attributes_list()))
+
+    def get_product_attribute(self, name):
+        for attr in self.get_product_attributes():
+            if attr.get_name() == name:
+                return attr
+        raise SyncroException("product attribute \'{}\' not found".format(name))
+
+    def get_import_flag_href(self):
+        return self.get_product_attribute(IMPORT_FLAG_ATTR_NAME).get_meta().get_href()
+
+    def get_wc_id_href(self):
+        return self.get_product_attribute(WC_ID_ATTR_NAME).get_meta().get_href()
+
+    def get_employee(self):
+        return self.__get('employee', lambda: Employee.request_by_id(EMPLOYEE_ID))
+
+    def get_task_registry(self) -> TaskRegistry:
+        """реестр задач запуска: задачи, созданные одной стадией, не создаются повторно другой"""
+        return self.__get('task_registry', lambda: TaskRegistry(self.get_employee()))
+
+    def set_task_registry(self, task_registry: TaskRegistry):
+        with self.__lock:
+            self.__values['task_registry'] = task_registry
+
+    def get_order_number_allocator(self) -> OrderNumberAllocator:
+        """номера новых заказов МС, общие для всех синхронизаций заказов запуска"""
+        return self.__get('order_number_allocator', OrderNumberAllocator)
+
+    def set_order_number_allocator(self, order_number_allocator: OrderNumberAllocator):
+        with self.__lock:
+            self.__values['order_number_allocator'] = order_number_allocator
+
+    def get_ms_products(self) -> [MsAssortmentRecord]:
+        """импортируемые товары МС"""
+        return self.__get('ms_products', lambda: self.to_records(gen_import_products(self.get_import_flag_href())))
+
+    def get_ms_bundles(self) -> [MsAssortmentRecord]:
+        """импортируемые комплекты МС"""
+        return self.__get('ms_bundles', lambda: self.to_records(gen_import_bundles()))
+
+    def to_records(self, ms_objects) -> [MsAssortmentRecord]:
+        """переводит объекты МС в записи по мере загрузки, объекты не накапливаются в памяти"""
+        price_engine = None if self.__sale_group_tag is None else self.get_price_engine()
+        return [MsAssortmentRecord.from_ms_object(ms_object, price_engine) for ms_object in ms_objects]
+
+    def get_price_engine(self) -> PriceEngine:
+        """расчёт цен для группы покупателей запуска: скидки и типы цен загружаются один раз"""
+        return self.__get('price_engine', lambda: PriceEngine.load(self.__sale_group_tag))
+
+    def require_wc_product_fields(self, fields):
+        """заявляет поля товаров WC, нужные стадии (None - все поля). Каталог загружается
+        с объединением заявленных полей, если он уже загружен без нужных полей - загружается заново"""
+        with self.__lock:
+            if self.__wc_product_fields is None:
+                return
+            if fields is None:
+                self.__wc_product_fields = None
+            elif set(fields) <= self.__wc_product_fields:
+                return
+            else:
+                self.__wc_product_fields |= set(fields)
+            self.__values.pop('wc_products', None)
+
+    def get_wc_records(self) -> [WcProductRecord]:
+        """каталог WC в виде компактных записей"""
+        return self.__get('wc_records', lambda: [WcProductRecord.from_json(wc_product) for wc_product
+                                                 in WcApi.gen_all_wc_products(fields=WcProductRecord.FIELDS)])
+
+    def get_wc_products(self, fields=None):
+        """каталог WC с полями fields и заявленными ранее (None - все поля)"""
+        self.require_wc_product_fields(fields)
+        return self.__get('wc_products', lambda: list(WcApi.gen_all_wc_products(fields=self.__wc_product_fields)))
+
+    def get_assortment_index(self) -> AssortmentIndex:
+        """индекс wc_id -> объекты МС, строится из общих списков товаров и комплектов"""
+        def load():
+            if self.__mirror is not None:
+                return AssortmentIndex(self.get_wc_id_href(), self.get_import_flag_href(), self.__mirror)
+            return AssortmentIndex(self.get_wc_id_href(), self.get_import_flag_href(),
+                                   ms_objects=lambda: self.get_ms_products() + self.get_ms_bundles())
+        return self.__get('assortment_index', load)
+
+    def get_counterparty_index(self) -> CounterpartyIndex:
+        return self.__get('counterparty_index', CounterpartyIndex)
+
+    def add_wc_products(self, wc_products):
+        """добавляет созданные товары WC (json) в загруженный каталог"""
+        with self.__lock:
+            loaded = self.__values.get('wc_products')
+            loaded_records = self.__values.get('wc_records')
+        if loaded is not None:
+            loaded.extend(wc_products)
+        if loaded_records is not None:
+            loaded_records.extend(WcProductRecord.from_json(wc_product) for wc_product in wc_products)
+
+    def add_wc_ids(self, links):
+        """отражает записанные в МС связи [(MsAssortmentRecord, wc_id)] в записях и индексе ассортимента"""
+        with self.__lock:
+            assortment_index = self.__values.get('assortment_index')
+        for ms_record, wc_id in links:
+            ms_record.wc_id = str(wc_id)
+            if assortment_index is not None:
+                assortment_index.add(wc_id, ms_record)
+
+    def __get(self, name, load):
+        with self.__lock:
+            if name in self.__values:
+                return self.__values[name]
+            name_lock = self.__locks.setdefault(name, threading.Lock())
+        # загрузка идёт вне общей блокировки, чтобы разные наборы загружались параллельно
+        with name_lock:
+            with self.__lock:
+                if name in self.__values:
+                    return self.__values[name]
+            value = load()
+            with self.__lock:
+                self.__values[name] = value
+            return value
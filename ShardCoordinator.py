@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import zlib
+from datetime import datetime, timezone
+
+from FileLock import FileLock
+from exceptions import SyncroException
+
+
+class Shard:
+    """часть каталога i/N (i от 0). Товар WC относится к части по своему id, объект МС - по wc_id,
+    а без корректного wc_id - по id МС. Поэтому связанные товары, дубликаты одного wc_id
+    и несинхронизированные товары WC всегда попадают в одну часть"""
+
+    def __init__(self, index: int, count: int):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError("invalid shard {}/{}".format(index, count))
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value: str):
+        """часть из строки 'i/N', бросает ValueError"""
+        index, separator, count = value.partition('/')
+        if not separator:
+            raise ValueError("invalid shard \'{}\', expected i/N".format(value))
+        return cls(int(index), int(count))
+
+    def __str__(self):
+        return "{}/{}".format(self.index, self.count)
+
+    def is_leader(self) -> bool:
+        """первая часть выполняет работу, общую для всего каталога"""
+        return self.index == 0
+
+    def contains(self, key) -> bool:
+        """стабильный между процессами и хостами хэш ключа"""
+        return zlib.crc32(str(key).encode('utf-8')) % self.count == self.index
+
+    def contains_wc_id(self, wc_id) -> bool:
+        return self.contains(int(wc_id))
+
+    def contains_ms_record(self, ms_record) -> bool:
+        try:
+            return self.contains(int(ms_record.wc_id))
+        except (TypeError, ValueError):
+            return self.contains(ms_record.id)
+
+    def filter_ms_records(self, ms_records):
+        return [ms_record for ms_record in ms_records if self.contains_ms_record(ms_record)]
+
+    def filter_wc_records(self, wc_records):
+        return [wc_record for wc_record in wc_records if self.contains_wc_id(wc_record.id)]
+
+
+class ShardCoordinator:
+    """согласует процессы (или хосты с общим каталогом), делящие синхронизацию ассортимента на части.
+    На время запуска часть захватывается файловой блокировкой, поэтому две копии одной части
+    не выполняются одновременно, как и части разных разбиений (i/N и j/M). Результаты проверок
+    дубликатов и несинхронизированных товаров каждой части сохраняются и сводятся по всем частям.
+    Без каталога части не захватываются, результаты не сохраняются"""
+
+    LAYOUT_FILE = 'shards.json'
+
+    def __init__(self, path, shard: Shard):
+        self.shard = shard
+        self.__path = path
+        self.__claim = None  # FileLock захваченной части
+        self.__started = datetime.now(timezone.utc)
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __enter__(self):
+        self.claim()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def claim(self):
+        """захватывает часть, бросает SyncroException, если она или часть другого разбиения уже выполняется"""
+        if self.__path is None:
+            return
+        with FileLock(self.__get_file_path(self.LAYOUT_FILE + '.lock')):
+            layout_count = self.__read_layout_count()
+            if layout_count is not None and layout_count != self.shard.count:
+                for index in range(layout_count):
+                    if self.__is_running(Shard(index, layout_count)):
+                        raise SyncroException("Shard {}/{} is running, shard {} not started".format(
+                            index, layout_count, self.shard))
+                self.__write_json(self.LAYOUT_FILE, {'count': self.shard.count})
+            elif layout_count is None:
+                self.__write_json(self.LAYOUT_FILE, {'count': self.shard.count})
+
+            claim = FileLock(self.__get_file_path(self.__get_shard_file_name(self.shard, '.lock')), blocking=False)
+            try:
+                claim.acquire()
+            except BlockingIOError:
+                raise SyncroException("Shard {} is already running".format(self.shard))
+            self.__claim = claim
+        logging.info("Shard {} claimed".format(self.shard))
+
+    def release(self):
+        if self.__claim is not None:
+            self.__claim.release()
+            self.__claim = None
+
+    def publish(self, name, wc_ids):
+        """сохраняет результат проверки части (wc_id найденных товаров) и пишет в лог сводку по всем частям"""
+        if self.__path is None:
+            return
+        file_name = self.__get_shard_file_name(self.shard, '.json')
+        results = self.__read_json(file_name) or {}
+        if results.get('started') != self.__started.isoformat():
+            results = {'started': self.__started.isoformat()}
+        results[name] = sorted(wc_ids)
+        self.__write_json(file_name, results)
+
+        total = 0
+        reported = 0
+        for index in range(self.shard.count):
+            shard_results = self.__read_json(self.__get_shard_file_name(Shard(index, self.shard.count), '.json'))
+            if shard_results is None or name not in shard_results:
+                continue
+            total += len(shard_results[name])
+            reported += 1
+        logging.info("Shard {}: {} {}, {} in {} of {} shards".format(
+            self.shard, len(wc_ids), name, total, reported, self.shard.count))
+
+    def __is_running(self, shard: Shard):
+        try:
+            with FileLock(self.__get_file_path(self.__get_shard_file_name(shard, '.lock')), blocking=False):
+                return False
+        except BlockingIOError:
+            return True
+
+    def __read_layout_count(self):
+        layout = self.__read_json(self.LAYOUT_FILE)
+        if layout is None:
+            return None
+        return layout.get('count')
+
+    @staticmethod
+    def __get_shard_file_name(shard: Shard, extension):
+        return "shard-{}-of-{}{}".format(shard.index, shard.count, extension)
+
+    def __get_file_path(self, file_name):
+        return os.path.join(self.__path, file_name)
+
+    def __read_json(self, file_name):
+        file_path = self.__get_file_path(file_name)
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with open(file_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("Shard file \'{}\' ignored: {}".format(file_path, str(e)))
+            return None
+
+    def __write_json(self, file_name, data):
+        file_path = self.__get_file_path(file_name)
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, file_path)
@@ -0,0 +1,175 @@
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from HttpMetrics import HttpMetrics
+
+
+class StageSpan:
+    """накопленные замеры одной стадии"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = None  # байты сверх памяти в начале стадии, None - память не измерялась
+        self.profile = None  # cProfile.Profile
+
+
+class StageProfiler:
+    """профилирование стадий синхронизации: время, процессорное время, пик памяти (tracemalloc)
+    и ожидание HTTP (HttpMetrics) каждой стадии, по запросу - cProfile стадии и сводка самых
+    затратных функций. Процессорное время и cProfile учитывают только поток стадии, без пулов
+    запросов. Стадии выполняются параллельно, поэтому пик памяти стадии - наибольший прирост
+    памяти процесса за время стадии. Пока профилирование не включено, span ничего не делает"""
+
+    __enabled = False
+    __trace_memory = False
+    __stats_dir = None
+    __spans = {}  # {str: StageSpan}
+    __memory = {}  # {object: [память в начале, наибольшая память]} выполняющихся стадий
+    __lock = threading.Lock()
+
+    @classmethod
+    def enable(cls, trace_memory=True, stats_dir=None):
+        """trace_memory - измерять память (замедляет выполнение),
+        stats_dir - каталог для статистики cProfile стадий, None - без cProfile"""
+        cls.__enabled = True
+        cls.__trace_memory = trace_memory
+        cls.__stats_dir = stats_dir
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @classmethod
+    def is_enabled(cls):
+        return cls.__enabled
+
+    @classmethod
+    @contextmanager
+    def span(cls, name):
+        """замеряет выполнение блока как стадию name. Повторные замеры стадии суммируются"""
+        if not cls.__enabled:
+            yield
+            return
+        memory_key = object()
+        with cls.__lock:
+            span = cls.__spans.get(name)
+            if span is None:
+                span = cls.__spans[name] = StageSpan(name)
+            current_memory = cls.__update_memory_peaks()
+            if current_memory is not None:
+                cls.__memory[memory_key] = [current_memory, current_memory]
+        profile = cls.__start_profile(span)
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            yield
+        finally:
+            cpu_time = time.thread_time() - cpu_started
+            wall_time = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+            with cls.__lock:
+                cls.__update_memory_peaks()
+                memory = cls.__memory.pop(memory_key, None)
+                span.count += 1
+                span.wall_time += wall_time
+                span.cpu_time += cpu_time
+                if memory is not None:
+                    span.peak_memory = max(span.peak_memory or 0, memory[1] - memory[0])
+
+    @classmethod
+    def reset(cls):
+        with cls.__lock:
+            cls.__spans = {}
+
+    @classmethod
+    def to_str(cls, hot_spots=20):
+        """стадии по убыванию времени и hot_spots самых затратных функций (по собственному времени)"""
+        with cls.__lock:
+            spans = sorted(cls.__spans.values(), key=lambda s: s.wall_time, reverse=True)
+        if not spans:
+            return "Profile: no stages"
+        http = {}  # {стадия: [число запросов, время]}
+        for (service, stage, method, endpoint), endpoint_stats in HttpMetrics.get_stats().items():
+            stage_http = http.setdefault(stage, [0, 0.0])
+            stage_http[0] += endpoint_stats.count
+            stage_http[1] += endpoint_stats.total_time
+
+        header = ('stage', 'runs', 'wall s', 'cpu s', 'peak MiB', 'http', 'http s')
+        rows = [header] + [(span.name, str(span.count), "{:.2f}".format(span.wall_time),
+                            "{:.2f}".format(span.cpu_time),
+                            '-' if span.peak_memory is None else "{:.1f}".format(span.peak_memory / 2 ** 20),
+                            str(http.get(span.name, (0, 0.0))[0]),
+                            "{:.2f}".format(http.get(span.name, (0, 0.0))[1]))
+                           for span in spans]
+        text = cls.__format_table(rows, right_aligned=range(1, len(header)))
+
+        functions = []  # [(собственное время, общее время, вызовы, стадия, функция)]
+        for span in spans:
+            if span.profile is None:
+                continue
+            for func, (cc, nc, tt, ct, callers) in pstats.Stats(span.profile).stats.items():
+                functions.append((tt, ct, nc, span.name, pstats.func_std_string(func)))
+        if functions and hot_spots:
+            functions.sort(reverse=True)
+            rows = [('own s', 'cum s', 'calls', 'stage', 'function')] + [
+                ("{:.3f}".format(tt), "{:.3f}".format(ct), str(nc), stage, func)
+                for tt, ct, nc, stage, func in functions[:hot_spots]]
+            text += "\nHot spots:\n" + cls.__format_table(rows, right_aligned=range(3))
+        return text
+
+    @classmethod
+    def write_stats(cls):
+        """сохраняет статистику cProfile стадий: <stats_dir>/<стадия>.prof, открывается pstats или snakeviz"""
+        if cls.__stats_dir is None:
+            return
+        os.makedirs(cls.__stats_dir, exist_ok=True)
+        with cls.__lock:
+            spans = list(cls.__spans.values())
+        for span in spans:
+            if span.profile is not None:
+                span.profile.dump_stats(os.path.join(cls.__stats_dir, "{}.prof".format(span.name)))
+        logging.debug("Stage profiles written to \'{}\'".format(cls.__stats_dir))
+
+    @classmethod
+    def __start_profile(cls, span: StageSpan):
+        if cls.__stats_dir is None:
+            return None
+        with cls.__lock:
+            if span.profile is None:
+                span.profile = cProfile.Profile()
+            profile = span.profile
+        try:
+            profile.enable()
+        except ValueError as e:
+            # в Python 3.12+ одновременно может работать только один профилировщик
+            logging.warning("Stage \'{}\' not profiled: {}".format(span.name, str(e)))
+            return None
+        return profile
+
+    @classmethod
+    def __update_memory_peaks(cls):
+        """учитывает пик памяти с прошлого вызова во всех выполняющихся стадиях,
+        возвращает текущую память или None, если память не измеряется"""
+        if not cls.__trace_memory or not tracemalloc.is_tracing():
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        for memory in cls.__memory.values():
+            memory[1] = max(memory[1], peak)
+        tracemalloc.reset_peak()
+        return current
+
+    @staticmethod
+    def __format_table(rows, right_aligned):
+        """right_aligned - номера столбцов с выравниванием вправо"""
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return '\n'.join('  '.join(cell.rjust(width) if i in right_aligned else cell.ljust(width)
+                                   for i, (cell, width) in enumerate(zip(row, widths))).rstrip()
+                         for row in rows)
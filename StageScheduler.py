@@ -0,0 +1,114 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from HttpMetrics import HttpMetrics
+from StageProfiler import StageProfiler
+
+
+def submit_in_context(executor, func, *args, **kwargs):
+    """запускает func в пуле с контекстом вызывающего потока (стадия HttpMetrics и т.п.)"""
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+class Stage:
+
+    def __init__(self, name, func, depends):
+        self.name = name
+        self.func = func
+        self.depends = list(depends)
+        self.result = None
+        self.error = None
+        self.skipped = False
+        self.started = None
+        self.seconds = None
+
+
+class StageScheduler:
+    """выполняет стадии синхронизации с учётом зависимостей.
+    Независимые стадии идут параллельно, но не больше max_workers одновременно.
+    Стадии и их пулы потоков вместе могут выполнять больше запросов к МС, чем допускает МойСклад,
+    общее ограничение запросов МС задаёт HttpMetrics.instrument_msapi"""
+
+    def __init__(self, max_workers: int = 3):
+        self.max_workers = max(max_workers, 1)
+        self.__stages = {}  # {str: Stage}
+
+    def add(self, name, func, depends=()):
+        """добавляет стадию. depends - имена стадий, которые должны завершиться раньше"""
+        if name in self.__stages:
+            raise ValueError("Stage \'{}\' already added".format(name))
+        self.__stages[name] = Stage(name, func, depends)
+        return name
+
+    def get_names(self):
+        return list(self.__stages)
+
+    def get_result(self, name):
+        return self.__stages[name].result
+
+    def run(self):
+        """выполняет все стадии. Если стадия завершилась ошибкой, зависящие от неё пропускаются,
+        остальные доводятся до конца, после чего первая ошибка пробрасывается"""
+        for stage in self.__stages.values():
+            for dependency in stage.depends:
+                if dependency not in self.__stages:
+                    raise ValueError("Stage \'{}\' depends on unknown stage \'{}\'".format(stage.name, dependency))
+
+        pending = dict(self.__stages)
+        running = {}  # {Future: Stage}
+        finished = set()
+        first_error = None
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for stage in list(pending.values()):
+                    dependencies = [self.__stages[name] for name in stage.depends]
+                    if any(dependency.error is not None or dependency.skipped for dependency in dependencies):
+                        stage.skipped = True
+                        del pending[stage.name]
+                        logging.warning("Stage \'{}\' skipped".format(stage.name))
+                        continue
+                    if all(dependency.name in finished for dependency in dependencies) \
+                            and len(running) < self.max_workers:
+                        del pending[stage.name]
+                        running[submit_in_context(executor, self.__run_stage, stage)] = stage
+                if not running:
+                    if pending:
+                        raise ValueError("Stages \'{}\' have cyclic dependencies".format("', '".join(pending)))
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    finished.add(stage.name)
+                    if stage.error is not None and first_error is None:
+                        first_error = stage.error
+
+        logging.info("Stages completed in {:.2f}s:\n\t{}".format(time.perf_counter() - started, self.to_str()))
+        if first_error is not None:
+            raise first_error
+
+    def to_str(self):
+        lines = []
+        for stage in sorted(self.__stages.values(), key=lambda s: (s.started is None, s.started or 0)):
+            if stage.skipped:
+                lines.append("{}: skipped".format(stage.name))
+            elif stage.seconds is not None:
+                lines.append("{}: {:.2f}s{}".format(stage.name, stage.seconds,
+                                                    " (failed)" if stage.error is not None else ""))
+        return "\n\t".join(lines)
+
+    @staticmethod
+    def __run_stage(stage: Stage):
+        logging.info("Stage \'{}\' started".format(stage.name))
+        stage.started = time.perf_counter()
+        try:
+            with HttpMetrics.stage(stage.name), StageProfiler.span(stage.name):
+                stage.result = stage.func()
+        except Exception as e:
+            stage.error = e
+            logging.error("Stage \'{}\' failed: {}".format(stage.name, str(e)))
+        finally:
+            stage.seconds = time.perf_counter() - stage.started
+        logging.info("Stage \'{}\' completed in {:.2f}s".format(stage.name, stage.seconds))
@@ -0,0 +1,61 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+
+class SyncCheckpoint:
+    """контрольная точка синхронизации: время начала последнего успешного
+    и последнего полного запуска и объекты МС, которые в последнем запуске не удалось синхронизировать.
+    Хранится в json файле"""
+
+    def __init__(self, path):
+        self.__path = path
+        self.__data = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.__data = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning("Checkpoint \'{}\' ignored: {}".format(path, str(e)))
+
+    def get_last_run(self):
+        """время начала последнего успешного запуска (UTC) или None"""
+        return self.__get_datetime('last_run')
+
+    def get_last_full_run(self):
+        """время начала последнего успешного полного запуска (UTC) или None"""
+        return self.__get_datetime('last_full_run')
+
+    def get_failed_ms_hrefs(self):
+        """объекты МС, которые не удалось синхронизировать в последнем запуске"""
+        return list(self.__data.get('failed_ms_hrefs', []))
+
+    def get_modified_since(self, full_sync_interval: timedelta):
+        """возвращает время, с которого нужно запрашивать изменения,
+        или None, если пора делать полный запуск"""
+        last_run = self.get_last_run()
+        last_full_run = self.get_last_full_run()
+        if last_run is None or last_full_run is None:
+            return None
+        if datetime.now(timezone.utc) - last_full_run >= full_sync_interval:
+            return None
+        return last_run
+
+    def save(self, started_at: datetime, is_full_run: bool, failed_ms_hrefs: [str] = ()):
+        """сохраняет контрольную точку после успешного запуска.
+        failed_ms_hrefs - объекты МС, которые следующий инкрементальный запуск синхронизирует повторно"""
+        self.__data['last_run'] = started_at.isoformat()
+        self.__data['failed_ms_hrefs'] = sorted(failed_ms_hrefs)
+        if is_full_run:
+            self.__data['last_full_run'] = started_at.isoformat()
+        tmp_path = self.__path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.__data, f, indent=4)
+        os.replace(tmp_path, self.__path)
+
+    def __get_datetime(self, key):
+        value = self.__data.get(key)
+        if value is None:
+            return None
+        return datetime.fromisoformat(value)
@@ -0,0 +1,69 @@
+import logging
+import threading
+
+from MSApi import MSApi, MSApiException, Task, error_handler
+
+
+class TaskRegistry:
+    """реестр задач МС на время запуска: описания существующих задач загружаются один раз,
+    новые задачи копятся в очереди и создаются одним пакетным запросом.
+    Может использоваться из параллельных стадий"""
+
+    BATCH_LIMIT = 1000
+
+    def __init__(self, employee):
+        self.__employee = employee
+        self.__existing = None  # {str} описания задач, существовавших в МС до запуска
+        self.__descriptions = None  # {str} существующие и поставленные в очередь за запуск
+        self.__pending = []  # [str]
+        self.created_count = 0
+        self.skipped_count = 0  # пропущено, потому что задача уже есть в МС
+        self.duplicate_count = 0  # пропущено, потому что задача уже поставлена в этом запуске
+        self.__lock = threading.RLock()
+
+    def add_task(self, desc):
+        """ставит задачу в очередь, если задачи с таким описанием ещё нет"""
+        desc = str(desc)
+        with self.__lock:
+            if desc in self.__get_descriptions():
+                if desc in self.__existing:
+                    self.skipped_count += 1
+                else:
+                    self.duplicate_count += 1
+                return False
+            self.__descriptions.add(desc)
+            self.__pending.append(desc)
+            return True
+
+    def flush(self):
+        """создаёт все задачи из очереди"""
+        with self.__lock:
+            self.__flush()
+
+    def __flush(self):
+        while self.__pending:
+            chunk = self.__pending[:self.BATCH_LIMIT]
+            del self.__pending[:len(chunk)]
+            try:
+                response = MSApi.auch_post('entity/task', json=[
+                    {
+                        'description': desc,
+                        'assignee': {'meta': self.__employee.get_meta().get_json()}
+                    } for desc in chunk])
+                error_handler(response)
+            except MSApiException as e:
+                logging.error("Tasks creation failed: {}".format(str(e)))
+                self.__descriptions.difference_update(chunk)
+                continue
+            for desc, task_json in zip(chunk, response.json()):
+                if 'errors' in task_json:
+                    logging.error("Task creation failed: {}".format(task_json['errors']))
+                    self.__descriptions.discard(desc)
+                    continue
+                self.created_count += 1
+
+    def __get_descriptions(self):
+        if self.__descriptions is None:
+            self.__existing = set(task.get_description() for task in Task.gen_list())
+            self.__descriptions = set(self.__existing)
+        return self.__descriptions
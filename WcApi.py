@@ -1,11 +1,38 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import RequestException
 from woocommerce import API
+from HttpMetrics import HttpMetrics
+from RetryPolicy import AimdLimiter, RetryPolicy, THROTTLE_STATUSES
 from exceptions import WcApiException
 from MSApi import caching
+import logging
+
+
+def check_wc_response(response):
+    """бросает WcApiException, если запрос к WC завершился ошибкой"""
+    if response.status_code not in [200, 201]:
+        message = None
+        if response.status_code not in [503, 500, 502, 504]:
+            try:
+                message = response.json().get('message')
+            except (ValueError, AttributeError):
+                # тело не JSON-объект, например HTML страница прокси или ограничителя запросов
+                pass
+        raise WcApiException(message or "{} {}".format(response.status_code, response.reason), response.status_code)
 
 
 class WcApi:
     wcapi = None
     read_only_mode = False
+    pool_size = 4
+    retry_policy = RetryPolicy()
+
+    MAX_PER_PAGE = 100
+
+    __limiter = None
 
     @classmethod
     def login(cls, url, consumer_key, consumer_secret):
@@ -17,49 +44,143 @@ class WcApi:
 
     @classmethod
     def get(cls, endpoint, **kwargs):
-        response = cls.wcapi.get(endpoint, **kwargs)
+        return cls.__get_response(endpoint, **kwargs).json()
+
+    @classmethod
+    def __get_response(cls, endpoint, **kwargs):
+        response = cls.__request('GET', endpoint, lambda: cls.wcapi.get(endpoint, **kwargs), idempotent=True)
         cls.__check_error(response)
-        return response.json()
+        return response
 
     @classmethod
     def put(cls, endpoint, data, **kwargs):
         if cls.read_only_mode:
             return None
-        response = cls.wcapi.put(endpoint, data, **kwargs)
+        response = cls.__request('PUT', endpoint, lambda: cls.wcapi.put(endpoint, data, **kwargs), idempotent=True)
         cls.__check_error(response)
         return response.json()
 
     @classmethod
-    def post(cls, endpoint, data, **kwargs):
+    def post(cls, endpoint, data, idempotent: bool = False, **kwargs):
+        """idempotent - запрос можно безопасно повторить (например, пакет только из изменений)"""
         if cls.read_only_mode:
             return None
-        response = cls.wcapi.post(endpoint, data, **kwargs)
+        response = cls.__request('POST', endpoint, lambda: cls.wcapi.post(endpoint, data, **kwargs), idempotent)
         cls.__check_error(response)
         return response.json()
 
+    @classmethod
+    def __request(cls, method, endpoint, send, idempotent):
+        """выполняет запрос с повторами при перегрузке и ошибках сервера.
+        Число одновременных запросов подстраивается под ответы сервера"""
+        attempt = 0
+        while True:
+            response, delay = cls.try_request(method, endpoint, send, idempotent, attempt)
+            if delay is None:
+                return response
+            time.sleep(delay)
+            attempt += 1
+
+    @classmethod
+    def try_request(cls, method, endpoint, send, idempotent, attempt):
+        """попытка запроса номер attempt (с нуля) через общий ограничитель и политику повторов.
+        Возвращает (ответ, None), если повторять не нужно, или (None, задержка перед повтором).
+        Бросает WcApiException, если запрос не выполнен и повторять его нельзя"""
+        policy = cls.retry_policy
+        limiter = cls.get_limiter()
+        response = None
+        error = None
+        with limiter:
+            try:
+                response = HttpMetrics.measure('wc', method, endpoint, send)
+            except RequestException as e:
+                error = e
+        policy.stats.add(requests=1)
+
+        if response is not None and not policy.is_retryable(response, True):
+            limiter.on_success()
+            return response, None
+        if response is not None and response.status_code in THROTTLE_STATUSES:
+            limiter.on_throttle()
+            policy.stats.add(throttled=1)
+        else:
+            policy.stats.add(failed=1)
+
+        if not policy.is_retryable(response, idempotent):
+            if error is not None:
+                raise WcApiException(str(error)) from error
+            return response, None
+        if attempt >= policy.max_retries:
+            policy.stats.add(gave_up=1)
+            if error is not None:
+                raise WcApiException(str(error)) from error
+            return response, None
+
+        delay = policy.get_delay(attempt, response)
+        logging.warning("WC {} {}: {}, retry {}/{} in {:.1f}s".format(
+            method, endpoint, error if response is None else response.status_code,
+            attempt + 1, policy.max_retries, delay))
+        policy.stats.add(retries=1, backoff_seconds=delay)
+        return None, delay
+
+    @classmethod
+    def get_limiter(cls) -> AimdLimiter:
+        """ограничитель одновременных запросов, верхняя граница - pool_size"""
+        if cls.__limiter is None or cls.__limiter.max_limit != max(cls.pool_size, 1):
+            cls.__limiter = AimdLimiter(cls.pool_size)
+        return cls.__limiter
+
     @staticmethod
     def __check_error(response):
-        if response.status_code not in [200, 201]:
-            if response.status_code in [503, 500]:
-                raise WcApiException(str(response.reason))
-            raise WcApiException(response.json().get('message'))
+        check_wc_response(response)
 
     @classmethod
     @caching
-    def gen_all_wc(cls, entity, filters: {str: str} = None, **kwargs):
-        page_iterator = 1
+    def gen_all_wc(cls, entity, filters: {str: str} = None, per_page: int = MAX_PER_PAGE, fields=None, **kwargs):
+        """возвращает все объекты WC постранично. Первая страница запрашивается сразу,
+        остальные - параллельно по заголовку X-WP-TotalPages.
+        fields - поля объектов верхнего уровня, которые нужно получить (параметр _fields), None - все поля"""
+        per_page = min(per_page, cls.MAX_PER_PAGE)
         filters_str = ""
         if filters is not None:
             for filter_parameter, filter_value in filters.items():
                 filters_str += f"&{filter_parameter}={filter_value}"
+        if fields is not None:
+            filters_str += "&_fields={}".format(','.join(sorted(set(fields))))
 
-        while True:
-            wc_product_list = cls.get(f'{entity}?per_page=50&page={page_iterator}{filters_str}', **kwargs)
-            if len(wc_product_list) == 0:
-                break
-            for wc_product in wc_product_list:
-                yield wc_product
-            page_iterator += 1
+        def get_page_endpoint(page):
+            return f'{entity}?per_page={per_page}&page={page}{filters_str}'
+
+        response = cls.__get_response(get_page_endpoint(1), **kwargs)
+        wc_object_list = response.json()
+        for wc_object in wc_object_list:
+            yield wc_object
+
+        total_pages = response.headers.get('X-WP-TotalPages')
+        if total_pages is None:
+            # заголовок не пришёл - идём по страницам до пустой
+            page_iterator = 2
+            while len(wc_object_list) != 0:
+                wc_object_list = cls.get(get_page_endpoint(page_iterator), **kwargs)
+                for wc_object in wc_object_list:
+                    yield wc_object
+                page_iterator += 1
+            return
+
+        logging.debug("WC {}: {} objects on {} pages".format(
+            entity, response.headers.get('X-WP-Total'), total_pages))
+        total_pages = int(total_pages)
+        if total_pages <= 1:
+            return
+
+        # страницы учитываются в статистике стадии вызывающего потока
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=max(cls.pool_size, 1)) as executor:
+            page_lists = executor.map(lambda page: context.copy().run(cls.get, get_page_endpoint(page), **kwargs),
+                                      range(2, total_pages + 1))
+            for wc_object_list in page_lists:
+                for wc_object in wc_object_list:
+                    yield wc_object
 
     @classmethod
     @caching
@@ -67,15 +188,88 @@ class WcApi:
         return cls.gen_all_wc(entity="products", **kwargs)
 
 
-def gen_all_wc_variations(wc_product_id):
-    page_iterator = 1
-    while True:
-        wc_product_list = WcApi.get(f'products/{wc_product_id}/variations?per_page=50&page={page_iterator}')
-        if len(wc_product_list) == 0:
-            break
-        for wc_product in wc_product_list:
-            yield wc_product
-        page_iterator += 1
+class WcBatchWriter:
+    """буфер пакетной записи в WooCommerce через эндпоинт '{entity}/batch'"""
+
+    BATCH_LIMIT = 100
+
+    def __init__(self, entity='products', batch_size=BATCH_LIMIT):
+        self.__entity = entity
+        self.__batch_size = min(batch_size, self.BATCH_LIMIT)
+        self.__create_queue = []  # [(source, data)]
+        self.__update_queue = []  # [(source, data)]
+        self.__results = []  # [(source, wc_json, error)]
+
+    def __len__(self):
+        return len(self.__create_queue) + len(self.__update_queue)
+
+    def create(self, data, source=None):
+        """добавляет в буфер создание нового объекта WC"""
+        self.__create_queue.append((source, data))
+        self.__flush_if_full()
+
+    def update(self, wc_id, data, source=None):
+        """добавляет в буфер изменение объекта WC"""
+        self.__update_queue.append((source, dict(data, id=int(wc_id))))
+        self.__flush_if_full()
+
+    def flush(self):
+        """отправляет содержимое буфера и возвращает результаты
+        в виде списка (source, wc_json, error) для каждого объекта"""
+        while self.__create_queue or self.__update_queue:
+            self.__send_chunk()
+        results, self.__results = self.__results, []
+        return results
+
+    def __flush_if_full(self):
+        if len(self) >= self.__batch_size:
+            self.__send_chunk()
+
+    def __send_chunk(self):
+        creates = self.__create_queue[:self.__batch_size]
+        del self.__create_queue[:len(creates)]
+        updates = self.__update_queue[:self.__batch_size - len(creates)]
+        del self.__update_queue[:len(updates)]
+
+        batch_data = {}
+        if creates:
+            batch_data['create'] = [data for _, data in creates]
+        if updates:
+            batch_data['update'] = [data for _, data in updates]
+
+        try:
+            # пакет только из изменений можно повторить без риска создать дубликаты
+            response = WcApi.post(f'{self.__entity}/batch', data=batch_data, idempotent=not creates)
+        except WcApiException as e:
+            for source, _ in creates + updates:
+                self.__results.append((source, None, str(e)))
+            return
+
+        if response is None:
+            # read only mode
+            for source, _ in creates + updates:
+                self.__results.append((source, None, None))
+            return
+
+        for action, queue in (('create', creates), ('update', updates)):
+            response_items = response.get(action, [])
+            for i, (source, _) in enumerate(queue):
+                wc_json = response_items[i] if i < len(response_items) else None
+                self.__results.append((source, wc_json, self.__get_item_error(wc_json)))
+
+    @staticmethod
+    def __get_item_error(wc_json):
+        if wc_json is None:
+            return "Batch response item is missing"
+        error = wc_json.get('error')
+        if error is None:
+            return None
+        return error.get('message') or error.get('code') or str(error)
+
+
+def gen_all_wc_variations(wc_product_id, **kwargs):
+    return WcApi.gen_all_wc(entity=f'products/{wc_product_id}/variations', **kwargs)
+
 
 def get_wooms_href(wc_product):
     wc_meta_list = wc_product.get('meta_data')
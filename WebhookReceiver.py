@@ -0,0 +1,212 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from MSApi.MSApi import MSApiException
+
+from WcApi import WcApi
+from exceptions import WcApiException
+
+
+def get_webhook_signature(secret: str, body: bytes) -> str:
+    """подпись вебхука WC: base64(HMAC-SHA256(secret, body))"""
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+class OrderQueue:
+    """долговременная очередь заказов WC на диске, один файл на заказ.
+    Повторные вебхуки одного заказа перезаписывают файл"""
+
+    def __init__(self, path):
+        self.__path = path
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, wc_order):
+        file_path = os.path.join(self.__path, "order-{}.json".format(int(wc_order['id'])))
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(wc_order, f, ensure_ascii=False)
+        os.replace(tmp_path, file_path)
+
+    def gen_pending(self):
+        """возвращает (путь, заказ) в порядке поступления"""
+        file_paths = [os.path.join(self.__path, file_name)
+                      for file_name in os.listdir(self.__path)
+                      if file_name.startswith('order-') and file_name.endswith('.json')]
+        for file_path in sorted(file_paths, key=os.path.getmtime):
+            try:
+                with open(file_path, encoding='utf-8') as f:
+                    yield file_path, json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error("Webhook queue: broken file \'{}\': {}".format(file_path, str(e)))
+
+    @staticmethod
+    def remove(file_path):
+        os.remove(file_path)
+
+
+class WebhookReceiver:
+    """HTTP приёмник вебхуков WC order.created / order.updated.
+    Проверяет подпись и кладёт заказы в очередь"""
+
+    TOPICS = ['order.created', 'order.updated']
+
+    def __init__(self, host, port, secret, queue: OrderQueue):
+        self.__secret = secret
+        self.__queue = queue
+        self.order_received = threading.Event()
+        self.__server = ThreadingHTTPServer((host, port), WebhookRequestHandler)
+        self.__server.receiver = self
+
+    def get_address(self):
+        return self.__server.server_address
+
+    def serve_forever(self):
+        logging.info("Webhook receiver listening on {}:{}".format(*self.get_address()))
+        self.__server.serve_forever()
+
+    def shutdown(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def handle(self, topic, signature, body) -> int:
+        """обрабатывает вебхук, возвращает HTTP код ответа"""
+        if signature is None or not hmac.compare_digest(signature, get_webhook_signature(self.__secret, body)):
+            logging.warning("Webhook rejected: invalid signature")
+            return 401
+        if topic not in self.TOPICS:
+            # пинг при создании вебхука и прочие темы
+            return 200
+        try:
+            wc_order = json.loads(body)
+            wc_order_id = int(wc_order['id'])
+        except (ValueError, KeyError, TypeError):
+            logging.warning("Webhook rejected: invalid payload")
+            return 400
+        self.__queue.put(wc_order)
+        logging.info("WC Order [{}]:\tQueued by webhook {}".format(wc_order_id, topic))
+        self.order_received.set()
+        return 202
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        code = self.server.receiver.handle(self.headers.get('X-WC-Webhook-Topic'),
+                                           self.headers.get('X-WC-Webhook-Signature'),
+                                           body)
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("Webhook receiver: " + format % args)
+
+
+class WebhookOrderProcessor(threading.Thread):
+    """обрабатывает заказы из очереди сразу после поступления
+    и периодически проходит по всем заказам в статусе 'processing'.
+    Ошибки запросов не останавливают обработку: заказ остаётся в очереди до следующего прохода"""
+
+    # наборы данных запуска, которые обновляются перед каждым догоняющим проходом
+    SWEEP_INVALIDATED = ('assortment_index', 'ms_products', 'ms_bundles')
+
+    def __init__(self, order_sync, queue: OrderQueue, order_received: threading.Event,
+                 sweep_interval: timedelta = None, run_context=None):
+        """run_context - общие данные запуска (RunContext) синхронизации заказов"""
+        super().__init__(daemon=True)
+        self.__order_sync = order_sync
+        self.__queue = queue
+        self.__order_received = order_received
+        self.__sweep_interval = sweep_interval
+        self.__run_context = run_context
+        self.__stopped = threading.Event()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__order_received.set()
+
+    def run(self):
+        next_sweep = time.monotonic()
+        while not self.__stopped.is_set():
+            self.process_queue()
+            if self.__sweep_interval is not None and time.monotonic() >= next_sweep:
+                self.sweep()
+                next_sweep = time.monotonic() + self.__sweep_interval.total_seconds()
+            timeout = None
+            if self.__sweep_interval is not None:
+                timeout = max(next_sweep - time.monotonic(), 0)
+            self.__order_received.wait(timeout)
+            self.__order_received.clear()
+
+    def process_queue(self):
+        """синхронизирует заказы из очереди"""
+        for file_path, wc_order in self.__queue.gen_pending():
+            wc_order_id = wc_order['id']
+            try:
+                # статус мог измениться, пока заказ ждал в очереди
+                wc_order = WcApi.get('orders/{}'.format(wc_order_id))
+            except WcApiException as e:
+                if e.status_code == 404:
+                    logging.warning("WC Order [{}]:\tNot found, removed from queue".format(wc_order_id))
+                    self.__queue.remove(file_path)
+                else:
+                    logging.error("WC Order [{}]:\tRequest failed, left in queue: {}".format(wc_order_id, str(e)))
+                continue
+            if wc_order.get('status') == 'processing':
+                try:
+                    if self.__order_sync.sync_order_list([wc_order]):
+                        logging.warning("WC Order [{}]:\tAssortment syncro required".format(wc_order_id))
+                except (WcApiException, MSApiException, requests.RequestException) as e:
+                    logging.error("WC Order [{}]:\tSyncro failed, left in queue: {}".format(wc_order_id, str(e)))
+                    continue
+            else:
+                logging.debug("WC Order [{}]:\tSkipped with status \'{}\'".format(wc_order_id, wc_order.get('status')))
+            self.__queue.remove(file_path)
+
+    def sweep(self):
+        """догоняющий проход по всем заказам в статусе 'processing'"""
+        logging.info("Webhook processor: catch-up sweep")
+        if self.__run_context is not None:
+            # ассортимент МС мог измениться с прошлого прохода
+            self.__run_context.invalidate(*self.SWEEP_INVALIDATED)
+        try:
+            self.__order_sync.check_and_correct_ms_phone_numbers()
+            if self.__order_sync.sync_orders():
+                logging.warning("Webhook processor: assortment syncro required")
+        except (WcApiException, MSApiException, requests.RequestException) as e:
+            logging.error("Webhook processor: catch-up sweep failed: {}".format(str(e)))
+
+
+def post_recorded_payload(url, secret, payload_path, topic='order.created'):
+    """отправляет записанный вебхук на приёмник с корректной подписью"""
+    with open(payload_path, 'rb') as f:
+        body = f.read()
+    response = requests.post(url, data=body, headers={
+        'Content-Type': 'application/json',
+        'X-WC-Webhook-Topic': topic,
+        'X-WC-Webhook-Signature': get_webhook_signature(secret, body)
+    })
+    return response.status_code
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Отправка записанных вебхуков WC на локальный приёмник")
+    parser.add_argument('payloads', nargs='+', help="json файлы с телом вебхука")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/')
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--topic', default='order.created', choices=WebhookReceiver.TOPICS)
+    args = parser.parse_args()
+    for payload in args.payloads:
+        print("{}: {}".format(payload, post_recorded_payload(args.url, args.secret, payload, args.topic)))
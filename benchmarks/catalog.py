@@ -0,0 +1,403 @@
+import random
+import uuid
+from datetime import datetime, timedelta
+
+from settings import DELIVERY_DICT, EMPLOYEE_ID, IMPORT_FLAG_ATTR_NAME, PROJECTS_DICT, STATES_DICT, STORE_NAME, \
+    WC_ID_ATTR_NAME
+
+SIZES = {
+    '1k': 1000,
+    '10k': 10000,
+    '100k': 100000,
+}
+
+SALE_GROUP_TAG = 'benchmark'
+
+# доли товаров МС в разных состояниях связи с WC
+UNLINKED_SHARE = 0.05
+DUPLICATE_SHARE = 0.01
+ORPHANED_SHARE = 0.01
+NOT_IMPORTED_SHARE = 0.03
+UNSYNCED_WC_SHARE = 0.02
+CHANGED_SHARE = 0.2
+INVALID_PHONE_SHARE = 0.3
+
+MS_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.000'
+
+
+def parse_size(size_str):
+    """'10k' или '2500' -> число товаров"""
+    if size_str in SIZES:
+        return SIZES[size_str]
+    return int(size_str)
+
+
+class FakeCatalog:
+    """синтетические каталоги WC и МС для тестового сервера.
+    Объекты МС хранятся как json с hrefs на base_url сервера"""
+
+    def __init__(self, base_url, products: int, bundles: int = None, counterparties: int = None,
+                 orders: int = None, seed: int = 0, variable_products: int = 0, variants_per_product: int = 4):
+        """variable_products - товары МС с модификациями, на сайте есть товар и часть его вариаций"""
+        self.base_url = base_url.rstrip('/')
+        self.ms_url = self.base_url + '/api/remap/1.2'
+        self.__random = random.Random(seed)
+        self.__now = datetime(2024, 1, 1)
+
+        self.wc = {'products': {}, 'orders': {}, 'products/attributes': {}}  # {entity: {id: json}}
+        self.wc_next_id = 1
+        self.ms = {}  # {type: {id: json}}
+        self.ms_metadata = {}  # {type: json}
+
+        if bundles is None:
+            bundles = products // 10
+        if counterparties is None:
+            counterparties = products // 2
+        if orders is None:
+            orders = max(products // 100, 10)
+
+        self.__create_reference_data()
+        self.__create_assortment('product', products)
+        self.__create_assortment('bundle', bundles)
+        self.__create_counterparties(counterparties)
+        self.__create_orders(orders)
+        self.__create_variable_products(variable_products, variants_per_product)
+
+    # -------------------------------------------------------------- helpers
+
+    def new_ms_id(self):
+        return str(uuid.UUID(int=self.__random.getrandbits(128), version=4))
+
+    def new_wc_id(self):
+        wc_id = self.wc_next_id
+        self.wc_next_id += 1
+        return wc_id
+
+    def get_ms_meta(self, ms_type, ms_id):
+        return {
+            'href': f"{self.ms_url}/entity/{ms_type}/{ms_id}",
+            'metadataHref': f"{self.ms_url}/entity/{ms_type}/metadata",
+            'type': ms_type,
+            'mediaType': 'application/json'
+        }
+
+    def get_ms_timestamp(self, delta_seconds=0):
+        return (self.__now + timedelta(seconds=delta_seconds)).strftime(MS_DATETIME_FORMAT)
+
+    def add_ms_object(self, ms_type, ms_json):
+        """добавляет объект МС, проставляя id, meta и время изменения"""
+        ms_id = ms_json.get('id') or self.new_ms_id()
+        ms_json['id'] = ms_id
+        ms_json['meta'] = self.get_ms_meta(ms_type, ms_id)
+        ms_json.setdefault('updated', self.get_ms_timestamp())
+        ms_json.setdefault('created', ms_json['updated'])
+        ms_json.setdefault('archived', False)
+        self.ms.setdefault(ms_type, {})[ms_id] = ms_json
+        return ms_json
+
+    def __add_attribute(self, ms_type, attr_id, name, attr_type):
+        attributes = self.ms_metadata.setdefault(ms_type, {}).setdefault('attributes', [])
+        attribute = {
+            'meta': {
+                'href': f"{self.ms_url}/entity/{ms_type}/metadata/attributes/{attr_id}",
+                'type': 'attributemetadata',
+                'mediaType': 'application/json'
+            },
+            'id': attr_id,
+            'name': name,
+            'type': attr_type,
+            'required': False
+        }
+        attributes.append(attribute)
+        return attribute
+
+    @staticmethod
+    def get_attribute_value(attribute, value):
+        return dict(meta=attribute['meta'], id=attribute['id'], name=attribute['name'], type=attribute['type'],
+                    value=value)
+
+    # -------------------------------------------------------------- reference data
+
+    def __create_reference_data(self):
+        self.wc_id_attr_id = self.new_ms_id()
+        self.import_flag_attr_id = self.new_ms_id()
+        self.attributes = {}  # {type: (wc_id, import_flag)}
+        # у товаров и комплектов общие доп. поля, как их видит синхронизация
+        for ms_type in ('product', 'bundle'):
+            self.attributes[ms_type] = (
+                self.__add_attribute(ms_type, self.wc_id_attr_id, WC_ID_ATTR_NAME, 'string'),
+                self.__add_attribute(ms_type, self.import_flag_attr_id, IMPORT_FLAG_ATTR_NAME, 'boolean'))
+        self.attributes['customerorder'] = (
+            self.__add_attribute('customerorder', self.new_ms_id(), WC_ID_ATTR_NAME, 'string'), None)
+
+        states = []
+        for state_name in list(STATES_DICT.keys()) + ['Отменён']:
+            state_id = self.new_ms_id()
+            states.append({
+                'meta': {
+                    'href': f"{self.ms_url}/entity/customerorder/metadata/states/{state_id}",
+                    'type': 'state',
+                    'mediaType': 'application/json'
+                },
+                'id': state_id,
+                'name': state_name,
+                'stateType': 'Regular'
+            })
+        self.ms_metadata['customerorder']['states'] = states
+        self.ms_metadata['variant'] = {'characteristics': [
+            {'meta': {'href': f"{self.ms_url}/entity/variant/metadata/characteristics/{self.new_ms_id()}",
+                      'type': 'attributemetadata'},
+             'name': name, 'type': 'string', 'required': False}
+            for name in ('Размер', 'Цвет')]}
+
+        price_type_id = self.new_ms_id()
+        self.default_price_type = {
+            'meta': {
+                'href': f"{self.ms_url}/context/companysettings/pricetype/{price_type_id}",
+                'type': 'pricetype',
+                'mediaType': 'application/json'
+            },
+            'id': price_type_id,
+            'name': 'Цена продажи',
+            'externalCode': 'cbcf493b-55bc-11d9-848a-00112f43529a'
+        }
+        discount_price_type_id = self.new_ms_id()
+        self.discount_price_type = dict(self.default_price_type, id=discount_price_type_id, name='Акция',
+                                        meta=dict(self.default_price_type['meta'],
+                                                  href=f"{self.ms_url}/context/companysettings/pricetype/"
+                                                       f"{discount_price_type_id}"))
+
+        self.add_ms_object('specialpricediscount', {
+            'name': 'Скидка постоянным покупателям',
+            'active': True,
+            'allProducts': True,
+            'allAgents': False,
+            'agentTags': ['vip'],
+            'usePriceType': False,
+            'discount': 5
+        })
+
+        self.organization = self.add_ms_object('organization', {'name': 'ООО Тест'})
+        self.add_ms_object('store', {'name': STORE_NAME})
+        self.add_ms_object('store', {'name': 'Склад брака'})
+        for project_name in PROJECTS_DICT.keys():
+            self.add_ms_object('project', {'name': project_name})
+        for service_id in set(DELIVERY_DICT.values()):
+            self.add_ms_object('service', {'id': service_id, 'name': 'Доставка'})
+        self.employee = self.add_ms_object('employee', {'id': EMPLOYEE_ID, 'name': 'Бенчмарк'})
+        self.add_ms_object('task', {'description': 'Существующая задача',
+                                    'assignee': {'meta': self.employee['meta']}})
+
+        self.wc['products/attributes'][1] = {'id': 1, 'name': 'Размер', 'slug': 'pa_size', 'type': 'select'}
+
+    # -------------------------------------------------------------- assortment
+
+    def __get_sale_prices(self, regular_price, sale_price=None):
+        sale_prices = [{'value': round(regular_price * 100), 'currency': {}, 'priceType': self.default_price_type}]
+        if sale_price is not None:
+            sale_prices.append({'value': round(sale_price * 100), 'currency': {},
+                                'priceType': self.discount_price_type})
+        return sale_prices
+
+    def __create_assortment(self, ms_type, count):
+        """создаёт объекты МС и товары WC с долей рассинхронизации"""
+        wc_id_attribute, import_flag_attribute = self.attributes[ms_type]
+        linked_wc_ids = []
+        for i in range(count):
+            regular_price = float(self.__random.randint(10, 5000))
+            sale_price = regular_price * 0.8 if self.__random.random() < 0.1 else None
+            name = "{} {}".format('Товар' if ms_type == 'product' else 'Комплект', i)
+            ms_json = {
+                'name': name,
+                'code': str(i),
+                'externalCode': self.new_ms_id(),
+                'salePrices': self.__get_sale_prices(regular_price, sale_price),
+                'attributes': [],
+                'updated': self.get_ms_timestamp(-self.__random.randint(0, 30 * 24 * 3600)),
+            }
+            if ms_type == 'product':
+                ms_json['variantsCount'] = 0
+
+            dice = self.__random.random()
+            if dice >= NOT_IMPORTED_SHARE:
+                ms_json['attributes'].append(self.get_attribute_value(import_flag_attribute, True))
+            dice = self.__random.random()
+            if dice < UNLINKED_SHARE:
+                pass
+            elif dice < UNLINKED_SHARE + ORPHANED_SHARE:
+                ms_json['attributes'].append(self.get_attribute_value(wc_id_attribute, str(10 ** 9 + i)))
+            elif dice < UNLINKED_SHARE + ORPHANED_SHARE + DUPLICATE_SHARE and linked_wc_ids:
+                ms_json['attributes'].append(self.get_attribute_value(
+                    wc_id_attribute, str(self.__random.choice(linked_wc_ids))))
+            else:
+                ms_json = self.add_ms_object(ms_type, ms_json)
+                wc_id = self.new_wc_id()
+                linked_wc_ids.append(wc_id)
+                ms_json['attributes'].append(self.get_attribute_value(wc_id_attribute, str(wc_id)))
+                # скидка по типу цен не действует для группы бенчмарка, цена со скидкой на сайте пустая
+                wc_regular_price, wc_sale_price = regular_price, None
+                if self.__random.random() < CHANGED_SHARE:
+                    wc_regular_price = regular_price + 10
+                self.__add_wc_product(wc_id, name, wc_regular_price, wc_sale_price, ms_json['meta']['href'])
+                continue
+            self.add_ms_object(ms_type, ms_json)
+
+        for i in range(int(count * UNSYNCED_WC_SHARE)):
+            self.__add_wc_product(self.new_wc_id(), "Без пары {} {}".format(ms_type, i), 100.0, None, None)
+
+    def __add_wc_product(self, wc_id, name, regular_price, sale_price, wooms_href):
+        # служебные поля плагинов, как в реальном магазине
+        meta_data = [{'id': wc_id * 10 + i, 'key': key, 'value': value} for i, (key, value) in enumerate([
+            ('_yoast_wpseo_title', name), ('_yoast_wpseo_metadesc', 'Купить {} с доставкой'.format(name)),
+            ('_wp_page_template', 'default'), ('total_sales', '0'), ('_edit_lock', '1700000000:1')])]
+        if wooms_href is not None:
+            meta_data.append({'id': wc_id, 'key': 'wooms_href', 'value': wooms_href})
+        self.wc['products'][wc_id] = {
+            'id': wc_id,
+            'name': name,
+            'slug': 'product-{}'.format(wc_id),
+            'type': 'simple',
+            'status': 'publish',
+            'description': 'Описание товара {}. '.format(wc_id) * 5,
+            'short_description': '',
+            'sku': '',
+            'price': str(sale_price or regular_price),
+            'regular_price': str(regular_price),
+            'sale_price': '' if sale_price is None else str(sale_price),
+            'date_modified_gmt': (self.__now - timedelta(seconds=self.__random.randint(0, 30 * 24 * 3600)))
+            .strftime('%Y-%m-%dT%H:%M:%S'),
+            'categories': [{'id': 15, 'name': 'Без категории', 'slug': 'uncategorized'}],
+            'images': [{'id': wc_id * 10 + i, 'name': '{}-{}'.format(wc_id, i), 'alt': name,
+                        'src': 'https://shop.example/wp-content/uploads/{}-{}.jpg'.format(wc_id, i)} for i in range(3)],
+            'attributes': [],
+            'variations': [],
+            'related_ids': [wc_id + i for i in range(1, 6)],
+            'meta_data': meta_data,
+            '_links': {'self': [{'href': 'https://shop.example/wp-json/wc/v3/products/{}'.format(wc_id)}],
+                       'collection': [{'href': 'https://shop.example/wp-json/wc/v3/products'}]},
+        }
+
+    def __create_variable_products(self, count, variants_per_product):
+        """товары с модификациями без флага импорта: вариации WC есть для всех модификаций, кроме последней"""
+        characteristic = self.ms_metadata['variant']['characteristics'][0]
+        wc_attribute = self.wc['products/attributes'][1]
+        for i in range(count):
+            regular_price = float(self.__random.randint(10, 5000))
+            name = "Товар с модификациями {}".format(i)
+            ms_product = self.add_ms_object('product', {
+                'name': name,
+                'salePrices': self.__get_sale_prices(regular_price),
+                'attributes': [],
+                'variantsCount': variants_per_product,
+            })
+            wc_id = self.new_wc_id()
+            self.__add_wc_product(wc_id, name, regular_price, None, ms_product['meta']['href'])
+            options = [str(40 + j) for j in range(variants_per_product)]
+            self.wc['products'][wc_id] |= {'type': 'variable', 'attributes': [
+                {'id': wc_attribute['id'], 'name': wc_attribute['name'], 'variation': True, 'options': options}]}
+            wc_variations = self.wc.setdefault('products/{}/variations'.format(wc_id), {})
+            for j, option in enumerate(options):
+                ms_variant = self.add_ms_object('variant', {
+                    'name': "{} ({})".format(name, option),
+                    'product': {'meta': ms_product['meta']},
+                    'characteristics': [dict(characteristic, value=option)],
+                    'salePrices': self.__get_sale_prices(regular_price),
+                })
+                if j == variants_per_product - 1:
+                    continue
+                variation_id = self.new_wc_id()
+                wc_variations[variation_id] = {
+                    'id': variation_id,
+                    'regular_price': str(regular_price),
+                    'attributes': [{'id': wc_attribute['id'], 'name': wc_attribute['name'], 'option': option}],
+                    'meta_data': [{'id': variation_id, 'key': 'wooms_href', 'value': ms_variant['meta']['href']}],
+                }
+
+    # -------------------------------------------------------------- customers and orders
+
+    def __gen_phone(self):
+        number = "9{:09d}".format(self.__random.randint(0, 10 ** 9 - 1))
+        if self.__random.random() < INVALID_PHONE_SHARE:
+            return "8 ({}) {}-{}-{}".format(number[:3], number[3:6], number[6:8], number[8:])
+        return "+7" + number
+
+    def __create_counterparties(self, count):
+        self.counterparties = []
+        for i in range(count):
+            self.counterparties.append(self.add_ms_object('counterparty', {
+                'name': "Покупатель {}".format(i),
+                'phone': self.__gen_phone(),
+                'email': "customer{}@example.com".format(i),
+                'tags': [SALE_GROUP_TAG] if i % 5 == 0 else [],
+                'companyType': 'individual'
+            }))
+        self.add_ms_object('customerorder', {
+            'name': '00100',
+            'created': self.get_ms_timestamp(),
+            'organization': {'meta': self.organization['meta']}
+        })
+
+    def __create_orders(self, count):
+        linked_wc_ids = [wc_id for wc_id, wc_product in self.wc['products'].items()
+                         if any(meta['key'] == 'wooms_href' for meta in wc_product['meta_data'])]
+        payment_methods = list(STATES_DICT.values())
+        pickup_stores = list(PROJECTS_DICT.values())
+        delivery_zones = list(DELIVERY_DICT.keys())
+        for i in range(count):
+            wc_id = self.new_wc_id()
+            if self.counterparties and self.__random.random() < 0.7:
+                ms_cp = self.__random.choice(self.counterparties)
+                phone, email = ms_cp['phone'], ms_cp['email']
+            else:
+                phone, email = self.__gen_phone(), "new{}@example.com".format(i)
+            line_items = []
+            for _ in range(self.__random.randint(1, 4)):
+                if not linked_wc_ids:
+                    break
+                product_id = self.__random.choice(linked_wc_ids)
+                line_items.append({
+                    'id': len(line_items) + 1,
+                    'product_id': product_id,
+                    'variation_id': 0,
+                    'quantity': self.__random.randint(1, 3),
+                    'price': float(self.wc['products'][product_id]['regular_price'])
+                })
+            meta_data = []
+            shipping_lines = []
+            if self.__random.random() < 0.5:
+                meta_data.append({'id': 1, 'key': '_shipping_pickup_stores',
+                                  'value': self.__random.choice(pickup_stores)})
+            else:
+                shipping_lines.append({'id': 1, 'method_title': self.__random.choice(delivery_zones),
+                                       'total': '300'})
+            self.wc['orders'][wc_id] = {
+                'id': wc_id,
+                'status': 'processing',
+                'payment_method': self.__random.choice(payment_methods),
+                'customer_note': '',
+                'billing': {
+                    'first_name': 'Имя{}'.format(i),
+                    'last_name': 'Фамилия{}'.format(i),
+                    'phone': phone,
+                    'email': email,
+                    'address_1': 'ул. Тестовая, {}'.format(i)
+                },
+                'meta_data': meta_data,
+                'line_items': line_items,
+                'shipping_lines': shipping_lines,
+                'date_modified_gmt': self.__now.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+        for i in range(count // 10):
+            wc_id = self.new_wc_id()
+            self.wc['orders'][wc_id] = {'id': wc_id, 'status': 'completed', 'line_items': [], 'meta_data': [],
+                                        'shipping_lines': []}
+
+    def get_summary(self):
+        return {
+            'wc products': len(self.wc['products']),
+            'wc orders': len(self.wc['orders']),
+            'ms products': len(self.ms.get('product', {})),
+            'ms bundles': len(self.ms.get('bundle', {})),
+            'ms counterparties': len(self.ms.get('counterparty', {})),
+            'ms variants': len(self.ms.get('variant', {})),
+        }
@@ -0,0 +1,419 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from benchmarks.catalog import FakeCatalog
+
+MS_PREFIX = '/api/remap/1.2/'
+WC_PREFIX = '/wp-json/wc/v3/'
+
+MS_MAX_LIMIT = 1000
+WC_MAX_PER_PAGE = 100
+WC_BATCH_LIMIT = 100
+
+MS_FILTER_OPERATORS = ('>=', '<=', '!=', '~=', '=~', '=', '>', '<', '~')
+# типы, которые возвращает entity/assortment
+MS_ASSORTMENT_TYPES = ('product', 'service', 'bundle', 'variant')
+
+
+class FakeApiError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def parse_ms_filter(filter_str):
+    """'a=1;a=2;b>=3' -> {key: [(operator, value)]}. Условия одного ключа объединяются по ИЛИ"""
+    conditions = {}
+    for condition in filter_str.split(';'):
+        if not condition:
+            continue
+        # ключом может быть href доп. поля, оператор ищется после последнего '/'
+        key_start = condition.rfind('/') + 1
+        for operator in MS_FILTER_OPERATORS:
+            position = condition.find(operator, key_start)
+            if position != -1:
+                key = condition[:position]
+                conditions.setdefault(key, []).append((operator, unquote(condition[position + len(operator):])))
+                break
+        else:
+            raise FakeApiError(412, "Invalid filter \'{}\'".format(condition))
+    return conditions
+
+
+def compare(operator, actual, expected):
+    if actual is None:
+        return operator == '=' and expected == '' or operator == '!=' and expected != ''
+    if isinstance(actual, bool):
+        actual = str(actual).lower()
+        expected = expected.lower()
+    actual = str(actual)
+    if operator == '=':
+        return actual == expected
+    if operator == '!=':
+        return actual != expected
+    if operator == '>=':
+        return actual >= expected
+    if operator == '<=':
+        return actual <= expected
+    if operator == '>':
+        return actual > expected
+    if operator == '<':
+        return actual < expected
+    if operator == '~':
+        return expected.lower() in actual.lower()
+    if operator == '~=':
+        return actual.lower().startswith(expected.lower())
+    return actual.lower().endswith(expected.lower())
+
+
+class FakeShop:
+    """обработка запросов к WC и МС поверх FakeCatalog с учётом записей"""
+
+    def __init__(self, catalog: FakeCatalog, wc_latency=0.0, ms_latency=0.0, wc_max_concurrency=None):
+        """wc_max_concurrency - сверх этого числа одновременных запросов WC отвечает 429 с Retry-After"""
+        self.catalog = catalog
+        self.wc_latency = wc_latency
+        self.ms_latency = ms_latency
+        self.wc_max_concurrency = wc_max_concurrency
+        self.__wc_in_flight = 0
+        self.__lock = threading.RLock()
+        self.__version = 0
+        self.__list_cache = {}  # {key: (version, [json])}
+        self.requests = {}  # {(service, method): int}
+
+    def handle(self, method, path, query, body):
+        """возвращает (code, json, headers)"""
+        if path.startswith(WC_PREFIX):
+            service, latency, handler = 'wc', self.wc_latency, self.__handle_wc
+            path = path[len(WC_PREFIX):]
+        elif path.startswith(MS_PREFIX):
+            service, latency, handler = 'ms', self.ms_latency, self.__handle_ms
+            path = path[len(MS_PREFIX):]
+        else:
+            return 404, {'message': 'Not found'}, {}
+        if service == 'wc' and self.wc_max_concurrency is not None:
+            with self.__lock:
+                self.__wc_in_flight += 1
+                throttled = self.__wc_in_flight > self.wc_max_concurrency
+            try:
+                if throttled:
+                    time.sleep(latency / 10)
+                    self.requests[(service, 'throttled')] = self.requests.get((service, 'throttled'), 0) + 1
+                    return 429, {'code': 'too_many_requests', 'message': 'Too many requests'}, {'Retry-After': '1'}
+                return self.__handle(service, latency, handler, method, path, query, body)
+            finally:
+                with self.__lock:
+                    self.__wc_in_flight -= 1
+        return self.__handle(service, latency, handler, method, path, query, body)
+
+    def __handle(self, service, latency, handler, method, path, query, body):
+        if latency:
+            time.sleep(latency)
+        with self.__lock:
+            self.requests[(service, method)] = self.requests.get((service, method), 0) + 1
+            try:
+                data = json.loads(body) if body else None
+                return handler(method, path.strip('/'), query, data)
+            except FakeApiError as e:
+                if service == 'wc':
+                    return e.code, {'code': 'fake_error', 'message': str(e), 'data': {'status': e.code}}, {}
+                return e.code, {'errors': [{'error': str(e), 'code': e.code}]}, {}
+            except ValueError as e:
+                return 400, {'message': str(e)}, {}
+
+    # -------------------------------------------------------------- WooCommerce
+
+    def __handle_wc(self, method, path, query, data):
+        parts = path.split('/')
+        if parts[-1] == 'batch':
+            if method != 'POST':
+                raise FakeApiError(405, "Method not allowed")
+            return 200, self.__wc_batch('/'.join(parts[:-1]), data), {}
+        if path in self.catalog.wc:
+            if method == 'GET':
+                return self.__wc_list(path, query)
+            if method == 'POST':
+                return 201, self.__wc_create(path, data), {}
+            raise FakeApiError(405, "Method not allowed")
+        entity, wc_id = '/'.join(parts[:-1]), parts[-1]
+        if entity in self.catalog.wc and wc_id.isdigit():
+            wc_object = self.catalog.wc[entity].get(int(wc_id))
+            if wc_object is None:
+                raise FakeApiError(404, "Invalid ID.")
+            if method == 'GET':
+                return 200, wc_object, {}
+            if method in ('PUT', 'POST'):
+                return 200, self.__wc_update(entity, int(wc_id), data), {}
+            raise FakeApiError(405, "Method not allowed")
+        if len(parts) == 3 and parts[0] == 'products' and parts[2] == 'variations' and method == 'GET':
+            return self.__wc_list(path, query)
+        raise FakeApiError(404, "No route was found matching the URL and request method.")
+
+    def __wc_list(self, entity, query):
+        per_page = min(int(query.get('per_page', 10)), WC_MAX_PER_PAGE)
+        page = int(query.get('page', 1))
+        key = ('wc', entity, tuple(sorted((k, v) for k, v in query.items()
+                                          if k in ('status', 'include', 'modified_after'))))
+        wc_objects = self.__get_cached_list(key, lambda: self.__filter_wc(entity, query))
+        total = len(wc_objects)
+        headers = {'X-WP-Total': str(total), 'X-WP-TotalPages': str(-(-total // per_page))}
+        wc_objects = wc_objects[(page - 1) * per_page:page * per_page]
+        if query.get('_fields'):
+            fields = query['_fields'].split(',')
+            wc_objects = [{field: wc_object[field] for field in fields if field in wc_object}
+                          for wc_object in wc_objects]
+        return 200, wc_objects, headers
+
+    def __filter_wc(self, entity, query):
+        wc_objects = list(self.catalog.wc.get(entity, {}).values())
+        if 'include' in query:
+            include = set(int(wc_id) for wc_id in query['include'].split(',') if wc_id)
+            wc_objects = [wc_object for wc_object in wc_objects if wc_object['id'] in include]
+        status = query.get('status', 'any')
+        if status == 'any':
+            # как и WC, без явного статуса товары в корзине не возвращаются
+            wc_objects = [wc_object for wc_object in wc_objects if wc_object.get('status') != 'trash']
+        else:
+            wc_objects = [wc_object for wc_object in wc_objects if wc_object.get('status') == status]
+        if 'modified_after' in query:
+            wc_objects = [wc_object for wc_object in wc_objects
+                          if wc_object.get('date_modified_gmt', '') > query['modified_after']]
+        return sorted(wc_objects, key=lambda wc_object: -wc_object['id'])
+
+    def __wc_create(self, entity, data):
+        wc_id = self.catalog.new_wc_id()
+        wc_object = dict(data, id=wc_id, date_modified_gmt=time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()))
+        if entity == 'products':
+            wc_object.setdefault('meta_data', [])
+            wc_object.setdefault('regular_price', '')
+            wc_object.setdefault('sale_price', '')
+        self.catalog.wc[entity][wc_id] = wc_object
+        self.__version += 1
+        return wc_object
+
+    def __wc_update(self, entity, wc_id, data):
+        wc_object = self.catalog.wc[entity][wc_id]
+        wc_object.update(data)
+        wc_object['date_modified_gmt'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+        self.__version += 1
+        return wc_object
+
+    def __wc_batch(self, entity, data):
+        parts = entity.split('/')
+        if len(parts) == 3 and parts[0] == 'products' and parts[2] == 'variations' \
+                and parts[1].isdigit() and int(parts[1]) in self.catalog.wc['products']:
+            self.catalog.wc.setdefault(entity, {})
+        if entity not in self.catalog.wc:
+            raise FakeApiError(404, "No route was found matching the URL and request method.")
+        data = data or {}
+        if sum(len(data.get(action, [])) for action in ('create', 'update', 'delete')) > WC_BATCH_LIMIT:
+            raise FakeApiError(413, "Unable to accept more than {} items for this request.".format(WC_BATCH_LIMIT))
+        result = {}
+        if 'create' in data:
+            result['create'] = [self.__wc_create(entity, item) for item in data['create']]
+        if 'update' in data:
+            result['update'] = []
+            for item in data['update']:
+                wc_id = int(item.get('id', 0))
+                if wc_id not in self.catalog.wc[entity]:
+                    result['update'].append({'id': wc_id, 'error': {
+                        'code': 'woocommerce_rest_invalid_id', 'message': 'Invalid ID.', 'data': {'status': 400}}})
+                    continue
+                result['update'].append(self.__wc_update(entity, wc_id, item))
+        return result
+
+    # -------------------------------------------------------------- MoySklad
+
+    def __handle_ms(self, method, path, query, data):
+        parts = path.split('/')
+        if path == 'context/companysettings/pricetype/default':
+            return 200, self.catalog.default_price_type, {}
+        if len(parts) < 2 or parts[0] != 'entity':
+            raise FakeApiError(404, "Unknown path \'{}\'".format(path))
+        ms_type = parts[1]
+        if len(parts) >= 3 and parts[2] == 'metadata':
+            metadata = self.catalog.ms_metadata.get(ms_type, {})
+            if len(parts) == 3:
+                return 200, metadata, {}
+            if parts[3] == 'attributes':
+                attributes = metadata.get('attributes', [])
+                return 200, {'meta': {'size': len(attributes)}, 'rows': attributes}, {}
+            raise FakeApiError(404, "Unknown path \'{}\'".format(path))
+        if len(parts) == 2:
+            if method == 'GET':
+                return 200, self.__ms_list(ms_type, query), {}
+            if method == 'POST':
+                if isinstance(data, list):
+                    return 200, [self.__ms_save(ms_type, item) for item in data], {}
+                ms_object = self.__ms_save(ms_type, data)
+                if 'errors' in ms_object:
+                    return 400, ms_object, {}
+                return 200, ms_object, {}
+            raise FakeApiError(405, "Method not allowed")
+        if len(parts) == 3:
+            ms_object = self.catalog.ms.get(ms_type, {}).get(parts[2])
+            if ms_object is None:
+                raise FakeApiError(404, "Object \'{}\' not found".format(path))
+            if method == 'GET':
+                return 200, ms_object, {}
+            if method == 'PUT':
+                return 200, self.__ms_update(ms_object, data), {}
+            raise FakeApiError(405, "Method not allowed")
+        raise FakeApiError(404, "Unknown path \'{}\'".format(path))
+
+    def __ms_list(self, ms_type, query):
+        limit = min(int(query.get('limit', MS_MAX_LIMIT)), MS_MAX_LIMIT)
+        offset = int(query.get('offset', 0))
+        key = ('ms', ms_type, query.get('filter', ''), query.get('order', ''))
+        ms_objects = self.__get_cached_list(key, lambda: self.__filter_ms(ms_type, query))
+        return {
+            'meta': {
+                'href': "{}/entity/{}".format(self.catalog.ms_url, ms_type),
+                'type': ms_type,
+                'size': len(ms_objects),
+                'limit': limit,
+                'offset': offset
+            },
+            'rows': ms_objects[offset:offset + limit]
+        }
+
+    def __filter_ms(self, ms_type, query):
+        if ms_type == 'assortment':
+            ms_objects = [ms_object for assortment_type in MS_ASSORTMENT_TYPES
+                          for ms_object in self.catalog.ms.get(assortment_type, {}).values()]
+        else:
+            ms_objects = list(self.catalog.ms.get(ms_type, {}).values())
+        conditions = parse_ms_filter(query.get('filter') or '')
+        # как и МС, архивные объекты возвращаются только при явном фильтре по archived
+        conditions.setdefault('archived', [('=', 'false')])
+        ms_objects = [ms_object for ms_object in ms_objects if self.__match_ms(ms_object, conditions)]
+        order_str = query.get('order')
+        if order_str:
+            for order in reversed(order_str.split(';')):
+                field, _, direction = order.partition(',')
+                ms_objects.sort(key=lambda ms_object: str(ms_object.get(field, '')), reverse=direction == 'desc')
+        return ms_objects
+
+    @staticmethod
+    def __match_ms(ms_object, conditions):
+        for key, key_conditions in conditions.items():
+            if '/metadata/attributes/' in key:
+                attr_id = key.rsplit('/', 1)[1]
+                actual = None
+                for attribute in ms_object.get('attributes', []):
+                    if attribute.get('id') == attr_id:
+                        actual = attribute.get('value')
+                        break
+            elif key == 'type':
+                actual = ms_object['meta']['type']
+            else:
+                actual = ms_object.get(key)
+            if not any(compare(operator, actual, expected) for operator, expected in key_conditions):
+                return False
+        return True
+
+    def __ms_save(self, ms_type, data):
+        """создание или изменение (если передан meta) одного объекта массового запроса"""
+        if not isinstance(data, dict):
+            return {'errors': [{'error': 'Invalid object', 'code': 1000}]}
+        meta = data.get('meta')
+        if meta is not None:
+            ms_id = meta.get('href', '').rsplit('/', 1)[-1]
+            ms_object = self.catalog.ms.get(ms_type, {}).get(ms_id)
+            if ms_object is None:
+                return {'errors': [{'error': "Object \'{}\' not found".format(ms_id), 'code': 1021}]}
+            return self.__ms_update(ms_object, data)
+        ms_object = json.loads(json.dumps(data))
+        ms_object['updated'] = time.strftime('%Y-%m-%d %H:%M:%S.000')
+        ms_object['created'] = ms_object['updated']
+        self.__version += 1
+        return self.catalog.add_ms_object(ms_type, ms_object)
+
+    def __ms_update(self, ms_object, data):
+        for field, value in (data or {}).items():
+            if field == 'meta':
+                continue
+            if field == 'attributes':
+                attributes = {attribute.get('id') or attribute['meta']['href'].rsplit('/', 1)[1]: attribute
+                              for attribute in ms_object.get('attributes', [])}
+                for attribute in value:
+                    attr_id = attribute['meta']['href'].rsplit('/', 1)[1]
+                    attributes[attr_id] = dict(attributes.get(attr_id, {}), id=attr_id, **attribute)
+                ms_object['attributes'] = list(attributes.values())
+                continue
+            ms_object[field] = value
+        ms_object['updated'] = time.strftime('%Y-%m-%d %H:%M:%S.000')
+        self.__version += 1
+        return ms_object
+
+    def __get_cached_list(self, key, loader):
+        """отфильтрованный список кэшируется до первой записи, чтобы постраничные запросы не фильтровали заново"""
+        cached = self.__list_cache.get(key)
+        if cached is not None and cached[0] == self.__version:
+            return cached[1]
+        result = loader()
+        self.__list_cache[key] = (self.__version, result)
+        return result
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # заголовки и тело уходят отдельными пакетами, без этого keep-alive ждёт отложенный ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def __handle(self, method):
+        url = urlsplit(self.path)
+        # клиент woocommerce по http добавляет '?' к адресу, уже содержащему параметры,
+        # и последний параметр приходит как 'page=1?'
+        query = {key: values[-1].rstrip('?')
+                 for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        code, response_json, headers = self.server.shop.handle(method, unquote(url.path), query, body)
+        response_body = json.dumps(response_json, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(response_body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        logging.debug("Fake server: " + format % args)
+
+
+class FakeServer:
+    """локальный HTTP сервер, изображающий WooCommerce v3 и МойСклад по одному адресу"""
+
+    def __init__(self, host='127.0.0.1', port=0, wc_latency=0.0, ms_latency=0.0, wc_max_concurrency=None,
+                 **catalog_kwargs):
+        self.__server = ThreadingHTTPServer((host, port), FakeRequestHandler)
+        self.__server.daemon_threads = True
+        self.url = "http://{}:{}".format(*self.__server.server_address)
+        self.shop = FakeShop(FakeCatalog(self.url, **catalog_kwargs), wc_latency, ms_latency, wc_max_concurrency)
+        self.__server.shop = self.shop
+
+    def serve_forever(self):
+        self.__server.serve_forever()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self.__server.shutdown()
+        self.__server.server_close()
@@ -0,0 +1,164 @@
+"""Сравнение памяти каталогов синхронизации ассортимента в разных представлениях.
+
+    python -m benchmarks.memory_benchmark --size 10k --size 100k
+
+objects   - объекты МС и полные словари товаров WC (как до проекции полей и компактных записей);
+projected - объекты МС и словари WC только с нужными полями;
+records   - компактные записи MsAssortmentRecord и WcProductRecord.
+
+Каждый вариант загружается в отдельном процессе, тестовый сервер - в своём процессе,
+поэтому пиковый RSS процесса относится только к загрузке каталогов.
+"""
+import argparse
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from benchmarks.catalog import SALE_GROUP_TAG, parse_size
+from benchmarks.sync_benchmark import get_forwarded_arguments, run_server
+
+MODES = ('objects', 'projected', 'records')
+
+
+def get_max_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_catalogs(mode, run_context):
+    """загружает каталоги МС и WC в заданном представлении"""
+    from AssortmentIndex import gen_import_bundles, gen_import_products
+    from CatalogRecords import WcProductRecord
+    from WcApi import WcApi
+
+    if mode == 'records':
+        return run_context.get_ms_products(), run_context.get_ms_bundles(), run_context.get_wc_records()
+    fields = WcProductRecord.FIELDS if mode == 'projected' else None
+    return (list(gen_import_products(run_context.get_import_flag_href())), list(gen_import_bundles()),
+            list(WcApi.gen_all_wc_products(fields=fields)))
+
+
+def run_mode(args, size, mode):
+    """один замер: сервер с каталогом заданного размера и загрузка каталогов"""
+    import importlib
+
+    from MSApi.MSApi import MSApi
+
+    from RunContext import RunContext
+    from WcApi import WcApi
+
+    server_kwargs = {'products': parse_size(size), 'bundles': args.bundles, 'counterparties': 0, 'orders': 0,
+                     'seed': args.seed}
+    parent_connection, child_connection = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=run_server, daemon=True, args=(child_connection, server_kwargs))
+    server_process.start()
+    try:
+        url, catalog_summary, generation_time = parent_connection.recv()
+        WcApi.login(url=url, consumer_key='ck_benchmark', consumer_secret='cs_benchmark')
+        WcApi.pool_size = args.pool_size
+        importlib.import_module('MSApi.MSLowApi').ms_url = url + '/api/remap/1.2'
+        MSApi.set_access_token('benchmark')
+
+        # справочники загружаются до замера
+        run_context = RunContext(sale_group_tag=SALE_GROUP_TAG)
+        run_context.get_product_attributes()
+        run_context.get_price_engine()
+        gc.collect()
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        rss_before = get_max_rss_mib()
+        started = time.perf_counter()
+        catalogs = load_catalogs(mode, run_context)
+        load_seconds = time.perf_counter() - started
+        gc.collect()
+        retained_mib = None
+        if args.tracemalloc:
+            retained_mib = round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 1)
+            tracemalloc.stop()
+        max_rss = get_max_rss_mib()
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+    return {
+        'size': size,
+        'mode': mode,
+        'catalog': catalog_summary,
+        'objects': sum(len(catalog) for catalog in catalogs),
+        'load_seconds': round(load_seconds, 3),
+        'max_rss_mib': round(max_rss, 1),
+        'rss_growth_mib': round(max_rss - rss_before, 1),
+        'retained_mib': retained_mib,
+    }
+
+
+def to_str(results):
+    header = ('size', 'mode', 'objects', 'load s', 'max RSS MiB', 'RSS growth MiB', 'retained MiB')
+    rows = [header] + [(result['size'], result['mode'], str(result['objects']),
+                        "{:.2f}".format(result['load_seconds']), "{:.0f}".format(result['max_rss_mib']),
+                        "{:.0f}".format(result['rss_growth_mib']),
+                        '-' if result['retained_mib'] is None else "{:.1f}".format(result['retained_mib']))
+                       for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.ljust(width) if i < 2 else cell.rjust(width)
+                               for i, (cell, width) in enumerate(zip(row, widths)))
+                     for row in rows)
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description="Память каталогов в разных представлениях")
+    parser.add_argument('--size', action='append', help="размер каталога: 1k, 10k, 100k или число товаров")
+    parser.add_argument('--mode', action='append', choices=MODES, help="представления (по умолчанию все)")
+    parser.add_argument('--bundles', type=int, help="число комплектов (по умолчанию 10%% товаров)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pool-size', type=int, default=4, help="WcApi.pool_size")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="измерить память, занятую каталогами после загрузки (замедляет загрузку)")
+    parser.add_argument('--json', help="сохранить результаты в json файл")
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv):
+    args = get_argument_parser().parse_args(argv)
+    sizes = args.size or ['10k']
+    modes = args.mode or list(MODES)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    if len(sizes) == 1 and len(modes) == 1:
+        results = [run_mode(args, sizes[0], modes[0])]
+    else:
+        # пиковый RSS - характеристика процесса, поэтому каждый замер в своём процессе
+        results = []
+        forwarded = get_forwarded_arguments(argv, ('--size', '--mode', '--json', '--result-file'))
+        for size in sizes:
+            for mode in modes:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    result_file = os.path.join(tmp_dir, 'result.json')
+                    subprocess.run([sys.executable, '-m', 'benchmarks.memory_benchmark', '--size', size,
+                                    '--mode', mode, '--result-file', result_file] + forwarded,
+                                   cwd=BASE_DIR, check=True)
+                    with open(result_file, encoding='utf-8') as f:
+                        results += json.load(f)
+        print(to_str(results))
+
+    for path in (args.result_file, args.json):
+        if path is not None:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=4, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,154 @@
+"""Замер расчёта цен сайта и сравнения с ценами WC без сервера.
+
+    python -m benchmarks.price_benchmark --size 10k --discounts 20
+
+handler - DiscountHandler для каждого объекта и сравнение цен по одному объекту (прежний путь),
+          замеряется на выборке --handler-sample объектов;
+engine  - PriceEngine: таблица цен всего ассортимента и сравнение столбцов цен.
+
+Ассортимент берётся из синтетического каталога, товары распределяются по группам, скидки группы
+бенчмарка действуют на часть групп и отдельные товары. Результаты обоих путей сверяются.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from MSApi import Bundle, PriceType, Product, SpecialPriceDiscount
+from MSApi.DiscountHandler import DiscountHandler
+
+from PriceEngine import PriceEngine, diff_prices, get_price_put_data
+from benchmarks.catalog import SALE_GROUP_TAG, FakeCatalog, parse_size
+
+BASE_URL = 'http://127.0.0.1:0'
+FOLDERS = 50
+ASSORTMENT_PER_DISCOUNT = 100
+CHANGED_SHARE = 0.2
+
+
+def create_assortment(args, size):
+    """тип цены по умолчанию, скидки и объекты МС, распределённые по группам товаров"""
+    rnd = random.Random(args.seed)
+    catalog = FakeCatalog(BASE_URL, products=parse_size(size), counterparties=0, orders=0, seed=args.seed)
+    folders = [catalog.add_ms_object('productfolder', {'name': "Группа {}".format(i)}) for i in range(FOLDERS)]
+    ms_jsons = list(catalog.ms['product'].values()) + list(catalog.ms['bundle'].values())
+    for ms_json in ms_jsons:
+        ms_json['productFolder'] = {'meta': rnd.choice(folders)['meta']}
+    ms_objects = [Product(ms_json) for ms_json in catalog.ms['product'].values()] + \
+                 [Bundle(ms_json) for ms_json in catalog.ms['bundle'].values()]
+
+    discounts = [SpecialPriceDiscount(ms_json) for ms_json in catalog.ms['specialpricediscount'].values()]
+    for i in range(args.discounts):
+        discount_json = {
+            'name': "Скидка {}".format(i),
+            'active': True,
+            'allProducts': False,
+            'allAgents': False,
+            'agentTags': [SALE_GROUP_TAG],
+            'productFolders': [{'meta': folder['meta']} for folder in rnd.sample(folders, 3)],
+            'assortment': [{'meta': ms_json['meta']} for ms_json in rnd.sample(ms_jsons, ASSORTMENT_PER_DISCOUNT)],
+        }
+        if i % 3 == 0:
+            discount_json |= {'usePriceType': True, 'specialPrice': {'priceType': catalog.discount_price_type}}
+        else:
+            discount_json |= {'usePriceType': False, 'discount': rnd.randint(1, 30)}
+        discounts.append(SpecialPriceDiscount(catalog.add_ms_object('specialpricediscount', discount_json)))
+    return PriceType(catalog.default_price_type), discounts, ms_objects, rnd
+
+
+def run_handler(default_price_type, discounts, ms_objects, wc_prices):
+    """прежний путь: правила скидок обходятся для каждого объекта, цены сравниваются по одной"""
+    # скидки подставляются напрямую, загрузка DiscountHandler.init() требует сервера
+    DiscountHandler._DiscountHandler__active_discounts = discounts
+    DiscountHandler._DiscountHandler__default_price_type = default_price_type
+    DiscountHandler.is_init = True
+
+    table = {}
+    changes = {}
+    for i, ms_object in enumerate(ms_objects):
+        ms_prices = (DiscountHandler.get_default_price_value(ms_object),
+                     DiscountHandler.get_actual_price(ms_object, SALE_GROUP_TAG))
+        table[ms_object.get_meta().get_href()] = ms_prices
+        wc_put_data = get_price_put_data(ms_prices, wc_prices[i])
+        if wc_put_data:
+            changes[i] = wc_put_data
+    return table, changes
+
+
+def run_engine(default_price_type, discounts, ms_objects, wc_prices):
+    """новый путь: таблица цен за один проход и сравнение столбцов"""
+    price_engine = PriceEngine(default_price_type.get_meta().get_href(), discounts, SALE_GROUP_TAG)
+    table, errors = price_engine.get_price_table(ms_objects)
+    changes = diff_prices([table[ms_object.get_meta().get_href()] for ms_object in ms_objects], wc_prices)
+    return table, changes
+
+
+def gen_wc_prices(table, ms_objects, rnd):
+    """цены WC: совпадают с МС, кроме доли изменённых"""
+    for ms_object in ms_objects:
+        regular_price, sale_price = table[ms_object.get_meta().get_href()]
+        sale_price = None if sale_price == regular_price else sale_price
+        if rnd.random() < CHANGED_SHARE:
+            regular_price += 10
+        yield regular_price, sale_price
+
+
+def run_size(args, size):
+    default_price_type, discounts, ms_objects, rnd = create_assortment(args, size)
+    price_engine = PriceEngine(default_price_type.get_meta().get_href(), discounts, SALE_GROUP_TAG)
+    wc_prices = list(gen_wc_prices(price_engine.get_price_table(ms_objects)[0], ms_objects, rnd))
+    # прежний путь обходит ассортимент скидок для каждого объекта, поэтому замеряется на выборке
+    sample = len(ms_objects) if args.handler_sample is None else min(args.handler_sample, len(ms_objects))
+
+    results = {}
+    for name, func, objects in (('handler', run_handler, ms_objects[:sample]), ('engine', run_engine, ms_objects)):
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            table, changes = func(default_price_type, discounts, objects, wc_prices[:len(objects)])
+            timings.append(time.perf_counter() - started)
+        results[name] = (table, changes, len(objects), min(timings))
+
+    handler_table, handler_changes = results['handler'][:2]
+    engine_table, engine_changes = results['engine'][:2]
+    if any(engine_table[href] != prices for href, prices in handler_table.items()) or \
+            handler_changes != {i: changes for i, changes in engine_changes.items() if i < sample}:
+        raise AssertionError("{}: PriceEngine prices differ from DiscountHandler".format(size))
+    return [(size, name, objects, len(discounts), len(changes), seconds, seconds / objects * len(ms_objects))
+            for name, (table, changes, objects, seconds) in results.items()]
+
+
+def to_str(rows):
+    header = ('size', 'path', 'objects', 'discounts', 'changed', 'best s', 'us/object', 'full catalog s')
+    rows = [header] + [(size, name, str(objects), str(discounts), str(changed), "{:.3f}".format(seconds),
+                        "{:.1f}".format(seconds / objects * 10 ** 6), "{:.2f}".format(full_seconds))
+                       for size, name, objects, discounts, changed, seconds, full_seconds in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.ljust(width) if i < 2 else cell.rjust(width)
+                               for i, (cell, width) in enumerate(zip(row, widths)))
+                     for row in rows)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Расчёт цен: DiscountHandler против PriceEngine")
+    parser.add_argument('--size', action='append', help="размер каталога: 1k, 10k, 100k или число товаров")
+    parser.add_argument('--discounts', type=int, default=20, help="число скидок группы бенчмарка")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов каждого пути, берётся лучшее время")
+    parser.add_argument('--handler-sample', type=int, default=200,
+                        help="число объектов для замера прежнего пути (время на весь каталог оценивается)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rows = []
+    for size in args.size or ['10k']:
+        rows += run_size(args, size)
+    print(to_str(rows))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
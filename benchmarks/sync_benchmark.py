@@ -0,0 +1,286 @@
+"""Замер синхронизации на локальном тестовом сервере без обращения к магазинам.
+
+    python -m benchmarks.sync_benchmark --size 1k --size 10k --wc-latency-ms 50 --ms-latency-ms 30
+
+Каждый размер каталога запускается в отдельном процессе, тестовый сервер - в своём процессе,
+чтобы его работа не попадала в замеры времени и памяти.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from benchmarks.catalog import SALE_GROUP_TAG, parse_size
+from benchmarks.fake_server import FakeServer
+
+
+def run_server(connection, server_kwargs):
+    """процесс тестового сервера: генерирует каталог и отдаёт адрес через connection"""
+    started = time.perf_counter()
+    server = FakeServer(**server_kwargs)
+    connection.send((server.url, server.shop.catalog.get_summary(), time.perf_counter() - started))
+    server.serve_forever()
+
+
+class StageTimer:
+    """замеры стадий: время, число HTTP запросов и пиковая память"""
+
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.results = []  # [{}]
+
+    def run(self, name, func, *args, http_stages=None, **kwargs):
+        """http_stages - стадии HttpMetrics, запросы которых относятся к замеру (по умолчанию name)"""
+        from HttpMetrics import HttpMetrics
+        from StageProfiler import StageProfiler
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        with HttpMetrics.stage(name), StageProfiler.span(name):
+            result = func(*args, **kwargs)
+        wall_time = time.perf_counter() - started
+        cpu_time = time.process_time() - cpu_started
+
+        requests_count = 0
+        http_time = 0.0
+        http_bytes = 0
+        for (service, stage, method, endpoint), stats in HttpMetrics.get_stats().items():
+            if stage in (http_stages or (name,)):
+                requests_count += stats.count
+                http_time += stats.total_time
+                http_bytes += stats.bytes
+        self.results.append({
+            'stage': name,
+            'wall_seconds': round(wall_time, 4),
+            'cpu_seconds': round(cpu_time, 4),
+            'http_seconds': round(http_time, 4),
+            'requests': requests_count,
+            'response_kib': round(http_bytes / 1024, 1),
+            'peak_mib': round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2) if self.trace_memory else None,
+        })
+        return result
+
+    def to_str(self):
+        header = ('stage', 'wall s', 'cpu s', 'http s', 'requests', 'resp KiB', 'peak MiB')
+        rows = [header] + [(result['stage'], "{:.3f}".format(result['wall_seconds']),
+                            "{:.3f}".format(result['cpu_seconds']), "{:.3f}".format(result['http_seconds']),
+                            str(result['requests']), "{:.1f}".format(result['response_kib']),
+                            '-' if result['peak_mib'] is None else "{:.1f}".format(result['peak_mib']))
+                           for result in self.results]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return '\n'.join('  '.join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                                   for i, (cell, width) in enumerate(zip(row, widths)))
+                         for row in rows)
+
+
+def run_size(args, size):
+    """один замер: сервер с каталогом заданного размера и все стадии синхронизации"""
+    import importlib
+
+    from MSApi.MSApi import MSApi
+
+    from CustomerOrderSyncro import CustomerOrderSyncro
+    from HttpMetrics import HttpMetrics
+    from NewAssortmentCreator import NewAssortmentCreator
+    from ProductsSyncro import ProductsSyncro
+    from RunContext import RunContext
+    from ShardCoordinator import Shard, ShardCoordinator
+    from StageProfiler import StageProfiler
+    from StageScheduler import StageScheduler
+    from WcApi import WcApi
+
+    server_kwargs = {'wc_latency': args.wc_latency_ms / 1000, 'ms_latency': args.ms_latency_ms / 1000,
+                     'wc_max_concurrency': args.wc_max_concurrency,
+                     'products': parse_size(size), 'bundles': args.bundles, 'counterparties': args.counterparties,
+                     'orders': args.orders, 'seed': args.seed, 'variable_products': args.variable_products}
+    parent_connection, child_connection = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=run_server, daemon=True, args=(child_connection, server_kwargs))
+    server_process.start()
+    try:
+        url, catalog_summary, generation_time = parent_connection.recv()
+        print("Catalog {}: generated in {:.1f}s".format(size, generation_time), flush=True)
+
+        WcApi.login(url=url, consumer_key='ck_benchmark', consumer_secret='cs_benchmark')
+        WcApi.pool_size = args.pool_size
+        CustomerOrderSyncro.ORDER_WORKERS = args.order_workers
+        importlib.import_module('MSApi.MSLowApi').ms_url = url + '/api/remap/1.2'
+        MSApi.set_access_token('benchmark')
+        HttpMetrics.instrument_msapi()
+        HttpMetrics.reset()
+        if args.profile or args.profile_dir is not None:
+            StageProfiler.enable(trace_memory=False, stats_dir=args.profile_dir)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        timer = StageTimer(args.tracemalloc)
+        run_context = RunContext(sale_group_tag=SALE_GROUP_TAG)
+        timer.run('setup', run_context.get_task_registry)
+        coordinator = None
+        if args.shard is not None:
+            coordinator = ShardCoordinator(None, Shard.parse(args.shard))
+
+        if args.parallel_stages:
+            # стадии выполняются планировщиком, как в main.py; замеряется общее время
+            from main import add_assortment_stages, add_order_stages
+
+            scheduler = StageScheduler(args.parallel_stages)
+            if 'orders' in args.stages:
+                add_order_stages(scheduler, SALE_GROUP_TAG, run_context, batch=args.batch_orders)
+            if 'assortment' in args.stages:
+                add_assortment_stages(scheduler, SALE_GROUP_TAG, run_context, None, coordinator=coordinator)
+            timer.run('scheduler x{}'.format(args.parallel_stages), scheduler.run,
+                      http_stages=scheduler.get_names())
+        if 'orders' in args.stages and not args.parallel_stages:
+            order_sync = timer.run('orders.load', CustomerOrderSyncro, SALE_GROUP_TAG, run_context=run_context)
+            timer.run('orders.phones', order_sync.check_and_correct_ms_phone_numbers)
+            timer.run('orders.sync', order_sync.sync_orders, args.batch_orders)
+
+        if 'assortment' in args.stages and not args.parallel_stages:
+            products_sync = timer.run('assortment.load', ProductsSyncro, SALE_GROUP_TAG, run_context=run_context,
+                                      coordinator=coordinator)
+            for stage_name, stage in [('duplicates', products_sync.find_duplicate_wc_products),
+                                      ('unsynced', products_sync.find_unsync_wc_products),
+                                      ('characteristics', products_sync.create_new_characteristics),
+                                      ('new_bundles', products_sync.create_new_bundles),
+                                      ('products', products_sync.sync_products),
+                                      ('bundles', products_sync.sync_bundles),
+                                      ('new_products', products_sync.create_new_products)]:
+                timer.run('assortment.' + stage_name, stage)
+
+        if 'variants' in args.stages:
+            creator = timer.run('variants.load', NewAssortmentCreator, None, SALE_GROUP_TAG, run_context)
+            timer.run('variants.create', creator.create_new_wc_variants)
+
+        if 'new_assortment' in args.stages:
+            creator = timer.run('new_assortment.load', NewAssortmentCreator, None, SALE_GROUP_TAG, run_context)
+            timer.run('new_assortment.create', creator.create_new_wc_products, args.assortment_scan == 'stream')
+        if args.tracemalloc:
+            tracemalloc.stop()
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+    total_wall = sum(result['wall_seconds'] for result in timer.results)
+    total_requests = sum(result['requests'] for result in timer.results)
+    max_rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("\n=== {} ({}) ===".format(size, ', '.join("{} {}".format(v, k) for k, v in catalog_summary.items())))
+    print(timer.to_str())
+    print("total: {:.3f}s, {} requests, max RSS {:.0f} MiB".format(total_wall, total_requests, max_rss_mib))
+    print("WC retries: {}, concurrency {:.1f} (lowest {:.1f})".format(
+        WcApi.retry_policy.stats.to_str(), WcApi.get_limiter().limit, WcApi.get_limiter().lowest_limit))
+    print("MS retries: {}".format(HttpMetrics.ms_retry_policy.stats.to_str()))
+    if args.http_table:
+        print(HttpMetrics.to_str())
+    if StageProfiler.is_enabled():
+        print(StageProfiler.to_str())
+        StageProfiler.write_stats()
+    return {
+        'size': size,
+        'catalog': catalog_summary,
+        'wc_latency_ms': args.wc_latency_ms,
+        'ms_latency_ms': args.ms_latency_ms,
+        'stages': timer.results,
+        'total_seconds': round(total_wall, 4),
+        'total_requests': total_requests,
+        'max_rss_mib': round(max_rss_mib, 1),
+        'wc_retries': WcApi.retry_policy.stats.to_json(),
+        'ms_retries': HttpMetrics.ms_retry_policy.stats.to_json(),
+    }
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description="Замер синхронизации на тестовом сервере WC + МС")
+    parser.add_argument('--size', action='append', help="размер каталога: 1k, 10k, 100k или число товаров")
+    parser.add_argument('--bundles', type=int, help="число комплектов (по умолчанию 10%% товаров)")
+    parser.add_argument('--counterparties', type=int, help="число контрагентов (по умолчанию 50%% товаров)")
+    parser.add_argument('--orders', type=int, help="число заказов в обработке (по умолчанию 1%% товаров)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--wc-latency-ms', type=float, default=0.0, help="задержка ответа WC")
+    parser.add_argument('--ms-latency-ms', type=float, default=0.0, help="задержка ответа МС")
+    parser.add_argument('--wc-max-concurrency', type=int,
+                        help="WC отвечает 429 при большем числе одновременных запросов")
+    parser.add_argument('--pool-size', type=int, default=4, help="WcApi.pool_size")
+    parser.add_argument('--variable-products', type=int, default=0,
+                        help="товары с модификациями для стадий variants (по 4 модификации, одной нет на сайте)")
+    parser.add_argument('--stages', default='orders,assortment',
+                        help="orders, assortment, variants, new_assortment через запятую")
+    parser.add_argument('--assortment-scan', choices=('stream', 'lists'), default='stream',
+                        help="new_assortment: один проход по entity/assortment или списки каждого типа")
+    parser.add_argument('--order-workers', type=int, default=4,
+                        help="CustomerOrderSyncro.ORDER_WORKERS: заказы, синхронизируемые одновременно")
+    parser.add_argument('--shard', help="стадии assortment: синхронизировать только часть i/N ассортимента")
+    parser.add_argument('--batch-orders', action='store_true', help="пакетная синхронизация заказов")
+    parser.add_argument('--parallel-stages', type=int, default=0,
+                        help="выполнять стадии планировщиком с указанным числом параллельных стадий")
+    parser.add_argument('--no-tracemalloc', dest='tracemalloc', action='store_false',
+                        help="не измерять пиковую память (tracemalloc замедляет выполнение)")
+    parser.add_argument('--profile', action='store_true', help="вывести замеры стадий StageProfiler")
+    parser.add_argument('--profile-dir', help="сохранить cProfile стадий в каталог и вывести самые затратные функции")
+    parser.add_argument('--http-table', action='store_true', help="вывести таблицу HTTP запросов по эндпоинтам")
+    parser.add_argument('--json', help="сохранить результаты в json файл")
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    parser.add_argument('--verbose', action='store_true', help="выводить лог синхронизации")
+    return parser
+
+
+def get_forwarded_arguments(argv, excluded):
+    """аргументы командной строки без указанных опций и их значений"""
+    forwarded = []
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg in excluded:
+            skip_value = True
+        elif arg.split('=', 1)[0] not in excluded:
+            forwarded.append(arg)
+    return forwarded
+
+
+def main(argv):
+    args = get_argument_parser().parse_args(argv)
+    args.stages = set(stage.strip() for stage in args.stages.split(','))
+    sizes = args.size or ['1k']
+    # ошибки синхронизации ожидаемы (каталог содержит рассинхронизацию), по умолчанию лог не выводится
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL,
+                        format='[%(levelname)s] - %(message)s')
+
+    if len(sizes) == 1:
+        results = [run_size(args, sizes[0])]
+    else:
+        # состояние классов (кэши, справочники) не должно переходить между замерами
+        results = []
+        forwarded = get_forwarded_arguments(argv, ('--size', '--json', '--result-file'))
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                result_file = os.path.join(tmp_dir, 'result.json')
+                subprocess.run([sys.executable, '-m', 'benchmarks.sync_benchmark', '--size', size,
+                                '--result-file', result_file] + forwarded, cwd=BASE_DIR, check=True)
+                with open(result_file, encoding='utf-8') as f:
+                    results += json.load(f)
+        print("\n=== summary ===")
+        for result in results:
+            print("{:>8}: {:9.3f}s  {:7} requests  max RSS {:.0f} MiB".format(
+                result['size'], result['total_seconds'], result['total_requests'], result['max_rss_mib']))
+
+    for path in (args.result_file, args.json):
+        if path is not None:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=4, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -9,7 +9,10 @@ class CheckAssortmentException(Exception):
 
 
 class WcApiException(Exception):
-    pass
+    def __init__(self, message=None, status_code=None):
+        """status_code - код ответа WC, None - ответ не получен"""
+        super().__init__(message)
+        self.status_code = status_code
 
 
 class ReporterException(Exception):
@@ -1,12 +1,25 @@
+import asyncio
 import configparser
 import os
 import sys
+from datetime import datetime, timedelta, timezone
 
 from MSApi.MSApi import MSApi, MSApiHttpException
 from WcApi import WcApi
+from AsyncWcApi import AsyncWcApi
 
+from CatalogMirror import CatalogMirror
 from CustomerOrderSyncro import CustomerOrderSyncro
+from HttpMetrics import HttpMetrics
+from OrderNumberAllocator import OrderNumberAllocator
+from PendingLinks import PendingLinks
 from ProductsSyncro import ProductsSyncro
+from RunContext import RunContext
+from ShardCoordinator import Shard, ShardCoordinator
+from StageProfiler import StageProfiler
+from StageScheduler import StageScheduler
+from SyncCheckpoint import SyncCheckpoint
+from WebhookReceiver import OrderQueue, WebhookOrderProcessor, WebhookReceiver
 from exceptions import *
 import logging
 
@@ -20,43 +33,301 @@ def get_settings_list_parameter(parameter):
     return result
 
 
-if __name__ == '__main__':
+def get_argument_value(name):
+    """значение параметра командной строки '--name value' или '--name=value', None - параметр не задан"""
+    for i, arg in enumerate(sys.argv):
+        if arg == name and i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return None
+
+
+def get_shard_file_path(path, shard: Shard):
+    """файл состояния части каталога рядом с общим: sync_checkpoint.shard-0-of-4.json"""
+    root, extension = os.path.splitext(path)
+    return "{}.shard-{}-of-{}{}".format(root, shard.index, shard.count, extension)
+
+
+def add_order_stages(scheduler, sale_group_tag, run_context, mirror=None, batch=False):
+    """добавляет стадии синхронизации заказов, возвращает имя последней стадии.
+    Её результат - необходимость синхронизации ассортимента"""
+    scheduler.add('orders.load', lambda: CustomerOrderSyncro(sale_group_tag, mirror=mirror, run_context=run_context))
+    scheduler.add('orders.phones', lambda: scheduler.get_result('orders.load').check_and_correct_ms_phone_numbers(),
+                  depends=['orders.load'])
+    return scheduler.add('orders.sync', lambda: scheduler.get_result('orders.load').sync_orders(batch),
+                         depends=['orders.phones'])
+
+
+def add_assortment_stages(scheduler, sale_group_tag, run_context, modified_since, wc_products=None, mirror=None,
+                          pending_links=None, coordinator=None, retry_ms_hrefs=None):
+    """добавляет стадии синхронизации ассортимента. Стадии после загрузки каталогов
+    работают с разными объектами и выполняются параллельно.
+    coordinator - если задан, синхронизируется только часть каталога;
+    retry_ms_hrefs - объекты МС, не синхронизированные прошлым запуском"""
+    def get_stage_func(method_name):
+        return lambda: getattr(scheduler.get_result('assortment.load'), method_name)()
+
+    scheduler.add('assortment.load', lambda: ProductsSyncro(sale_group_tag, None, modified_since, wc_products, mirror,
+                                                            pending_links, run_context, coordinator, retry_ms_hrefs))
+    new_products_depends = ['assortment.load']
+    # характеристики не зависят от каталогов, но нужны новым товарам; общие для всех частей каталога
+    if coordinator is None or coordinator.shard.is_leader():
+        scheduler.add('assortment.characteristics', ProductsSyncro.create_new_characteristics)
+        new_products_depends.append('assortment.characteristics')
+    for stage_name, method_name in [('duplicates', 'find_duplicate_wc_products'),
+                                    ('unsynced', 'find_unsync_wc_products'),
+                                    ('new_bundles', 'create_new_bundles'),
+                                    ('products', 'sync_products'),
+                                    ('bundles', 'sync_bundles')]:
+        scheduler.add('assortment.' + stage_name, get_stage_func(method_name), depends=['assortment.load'])
+    scheduler.add('assortment.new_products', get_stage_func('create_new_products'), depends=new_products_depends)
+
+
+def sync_orders(sale_group_tag, run_context, mirror=None, batch=False, max_parallel_stages=3):
+    """синхронизирует заказы, возвращает необходимость синхронизации ассортимента"""
+    logging.info("Starting CustomerOrder syncro...")
+    scheduler = StageScheduler(max_parallel_stages)
+    last_stage = add_order_stages(scheduler, sale_group_tag, run_context, mirror, batch)
+    scheduler.run()
+    logging.info("CustomerOrder syncro completed")
+    return scheduler.get_result(last_stage)
+
+
+def save_checkpoint(checkpoint, started_at, modified_since, products_syncro: ProductsSyncro):
+    """сохраняет контрольную точку. Объекты МС, которые не удалось синхронизировать, запоминаются
+    и повторяются следующим инкрементальным запуском. Если неизвестно, какие объекты не синхронизированы,
+    контрольная точка не сдвигается"""
+    if not products_syncro.is_complete():
+        logging.warning("Assortment syncro incomplete, checkpoint not saved")
+        return
+    failed_ms_hrefs = products_syncro.get_failed_ms_hrefs()
+    if failed_ms_hrefs:
+        logging.warning("{} MS objects not synchronized, retried on next incremental run".format(len(failed_ms_hrefs)))
+    checkpoint.save(started_at, is_full_run=modified_since is None, failed_ms_hrefs=failed_ms_hrefs)
+
+
+def sync_assortment(sale_group_tag, run_context, checkpoint, modified_since, wc_products=None, mirror=None,
+                    pending_links=None, max_parallel_stages=3, coordinator=None):
+    """синхронизирует ассортимент и сохраняет контрольную точку"""
+    logging.info("Starting Assortment syncro...")
+    products_sync_started = datetime.now(timezone.utc)
+
+    scheduler = StageScheduler(max_parallel_stages)
+    add_assortment_stages(scheduler, sale_group_tag, run_context, modified_since, wc_products, mirror,
+                          pending_links, coordinator, checkpoint.get_failed_ms_hrefs())
+    scheduler.run()
+    save_checkpoint(checkpoint, products_sync_started, modified_since, scheduler.get_result('assortment.load'))
+    logging.info("Assortment syncro completed")
+
+
+def run_sync(sale_group_tag, run_context, start_orders, start_product_syncro, checkpoint, modified_since,
+             mirror=None, pending_links=None, batch_orders=False, max_parallel_stages=3, coordinator=None):
+    """синхронный запуск. Если синхронизация ассортимента нужна независимо от заказов,
+    стадии заказов и ассортимента выполняются одним планировщиком параллельно"""
+    if not start_product_syncro:
+        if start_orders and sync_orders(sale_group_tag, run_context, mirror, batch_orders, max_parallel_stages):
+            sync_assortment(sale_group_tag, run_context, checkpoint, modified_since, mirror=mirror,
+                            pending_links=pending_links, max_parallel_stages=max_parallel_stages,
+                            coordinator=coordinator)
+        return
+    if not start_orders:
+        sync_assortment(sale_group_tag, run_context, checkpoint, modified_since, mirror=mirror,
+                        pending_links=pending_links, max_parallel_stages=max_parallel_stages,
+                        coordinator=coordinator)
+        return
+
+    logging.info("Starting CustomerOrder and Assortment syncro...")
+    products_sync_started = datetime.now(timezone.utc)
+    scheduler = StageScheduler(max_parallel_stages)
+    add_order_stages(scheduler, sale_group_tag, run_context, mirror, batch_orders)
+    add_assortment_stages(scheduler, sale_group_tag, run_context, modified_since, mirror=mirror,
+                          pending_links=pending_links, coordinator=coordinator,
+                          retry_ms_hrefs=checkpoint.get_failed_ms_hrefs())
+    scheduler.run()
+    save_checkpoint(checkpoint, products_sync_started, modified_since, scheduler.get_result('assortment.load'))
+    logging.info("CustomerOrder and Assortment syncro completed")
+
+
+def serve_webhooks(config, base_dir, sale_group_tag, run_context, mirror=None):
+    """принимает вебхуки заказов WC и синхронизирует заказы сразу по поступлении"""
+    queue = OrderQueue(config.get('webhooks', 'queue_dir', fallback=os.path.join(base_dir, "webhook_queue")))
+    receiver = WebhookReceiver(config.get('webhooks', 'host', fallback='0.0.0.0'),
+                               config.getint('webhooks', 'port', fallback=8080),
+                               config['webhooks']['secret'],
+                               queue)
+    sweep_interval = None
+    sweep_interval_minutes = config.getfloat('webhooks', 'sweep_interval_minutes', fallback=60)
+    if sweep_interval_minutes > 0:
+        sweep_interval = timedelta(minutes=sweep_interval_minutes)
+
+    order_sync = CustomerOrderSyncro(sale_group_tag, mirror=mirror, run_context=run_context)
+    processor = WebhookOrderProcessor(order_sync, queue, receiver.order_received, sweep_interval, run_context)
+    processor.start()
     try:
-        log_format = '[%(levelname)s] - %(message)s'
-        logging.basicConfig(level=logging.INFO, format=log_format)
+        receiver.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.shutdown()
+        processor.stop()
+        processor.join()
 
-        config = configparser.ConfigParser()
-        config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.ini"), encoding="utf-8")
 
+def report_http_metrics(config):
+    """выводит сводку HTTP запросов и при необходимости сохраняет её для мониторинга"""
+    logging.info("HTTP requests:\n" + HttpMetrics.to_str())
+    logging.info("WC retries: {}, concurrency {:.1f} (lowest {:.1f})".format(
+        WcApi.retry_policy.stats.to_str(), WcApi.get_limiter().limit, WcApi.get_limiter().lowest_limit))
+    logging.info("MS retries: {}".format(HttpMetrics.ms_retry_policy.stats.to_str()))
+    try:
+        if config.has_option('metrics', 'json'):
+            HttpMetrics.write_json(config.get('metrics', 'json'))
+        if config.has_option('metrics', 'prometheus_textfile'):
+            HttpMetrics.write_prometheus(config.get('metrics', 'prometheus_textfile'))
+    except OSError as e:
+        logging.error("HTTP metrics not saved: {}".format(str(e)))
+
+
+def report_profile(config):
+    """выводит замеры стадий и самые затратные функции, сохраняет статистику cProfile стадий"""
+    if not StageProfiler.is_enabled():
+        return
+    logging.info("Stage profile:\n" + StageProfiler.to_str(config.getint('profile', 'hot_spots', fallback=20)))
+    try:
+        StageProfiler.write_stats()
+    except OSError as e:
+        logging.error("Stage profiles not saved: {}".format(str(e)))
+
+
+def gen_future_result(future):
+    """отдаёт элементы результата future, дожидаясь его завершения"""
+    yield from future.result()
+
+
+async def run_async(sale_group_tag, run_context, start_orders, start_product_syncro, checkpoint, modified_since,
+                    mirror=None, pending_links=None, batch_orders=False, max_parallel_stages=3, coordinator=None):
+    """асинхронный запуск: каталог WC загружается одновременно
+    с синхронизацией заказов и загрузкой ассортимента МС. Асинхронно только чтение каталога,
+    записи в WC выполняют стадии через WcApi"""
+    wc_products_future = None
+    if start_product_syncro and modified_since is None and mirror is None:
+        wc_products_future = asyncio.run_coroutine_threadsafe(
+            AsyncWcApi.get_all_wc('products', fields=ProductsSyncro.WC_PRODUCT_FIELDS), asyncio.get_running_loop())
+    try:
+        if start_orders:
+            start_product_syncro = await asyncio.to_thread(sync_orders, sale_group_tag, run_context, mirror,
+                                                          batch_orders, max_parallel_stages) \
+                                   or start_product_syncro
+
+        if start_product_syncro:
+            wc_products = None
+            if wc_products_future is not None:
+                wc_products = gen_future_result(wc_products_future)
+            await asyncio.to_thread(sync_assortment, sale_group_tag, run_context, checkpoint, modified_since,
+                                    wc_products, mirror, pending_links, max_parallel_stages, coordinator)
+    finally:
+        if wc_products_future is not None:
+            wc_products_future.cancel()
+
+
+if __name__ == '__main__':
+    log_format = '[%(levelname)s] - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_format)
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    config = configparser.ConfigParser()
+    config.read(os.path.join(base_dir, "settings.ini"), encoding="utf-8")
+    HttpMetrics.instrument_msapi(config.getint('moy_sklad', 'max_parallel_requests',
+                                               fallback=HttpMetrics.MS_MAX_PARALLEL))
+    HttpMetrics.ms_retry_policy.max_retries = config.getint('moy_sklad', 'max_retries',
+                                                            fallback=HttpMetrics.ms_retry_policy.max_retries)
+    # --profile: замеры каждой стадии, --profile-dir=<каталог>: ещё и cProfile стадий
+    profile_dir = get_argument_value('--profile-dir')
+    if '--profile' in sys.argv or profile_dir is not None:
+        StageProfiler.enable(config.getboolean('profile', 'tracemalloc', fallback=True),
+                             profile_dir or config.get('profile', 'stats_dir', fallback=None))
+    coordinator = None
+    try:
         WcApi.login(
             url=config['woocommerce']['url'],
             consumer_key=config['woocommerce']['consumer_key'],
             consumer_secret=config['woocommerce']['consumer_secret'])
         WcApi.read_only_mode = False
+        WcApi.pool_size = config.getint('woocommerce', 'pool_size', fallback=WcApi.pool_size)
+        WcApi.retry_policy.max_retries = config.getint('woocommerce', 'max_retries',
+                                                       fallback=WcApi.retry_policy.max_retries)
 
         MSApi.set_access_token(config['moy_sklad']['access_token'])
         sale_group_tag = config['moy_sklad']['group_tag']
 
-        start_product_syncro = (len(sys.argv) == 1) or ('--products' in sys.argv)
+        start_orders = '--orders' in sys.argv
+        start_product_syncro = ('--products' in sys.argv) or not start_orders
+        batch_orders = '--batch-orders' in sys.argv
+        max_parallel_stages = config.getint('sync', 'max_parallel_stages', fallback=3)
 
-        if '--orders' in sys.argv:
-            logging.info("Starting CustomerOrder syncro...")
-            order_sync = CustomerOrderSyncro(sale_group_tag)
-            order_sync.check_and_correct_ms_phone_numbers()
-            start_product_syncro = start_product_syncro or order_sync.sync_orders()
-            logging.info("CustomerOrder syncro completed")
+        checkpoint_path = config.get('sync', 'checkpoint', fallback=os.path.join(base_dir, "sync_checkpoint.json"))
+        pending_links_path = config.get('sync', 'pending_links',
+                                        fallback=os.path.join(base_dir, "pending_wc_links.json"))
+        shard_value = get_argument_value('--shard')
+        if shard_value is not None:
+            # несколько процессов или хостов делят ассортимент на части, каталог shard_dir у них общий
+            try:
+                shard = Shard.parse(shard_value)
+            except ValueError as e:
+                raise SyncroException(str(e))
+            coordinator = ShardCoordinator(config.get('sync', 'shard_dir', fallback=os.path.join(base_dir, "shards")),
+                                           shard)
+            coordinator.claim()
+            checkpoint_path = get_shard_file_path(checkpoint_path, shard)
+            pending_links_path = get_shard_file_path(pending_links_path, shard)
+            if start_orders and not shard.is_leader():
+                logging.info("Shard {}: orders are synchronized by shard 0/{}".format(shard, shard.count))
+                start_orders = False
+        checkpoint = SyncCheckpoint(checkpoint_path)
+        pending_links = PendingLinks(pending_links_path)
 
-        if start_product_syncro:
-            logging.info("Starting Assortment syncro...")
-            products_sync = ProductsSyncro(sale_group_tag)
-            products_sync.find_duplicate_wc_products()
-            products_sync.find_unsync_wc_products()
-            products_sync.create_new_characteristics()
-            products_sync.create_new_bundles()
-            products_sync.sync_products()
-            products_sync.sync_bundles()
-            products_sync.create_new_products()
-            logging.info("Assortment syncro completed")
+        mirror = None
+        if config.has_option('mirror', 'path'):
+            mirror = CatalogMirror(config.get('mirror', 'path'))
+            # части синхронизации с общим зеркалом не обновляют его одновременно, см. CatalogMirror.refresh
+            mirror.refresh(timedelta(hours=config.getfloat('mirror', 'full_refresh_interval_hours', fallback=24)))
+        # атрибуты, каталоги и реестр задач загружаются один раз на запуск
+        run_context = RunContext(mirror, sale_group_tag)
+        # номера заказов резервируются через общий файл, поэтому одновременные запуски не выдают одинаковых
+        run_context.set_order_number_allocator(OrderNumberAllocator(
+            config.get('sync', 'order_numbers', fallback=os.path.join(base_dir, "order_numbers.json")),
+            config.getint('sync', 'order_number_block', fallback=OrderNumberAllocator.BLOCK_SIZE)))
+        CustomerOrderSyncro.ORDER_WORKERS = config.getint('sync', 'order_workers',
+                                                          fallback=CustomerOrderSyncro.ORDER_WORKERS)
+
+        modified_since = None
+        if '--incremental' in sys.argv and mirror is not None:
+            logging.info("Catalog mirror is refreshed incrementally, incremental mode ignored")
+        elif '--incremental' in sys.argv:
+            full_sync_interval = timedelta(hours=config.getfloat('sync', 'full_sync_interval_hours', fallback=24))
+            modified_since = checkpoint.get_modified_since(full_sync_interval)
+            if modified_since is None:
+                logging.info("Full syncro is due, incremental mode ignored")
+
+        if '--webhooks' in sys.argv:
+            serve_webhooks(config, base_dir, sale_group_tag, run_context, mirror)
+        elif '--async' in sys.argv:
+            AsyncWcApi.login(
+                url=config['woocommerce']['url'],
+                consumer_key=config['woocommerce']['consumer_key'],
+                consumer_secret=config['woocommerce']['consumer_secret'],
+                concurrency=config.getint('woocommerce', 'async_concurrency', fallback=WcApi.pool_size))
+            asyncio.run(run_async(sale_group_tag, run_context, start_orders, start_product_syncro,
+                                  checkpoint, modified_since, mirror, pending_links, batch_orders,
+                                  max_parallel_stages, coordinator))
+        else:
+            run_sync(sale_group_tag, run_context, start_orders, start_product_syncro, checkpoint, modified_since,
+                     mirror, pending_links, batch_orders, max_parallel_stages, coordinator)
+
+        task_registry = run_context.get_task_registry()
+        logging.info("Tasks: {} created, {} skipped as existing, {} duplicates skipped".format(
+            task_registry.created_count, task_registry.skipped_count, task_registry.duplicate_count))
 
     except KeyError as e:
         print(e)
@@ -68,3 +339,8 @@ if __name__ == '__main__':
         print(e)
     except ReporterException as e:
         print(e)
+    finally:
+        if coordinator is not None:
+            coordinator.release()
+        report_http_metrics(config)
+        report_profile(config)
@@ -1,6 +1,11 @@
 
+from datetime import timedelta, timezone
+
 EMPLOYEE_ID = "68a33c0e-9f23-11ea-0a80-02350002e869"
 
+# время в API МойСклад - московское
+MS_TIMEZONE = timezone(timedelta(hours=3))
+
 STORE_NAME = 'Основной склад'
 
 WC_ID_ATTR_NAME = 'wc_id'